@@ -2,13 +2,14 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
 from db.db import get_db
-from db.schemas import UserCreate, Token
+from db.schemas import UserCreate, Token, PasswordChange
 from datetime import timedelta
-from db.auth_security import create_access_token, verify_password
+from db.auth_security import create_access_token, verify_password, get_password_hash, get_current_user
 from fastapi.security import OAuth2PasswordRequestForm
 import os
 import logging
-from db.crud_auth import create_user, get_user_by_username
+from db.crud_auth import create_user, get_user_by_username, update_user, set_user_active
+from db.models import User
 
 # Глобальный логгер (подхватит config из main.py)
 logger = logging.getLogger(__name__)
@@ -61,7 +62,8 @@ async def login_for_access_token(
         user = get_user_by_username(db, username=form_data.username)
         
         # Проверка пароля (если пользователь не найден или пароль неверный — общий error)
-        if not user or not verify_password(form_data.password, user.hashed_password):
+        # Отключенный пользователь (is_active = False) войти не может
+        if not user or user.is_active is False or not verify_password(form_data.password, user.hashed_password):
             logger.warning(f"Неуспешная попытка логина для username: {form_data.username}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -81,6 +83,8 @@ async def login_for_access_token(
         # Возврат токена клиенту
         return {"access_token": access_token, "token_type": "bearer"}
     
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         db.rollback()
         logger.error(f"DB ошибка при логине для {form_data.username}: {e}")
@@ -89,3 +93,39 @@ async def login_for_access_token(
         logger.error(f"Неожиданная ошибка при логине для {form_data.username}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+
+# --- 3. СМЕНА ПАРОЛЯ ---
+@router_auth.post("/me/password", response_model=dict)
+def change_password(
+    passwords: PasswordChange,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    try:
+        if not verify_password(passwords.current_password, current_user.hashed_password):
+            logger.warning(f"Неверный текущий пароль при смене пароля пользователем {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect current password")
+        # update_user сбрасывает пользователя из кэша аутентификации этого процесса
+        update_user(db, current_user.user_id, hashed_password=get_password_hash(passwords.new_password))
+        logger.info(f"Пользователь {current_user.user_id} сменил пароль")
+        return {"message": "Password changed"}
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при смене пароля пользователя {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during password change")
+
+
+# --- 4. ОТКЛЮЧЕНИЕ СВОЕЙ УЧЕТНОЙ ЗАПИСИ ---
+@router_auth.delete("/me", response_model=dict)
+def deactivate_account(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Отключает учетную запись: выданные токены перестают приниматься сразу (в других процессах — через TTL кэша)."""
+    try:
+        set_user_active(db, current_user.user_id, False)
+        logger.info(f"Пользователь {current_user.user_id} отключил свою учетную запись")
+        return {"message": "Account deactivated"}
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при отключении пользователя {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during deactivation")
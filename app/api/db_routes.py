@@ -3,11 +3,14 @@ from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
 from db.db import get_db
 from db.auth_security import get_current_user 
-from db.schemas import UserCreate, ProjectInitialization, ProjectShare, ProjectResponse, ProjectResponseWithAccess
+from db.schemas import UserCreate, ProjectInitialization, ProjectShare, ProjectResponse, ProjectResponseWithAccess, UserTokenUsage
 from db.models import User, Project
-from typing import List, Annotated
+from typing import List, Annotated, Optional
+from datetime import date
 from pathlib import Path
 from db.crud_auth import get_user_by_username
+from db.crud_user import get_user_monthly_token_usage, get_user_token_usage_breakdown
+from services import usage_buffer
 import os
 import logging
 from db.crud_project import (
@@ -194,4 +197,37 @@ async def upload_project_files_endpoint(
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail=f"Не удалось завершить загрузку файлов: {e}"
-        )
\ No newline at end of file
+        )
+
+
+# --- 6. РАСХОД ТОКЕНОВ ПОЛЬЗОВАТЕЛЯ ---
+@router_db.get("/usage", response_model=UserTokenUsage)
+def get_token_usage(
+    month: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Расход токенов по месяцам и разбивка за month (YYYY-MM, по умолчанию текущий) по моделям и этапам."""
+    try:
+        month = month or date.today().strftime("%Y-%m")
+        token_usage = get_user_monthly_token_usage(db, current_user.user_id)
+        breakdown = {(row["model"], row["stage"]): row["tokens"]
+                     for row in get_user_token_usage_breakdown(db, current_user.user_id, month)}
+        # Списания из буфера, еще не сброшенные в БД
+        for pending in usage_buffer.pending_usage(current_user.user_id):
+            pending_month = pending["day"][:7]
+            token_usage[pending_month] = token_usage.get(pending_month, 0) + pending["tokens"]
+            if pending_month == month:
+                key = (pending["model"], pending["stage"])
+                breakdown[key] = breakdown.get(key, 0) + pending["tokens"]
+        return UserTokenUsage(
+            user_id=current_user.user_id,
+            token_usage=dict(sorted(token_usage.items())),
+            month=month,
+            breakdown=[{"model": model, "stage": stage, "tokens": tokens}
+                       for (model, stage), tokens in sorted(breakdown.items(), key=lambda item: -item[1])],
+        )
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при получении расхода токенов для {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during usage retrieval")
@@ -3,16 +3,26 @@ from services import workflows as wrk
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from db.db import get_db
-from db.schemas import ProjectInitialization, ScenarioSchema, ScenarioStructureSchema, WorkflowSchema, WorkflowFactsSearchSchema
-from db.auth_security import get_current_user 
+from db.db import get_db, SessionLocal
+from db.schemas import ProjectInitialization, ScenarioSchema, ScenarioStructureSchema, WorkflowSchema, WorkflowFactsSearchSchema, WorkflowJobResponse, PipelineSchema, ScenarioPartSchema
+from db.auth_security import get_current_user, oauth2_scheme
 from db.crud_project import get_project_by_id, get_access_level
+from db.crud_job import get_job, get_project_jobs, get_active_project_jobs
+from services.jobs import submit_job, cancel_job, job_queue_position
+from services.admission import WorkflowQuotaExceeded
+from services import events
+from fastapi import Request, Header
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+import asyncio
+import json
 import logging
-from db.crud_user import update_user_token_usage
 
 # Глобальный логгер (подхватит config из main.py)
 logger = logging.getLogger(__name__)
 
+SSE_KEEPALIVE_SECONDS = 15  # Пустой комментарий раз в N секунд, чтобы прокси не рвали соединение
+
 router_llm_workflows = APIRouter(  # Переименовал для краткости
     prefix="/workflow",
     tags=["LLM Workflows"]
@@ -27,7 +37,7 @@ from db.db import get_db
 from db.schemas import ProjectInitialization, ScenarioSchema, ScenarioStructureSchema, WorkflowSchema
 from db.auth_security import get_current_user 
 from db.crud_project import get_project_by_id, get_access_level
-from db.models import User  # Для update_user_token_usage
+from db.models import User
 import logging
 
 # Глобальный логгер (подхватит config из main.py)
@@ -39,11 +49,12 @@ router = APIRouter(  # Переименовал для краткости
 )
 
 # --- 1. РАСШИРЕНИЕ БАЗЫ ДАННЫХ (FACTS EXPAND) ---
-@router_llm_workflows.post("/{project_id}/facts/expand", response_model=dict, status_code=status.HTTP_200_OK)
+@router_llm_workflows.post("/{project_id}/facts/expand", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
 def expand_database(
     project_id: int,
     params: WorkflowSchema,
     current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     try:
@@ -53,17 +64,15 @@ def expand_database(
             logger.warning(f"Отказано в доступе к workflow expand для проекта {project_id} от {current_user.user_id}")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
         
-        # Вызов workflow
-        status, tokens = wrk.expand_database(params.folder_path, params.llm_model)
-        if status != "success":
-            logger.error(f"Workflow expand failed for project {project_id}: {status}")
-            raise HTTPException(status_code=500, detail=status)
-        
-        # Обновление токенов
-        update_user_token_usage(db, current_user.user_id, tokens)
+        # Запуск workflow в фоне (токены спишутся по завершении задачи)
+        job = submit_job(db, project_id, current_user.user_id, "expand", params.model_dump(),
+                         idempotency_key=idempotency_key)
         
-        logger.info(f"База данных расширена для проекта {project_id} пользователем {current_user.user_id}")
-        return {"status": "ok", "message": f"Database expanded successfully", "user": current_user.username}
+        logger.info(f"Расширение БД поставлено в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Database expansion started", "user": current_user.username}
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     except HTTPException:
         # Пропускаем дальше — FastAPI сам обработает корректный статус
         raise
@@ -77,11 +86,12 @@ def expand_database(
     
 
 # --- 2. ПОИСК ФАКТОВ И СВЯЗЕЙ (FACTS SEARCH) ---
-@router_llm_workflows.post("/{project_id}/facts/search", response_model=dict, status_code=status.HTTP_200_OK)
+@router_llm_workflows.post("/{project_id}/facts/search", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
 def find_facts(
     project_id: int,
     params: WorkflowFactsSearchSchema,
     current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     try:
@@ -91,21 +101,16 @@ def find_facts(
             logger.warning(f"Отказано в доступе к workflow search для проекта {project_id} от {current_user.user_id}")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
         
-        # Вызов workflow (main по умолчанию)
-        if params.search_type == "main":
-            status, tokens = wrk.find_connections_main(params.folder_path, params.llm_model)
-        else:
-            status, tokens = wrk.find_connections_blind_spots(params.folder_path, params.llm_model)
-        if status != "success":
-            logger.error(f"Workflow search failed for project {project_id}: {status}")
-            raise HTTPException(status_code=500, detail=status)
+        # Запуск workflow в фоне (main или blind_spots — по search_type)
+        job = submit_job(db, project_id, current_user.user_id, "search", params.model_dump(),
+                         idempotency_key=idempotency_key)
         
-        # Обновление токенов
-        update_user_token_usage(db, current_user.user_id, tokens)
-        
-        logger.info(f"Факты найдены для проекта {project_id} пользователем {current_user.user_id}")
-        return {"status": "ok", "message": f"Facts search completed",  "user": current_user.username}
+        logger.info(f"Поиск фактов поставлен в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Facts search started",  "user": current_user.username}
     
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     except HTTPException:
         raise
     except SQLAlchemyError as e:
@@ -118,11 +123,12 @@ def find_facts(
 
 
 # --- 3. ПРОВЕРКА ГИПОТЕЗ (FACTS CHECK) ---
-@router_llm_workflows.post("/{project_id}/facts/check", response_model=dict, status_code=status.HTTP_200_OK)
+@router_llm_workflows.post("/{project_id}/facts/check", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
 def check_hypothesis(
     project_id: int,
     params: WorkflowFactsSearchSchema,
     current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     try:
@@ -132,18 +138,16 @@ def check_hypothesis(
             logger.warning(f"Отказано в доступе к workflow check для проекта {project_id} от {current_user.user_id}")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
         
-        # Вызов workflow
-        status, tokens = wrk.check_hypotheses(params.folder_path, params.llm_model, params.search_type)
-        if status != "success":
-            logger.error(f"Workflow check failed for project {project_id} ({params.search_type}): {status}")
-            raise HTTPException(status_code=500, detail=status)
-        
-        # Обновление токенов
-        update_user_token_usage(db, current_user.user_id, tokens)
+        # Запуск workflow в фоне
+        job = submit_job(db, project_id, current_user.user_id, "check", params.model_dump(),
+                         idempotency_key=idempotency_key)
         
-        logger.info(f"Гипотезы проверены ({params.search_type}) для проекта {project_id} пользователем {current_user.user_id}")
-        return {"status": "ok", "message": f"Hypotheses checked successfully ({params.search_type})", "user": current_user.username}
+        logger.info(f"Проверка гипотез ({params.search_type}) поставлена в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Hypotheses check started ({params.search_type})", "user": current_user.username}
     
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     except HTTPException:
         raise
     except SQLAlchemyError as e:
@@ -155,11 +159,12 @@ def check_hypothesis(
         raise HTTPException(status_code=500, detail="Internal server error during workflow")
 
 # --- 4. СОЗДАНИЕ СТРУКТУРЫ СЦЕНАРИЯ ---
-@router_llm_workflows.post("/{project_id}/scenario/structure", response_model=dict, status_code=status.HTTP_200_OK)
+@router_llm_workflows.post("/{project_id}/scenario/structure", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
 def create_scenario_structure(
     project_id: int,
     scenario: ScenarioStructureSchema,
     current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     try:
@@ -169,21 +174,15 @@ def create_scenario_structure(
             logger.warning(f"Отказано в доступе к workflow structure для проекта {project_id} от {current_user.user_id}")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
         
-        # Вызов workflow
-        status, tokens = wrk.build_script_structure(
-            topic_path=scenario.folder_path, 
-            num_series=scenario.num_series, 
-            llm_model_name=scenario.llm_model
-        )
-        if status != "success":
-            logger.error(f"Workflow structure failed for project {project_id}: {status}")
-            raise HTTPException(status_code=500, detail=status)
-        
-        # Обновление токенов
-        update_user_token_usage(db, current_user.user_id, tokens)
-        
-        logger.info(f"Структура сценария создана для проекта {project_id} пользователем {current_user.user_id}")
-        return {"status": "ok", "message": f"Scenario structure created", "user": current_user.username}
+        # Запуск workflow в фоне
+        job = submit_job(db, project_id, current_user.user_id, "structure", scenario.model_dump(),
+                         idempotency_key=idempotency_key)
+        
+        logger.info(f"Создание структуры сценария поставлено в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Scenario structure generation started", "user": current_user.username}
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     except HTTPException:
         raise
     except SQLAlchemyError as e:
@@ -197,11 +196,12 @@ def create_scenario_structure(
 
 
 # --- 5. СОЗДАНИЕ СЦЕНАРИЯ (ТЕКСТ) ---
-@router_llm_workflows.post("/{project_id}/scenario", response_model=dict, status_code=status.HTTP_200_OK)
+@router_llm_workflows.post("/{project_id}/scenario", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
 def create_scenario(
     project_id: int,
     project: ScenarioSchema,  # Переименовал param для ясности
     current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     try:
@@ -211,22 +211,16 @@ def create_scenario(
             logger.warning(f"Отказано в доступе к workflow scenario для проекта {project_id} от {current_user.user_id}")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
         
-        # Вызов workflow
-        status, tokens = wrk.write_script_text(
-            topic_path=project.folder_path, 
-            temperature=project.temperature, 
-            llm_model_name=project.llm_model
-        )
-        if status != "success":
-            logger.error(f"Workflow scenario failed for project {project_id}: {status}")
-            raise HTTPException(status_code=500, detail=status)
-        
-        # Обновление токенов
-        update_user_token_usage(db, current_user.user_id, tokens)
-        
-        logger.info(f"Сценарий создан для проекта {project_id} пользователем {current_user.user_id}")
-        return {"status": "ok", "message": f"Scenario text generated", "user": current_user.username}
+        # Запуск workflow в фоне
+        job = submit_job(db, project_id, current_user.user_id, "scenario", project.model_dump(),
+                         idempotency_key=idempotency_key)
+        
+        logger.info(f"Написание сценария поставлено в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Scenario text generation started", "user": current_user.username}
     
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
     except HTTPException:
         raise
     except SQLAlchemyError as e:
@@ -236,3 +230,275 @@ def create_scenario(
     except Exception as e:
         logger.error(f"Неожиданная ошибка при создании сценария для проекта {project_id} от {current_user.user_id}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error during workflow")
+
+
+# --- 5.2. ПЕРЕГЕНЕРАЦИЯ ГЛАВЫ ИЛИ СЕРИИ ---
+def _submit_regeneration(db: Session, project_id: int, current_user: User, params: dict, target: str,
+                         idempotency_key: Optional[str] = None) -> dict:
+    try:
+        access_level = get_access_level(db, project_id, current_user.user_id)
+        if access_level not in ["WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в доступе к перегенерации {target} для проекта {project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        
+        job = submit_job(db, project_id, current_user.user_id, "regenerate", params,
+                         idempotency_key=idempotency_key)
+        
+        logger.info(f"Перегенерация {target} поставлена в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": f"Regeneration of {target} started", "user": current_user.username}
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Перегенерация {target} отклонена для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при перегенерации {target} для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during regeneration")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при перегенерации {target} для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error during workflow")
+
+
+@router_llm_workflows.post("/{project_id}/scenario/chapters/{chapter_id}", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def regenerate_chapter(
+    project_id: int,
+    chapter_id: str,
+    params: ScenarioPartSchema,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Переписывает одну главу готового сценария и перерисовывает только ее серию."""
+    return _submit_regeneration(db, project_id, current_user, {**params.model_dump(), "chapter_id": chapter_id},
+                                f"chapter {chapter_id}", idempotency_key)
+
+
+@router_llm_workflows.post("/{project_id}/scenario/series/{serie_id}", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def regenerate_serie(
+    project_id: int,
+    serie_id: str,
+    params: ScenarioPartSchema,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Переписывает все главы одной серии готового сценария."""
+    return _submit_regeneration(db, project_id, current_user, {**params.model_dump(), "serie_id": serie_id},
+                                f"serie {serie_id}", idempotency_key)
+
+
+# --- 5.1. ВЕСЬ ПАЙПЛАЙН ОДНОЙ ЗАДАЧЕЙ (RUN ALL) ---
+@router_llm_workflows.post("/{project_id}/pipeline", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def run_full_pipeline(
+    project_id: int,
+    params: PipelineSchema,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Прогоняет все этапы от загруженных отчетов до .docx; независимые этапы идут параллельно."""
+    try:
+        # Пайплайн пишет сценарий, поэтому права — как у написания сценария
+        access_level = get_access_level(db, project_id, current_user.user_id)
+        if access_level not in ["WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в доступе к workflow pipeline для проекта {project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        
+        job = submit_job(db, project_id, current_user.user_id, "pipeline", params.model_dump(),
+                         idempotency_key=idempotency_key)
+        
+        logger.info(f"Пайплайн поставлен в очередь для проекта {project_id} пользователем {current_user.user_id}: {job.job_id}")
+        return {"status": "accepted", "job_id": job.job_id, "job_status": job.status, "message": "Pipeline started", "user": current_user.username}
+    
+    except WorkflowQuotaExceeded as e:
+        logger.warning(f"Запуск отклонен для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при запуске пайплайна для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during pipeline start")
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при запуске пайплайна для проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error during workflow")
+
+
+@router_llm_workflows.get("/{project_id}/stages", response_model=List[dict])
+def get_pipeline_stages(
+    project_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Состояние этапов по манифесту проекта: fresh / stale (что изменилось) / never_run."""
+    try:
+        access_level = get_access_level(db, project_id, current_user.user_id)
+        if access_level not in ["READ", "WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в доступе к этапам проекта {project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        project = get_project_by_id(db, project_id)
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        return wrk.stage_statuses(project.file_path)
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при получении этапов проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during stages retrieval")
+
+
+# --- 6. СОСТОЯНИЕ ФОНОВЫХ ЗАДАЧ ---
+@router_llm_workflows.get("/jobs/{job_id}", response_model=WorkflowJobResponse)
+def get_job_status(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        job = get_job(db, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        # Проверка доступа к проекту задачи (нужен хотя бы READ)
+        access_level = get_access_level(db, job.project_id, current_user.user_id)
+        if access_level not in ["READ", "WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в доступе к задаче {job_id} проекта {job.project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        response = WorkflowJobResponse.model_validate(job)
+        if job.status == "queued":
+            response.queue_position = job_queue_position(job_id) or None
+        return response
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при получении задачи {job_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during job retrieval")
+
+
+@router_llm_workflows.get("/{project_id}/jobs", response_model=List[WorkflowJobResponse])
+def list_project_jobs(
+    project_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        access_level = get_access_level(db, project_id, current_user.user_id)
+        if access_level not in ["READ", "WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в доступе к задачам проекта {project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        return get_project_jobs(db, project_id)
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при получении задач проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during jobs retrieval")
+
+
+@router_llm_workflows.post("/jobs/{job_id}/cancel", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def cancel_workflow_job(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Останавливает задачу: текущий вызов LLM обрывается, списываются только потраченные токены."""
+    try:
+        job = get_job(db, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        # Чужие задачи отменяют только WRITE/ADMIN; с правом READ — только свои (READ может запустить лишь expand)
+        access_level = get_access_level(db, job.project_id, current_user.user_id)
+        if not (access_level in ["WRITE", "ADMIN"] or (access_level == "READ" and job.user_id == current_user.user_id)):
+            logger.warning(f"Отказано в отмене задачи {job_id} проекта {job.project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this job")
+        if job.status not in ("queued", "running") or not cancel_job(job_id):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Job is not active (status: {job.status})")
+        
+        logger.info(f"Пользователь {current_user.user_id} отменил задачу {job_id}")
+        return {"status": "cancelling", "job_id": job_id}
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при отмене задачи {job_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during job cancellation")
+
+
+@router_llm_workflows.post("/{project_id}/cancel", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def cancel_project_workflows(
+    project_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Останавливает все активные задачи проекта (нужен WRITE: задачи могли запустить другие участники)."""
+    try:
+        access_level = get_access_level(db, project_id, current_user.user_id)
+        if access_level not in ["WRITE", "ADMIN"]:
+            logger.warning(f"Отказано в отмене задач проекта {project_id} от {current_user.user_id}")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+        
+        cancelled = [job.job_id for job in get_active_project_jobs(db, project_id) if cancel_job(job.job_id)]
+        logger.info(f"Пользователь {current_user.user_id} отменил задачи проекта {project_id}: {cancelled}")
+        return {"status": "cancelling", "job_ids": cancelled}
+    except HTTPException:
+        raise
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error(f"DB ошибка при отмене задач проекта {project_id} от {current_user.user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Database error during jobs cancellation")
+
+
+# --- 7. ПОТОК СОБЫТИЙ ПРОЕКТА (SSE) ---
+def _authorize_project_events(project_id: int, token: str = Depends(oauth2_scheme)) -> User:
+    """
+    Аутентификация и проверка доступа для потока событий. Синхронная зависимость — FastAPI
+    выполняет ее в пуле потоков, а не в цикле событий. Сессия своя и закрывается здесь же:
+    с get_db соединение из пула держалось бы до конца стрима, то есть все время подписки.
+    """
+    with SessionLocal() as db:
+        current_user = get_current_user(token, db)
+        access_level = get_access_level(db, project_id, current_user.user_id)
+    if access_level not in ["READ", "WRITE", "ADMIN"]:
+        logger.warning(f"Отказано в доступе к событиям проекта {project_id} от {current_user.user_id}")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied to this project")
+    return current_user
+
+
+@router_llm_workflows.get("/{project_id}/events")
+async def stream_project_events(
+    project_id: int,
+    request: Request,
+    current_user: User = Depends(_authorize_project_events),
+):
+    """
+    Server-Sent Events по всем задачам проекта: линза готова, раунд проверки готов,
+    глава готова (вместе с текстом), задача завершена/упала.
+    """
+    async def event_stream():
+        # Подписка — внутри генератора: если клиент отключится до начала ответа, генератор не запустится
+        # и подписки не будет. Подписываемся до первого yield, чтобы не потерять события задачи,
+        # запущенной сразу после ": connected"
+        subscription = events.subscribe(project_id)
+        try:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Событий не было N секунд — пустой комментарий, чтобы прокси не рвали соединение
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            events.unsubscribe(project_id, subscription)
+
+    logger.info(f"Пользователь {current_user.user_id} подписался на события проекта {project_id}")
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
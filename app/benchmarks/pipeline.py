@@ -0,0 +1,210 @@
+"""
+Бенчмарк всего пайплайна (5 этапов) на синтетическом проекте и локальной заглушке LLM.
+
+Запуск из папки app:
+    python -m benchmarks.pipeline --pdfs 3 --pdf-pages 20 --txts 2 --latency 0 --output bench.json
+
+С --latency 0 время этапов — чистые накладные расходы оркестрации (загрузки, хэши,
+файлы, потоки, лимитер), без модели. Результат — JSON для сравнения запусков.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+from pathlib import Path
+
+# Заглушка и холодный кэш загрузок должны быть выбраны до импорта services.gemini_api
+os.environ["LLM_BACKEND"] = "fake"
+os.environ.setdefault("GEMINI_UPLOAD_CACHE_FILE", str(Path(tempfile.mkdtemp(prefix="bench_cache_")) / "uploads.json"))
+
+from services import gemini_api
+from services import workflows as wrk
+from services.fake_gemini import FakeGeminiBackend
+
+_WORDS = ("летопись", "экспедиция", "министр", "архив", "договор", "крепость", "инженер", "донесение", "граница")
+
+
+# --- СИНТЕТИЧЕСКИЙ ПРОЕКТ ---
+def _random_text(rnd: random.Random, size: int) -> str:
+    words, length = [], 0
+    while length < size:
+        word = rnd.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def _write_pdf(path: Path, pages: int, rnd: random.Random):
+    """Минимальный валидный PDF: pages страниц латинского текста (стандартный шрифт Helvetica)."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        lines = [" ".join(rnd.choice(("lorem", "ipsum", "archive", "report", "letter", "expedition")) for _ in range(12))
+                 for _ in range(45)]
+        stream = "BT /F1 10 Tf 40 800 Td 14 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    path.write_bytes(bytes(out))
+
+
+def create_synthetic_project(root: Path, pdfs: int, pdf_pages: int, txts: int, txt_kb: int, seed: int) -> Path:
+    """Создает папку проекта с DB/ из сгенерированных PDF и TXT."""
+    rnd = random.Random(seed)
+    db = root / "DB"
+    db.mkdir(parents=True, exist_ok=True)
+    for i in range(1, pdfs + 1):
+        _write_pdf(db / f"source_{i}.pdf", pdf_pages, rnd)
+    for i in range(1, txts + 1):
+        (db / f"notes_{i}.txt").write_text(_random_text(rnd, txt_kb * 1024), encoding="utf-8")
+    return root
+
+
+# --- ЗАМЕРЫ ---
+def _peak_rss_mb() -> float:
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _counters(backend: FakeGeminiBackend) -> dict:
+    return {
+        "llm_calls": backend.stats["requests"],
+        "rate_limited": backend.stats["rate_limited"],
+        "llm_latency_seconds": backend.stats["latency_seconds"],
+        "bytes_uploaded": gemini_api.get_upload_cache_stats()["bytes_uploaded"],
+    }
+
+
+def run_stage(name: str, func, backend: FakeGeminiBackend) -> dict:
+    before = _counters(backend)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    status, tokens = func()
+    # Упавшие workflow возвращают status None или текст ошибки — в отчете всегда строка
+    status = str(status)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    after = _counters(backend)
+    result = {
+        "stage": name,
+        "status": status,
+        "wall_seconds": round(wall, 4),
+        "cpu_seconds": round(cpu, 4),
+        "peak_rss_mb": _peak_rss_mb(),
+        "tokens": tokens or 0,
+        **{key: after[key] - before[key] for key in before},
+    }
+    result["llm_latency_seconds"] = round(result["llm_latency_seconds"], 4)
+    print(f"{name:<14} {status:<10} wall {wall:8.3f}s  cpu {cpu:8.3f}s  calls {result['llm_calls']:4d}  "
+          f"tokens {result['tokens']:8d}", file=sys.stderr)
+    return result
+
+
+def run_pipeline(topic_path: str, model: str, num_series: int, use_async: bool, parallel_series: bool,
+                 backend: FakeGeminiBackend) -> list[dict]:
+    if use_async:
+        run = gemini_api.run_async
+        stages = [
+            ("expand", lambda: run(wrk.aexpand_database(topic_path, model))),
+            ("search_main", lambda: run(wrk.afind_connections_main(topic_path, model))),
+            ("search_blind", lambda: run(wrk.afind_connections_blind_spots(topic_path, model))),
+            ("check_main", lambda: run(wrk.acheck_hypotheses(topic_path, model, "main"))),
+            ("structure", lambda: run(wrk.abuild_script_structure(topic_path, num_series, model))),
+            ("scenario", lambda: run(wrk.awrite_script_text(topic_path, model, temperature=1.0,
+                                                            parallel_series=parallel_series))),
+        ]
+    else:
+        stages = [
+            ("expand", lambda: wrk.expand_database(topic_path, model)),
+            ("search_main", lambda: wrk.find_connections_main(topic_path, model)),
+            ("search_blind", lambda: wrk.find_connections_blind_spots(topic_path, model)),
+            ("check_main", lambda: wrk.check_hypotheses(topic_path, model, "main")),
+            ("structure", lambda: wrk.build_script_structure(topic_path, num_series, model)),
+            ("scenario", lambda: wrk.write_script_text(topic_path, model, temperature=1.0,
+                                                       parallel_series=parallel_series)),
+        ]
+    results = []
+    for name, func in stages:
+        result = run_stage(name, func, backend)
+        results.append(result)
+        if result["status"] != "success":
+            print(f"Этап {name} завершился с ошибкой, бенчмарк остановлен", file=sys.stderr)
+            break
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк пайплайна на заглушке LLM")
+    parser.add_argument("--pdfs", type=int, default=2, help="сколько PDF в DB")
+    parser.add_argument("--pdf-pages", type=int, default=10, help="страниц в каждом PDF")
+    parser.add_argument("--txts", type=int, default=2, help="сколько TXT в DB")
+    parser.add_argument("--txt-kb", type=int, default=50, help="размер каждого TXT, КБ")
+    parser.add_argument("--series", type=int, default=3, help="серий в структуре сценария")
+    parser.add_argument("--chapters", type=int, default=4, help="глав в каждой серии")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки, с")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--output-tokens", type=int, default=600, help="размер текстового ответа, токенов")
+    parser.add_argument("--model", default=gemini_api.MODEL_NAME)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="все этапы на асинхронном клиенте")
+    parser.add_argument("--parallel-series", action="store_true", help="писать серии параллельно")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="папка для синтетического проекта (по умолчанию временная)")
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    backend = gemini_api.set_backend(FakeGeminiBackend(
+        latency=args.latency, jitter=args.jitter, rate_limit_rate=args.rate_limit_rate,
+        output_tokens=args.output_tokens, chapters=args.chapters, seed=args.seed,
+    ))
+    topic_path = Path(args.workdir or tempfile.mkdtemp(prefix="bench_project_"))
+    create_synthetic_project(topic_path, args.pdfs, args.pdf_pages, args.txts, args.txt_kb, args.seed)
+    db_bytes = sum(f.stat().st_size for f in (topic_path / "DB").iterdir())
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    # Workflow местами печатают в stdout — уводим это в stderr, чтобы stdout оставался чистым JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        stages = run_pipeline(str(topic_path), args.model, args.series, args.use_async, args.parallel_series, backend)
+    report = {
+        "config": {**vars(args), "db_bytes": db_bytes, "project": str(topic_path)},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "stages": stages,
+        "total": {
+            "status": "success" if all(s["status"] == "success" for s in stages) else "error",
+            "wall_seconds": round(time.perf_counter() - wall_start, 4),
+            "cpu_seconds": round(time.process_time() - cpu_start, 4),
+            "peak_rss_mb": _peak_rss_mb(),
+            **{key: sum(s[key] for s in stages)
+               for key in ("tokens", "llm_calls", "rate_limited", "bytes_uploaded")},
+            "llm_latency_seconds": round(sum(s["llm_latency_seconds"] for s in stages), 4),
+        },
+    }
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(report_json, encoding="utf-8")
+    else:
+        print(report_json)
+    return 0 if report["total"]["status"] == "success" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,7 +5,10 @@ from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
 from db.db import get_db
 from db.models import User
+from db.cache import TTLCache
+from services import metrics
 import os
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from passlib.context import CryptContext
@@ -42,6 +45,38 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # Эндпоинт для получения токена
 
+# Кэши аутентификации: каждый запрос (в том числе каждый перезапуск Streamlit) проходит get_current_user.
+# Расшифрованный токен действителен до своего exp — подпись повторно не проверяем.
+# Пользователь кэшируется ненадолго: изменения из других процессов видны не позже чем через TTL,
+# изменения в этом процессе сбрасывают запись через invalidate_user(): смена пароля и отключение
+# учетной записи (/users/me/password, DELETE /users/me) идут через crud_auth.update_user.
+# Отключенные пользователи (is_active = False) не проходят и в кэш не попадают. Запись их токена
+# в _token_cache живет до exp, но дает только user_id: сброшенный пользователь читается из БД и отклоняется.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 1024))
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL_SECONDS", 60))
+_token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=24 * 3600)
+_user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL)
+
+
+def invalidate_user(user_id: int):
+    """Сбрасывает пользователя из кэша аутентификации (вызывать после изменения записи users)."""
+    _user_cache.pop(int(user_id))
+
+
+def _decode_token(token: str):
+    """user_id из JWT; расшифровка кэшируется по токену до его истечения. None — в токене нет sub."""
+    user_id = _token_cache.get(token)
+    if user_id is not None:
+        metrics.AUTH_CACHE.inc(cache="token", result="hit")
+        return user_id
+    metrics.AUTH_CACHE.inc(cache="token", result="miss")
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    user_id = payload.get("sub")
+    if user_id is not None and payload.get("exp"):
+        _token_cache.set(token, user_id, ttl=payload["exp"] - time.time())
+    return user_id
+
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -49,8 +84,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
+        user_id = _decode_token(token)
         if user_id is None:
             logger.warning(f"Невалидный user_id в токене: {user_id}")
             raise credentials_exception
@@ -60,13 +94,31 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     
     # Обработка DB-запроса с логами и обработкой ошибок
     try:
+        cached = _user_cache.get(int(user_id))
+        if cached is not None:
+            metrics.AUTH_CACHE.inc(cache="user", result="hit")
+            # merge(load=False) привязывает копию к сессии запроса без SELECT
+            user = db.merge(cached, load=False)
+            logger.debug(f"Пользователь {user_id} взят из кэша аутентификации")
+            return user
+        metrics.AUTH_CACHE.inc(cache="user", result="miss")
+
         logger.debug(f"Поиск пользователя по ID: {user_id}")
         user = db.query(User).filter(User.user_id == user_id).first()
         if user is None:
             logger.warning(f"Пользователь не найден по ID: {user_id}")
             raise credentials_exception
+        if user.is_active is False:
+            logger.warning(f"Отклонен токен отключенного пользователя: {user_id}")
+            raise credentials_exception
+        # В кэш кладем отсоединенный экземпляр, а запросу отдаем его копию в текущей сессии
+        db.expunge(user)
+        _user_cache.set(int(user_id), user)
+        user = db.merge(user, load=False)
         logger.info(f"Успешная аутентификация пользователя: {user.username}")  # Аудит
         return user  # Возвращает объект User, если аутентификация успешна
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         logger.error(f"DB ошибка при поиске пользователя {user_id}: {e}")
         db.rollback()  # Откат при ошибке
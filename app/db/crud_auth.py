@@ -1,7 +1,7 @@
 from sqlalchemy.orm import Session
 from db.models import User
 from db.schemas import UserCreate
-from db.auth_security import get_password_hash
+from db.auth_security import get_password_hash, invalidate_user
 
 
 def get_user_by_username(db: Session, username: str):
@@ -24,13 +24,17 @@ def create_user(db: Session, user: UserCreate):
     db.refresh(db_user)
     return db_user
 
+def update_user(db: Session, user_id: int, **fields):
+    """Изменить поля пользователя (is_active, hashed_password, ...) и сбросить его из кэша аутентификации."""
+    db_user = get_user_by_id(db, user_id)
+    if db_user is None:
+        return None
+    for key, value in fields.items():
+        setattr(db_user, key, value)
+    db.commit()
+    invalidate_user(user_id)
+    return db_user
 
-
-
-
-
-
-
-
-
-
+def set_user_active(db: Session, user_id: int, is_active: bool):
+    """Включить или отключить пользователя: отключенный теряет доступ сразу, не дожидаясь TTL кэша."""
+    return update_user(db, user_id, is_active=is_active)
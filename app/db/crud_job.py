@@ -0,0 +1,138 @@
+import uuid
+import logging
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy.orm import Session
+from db.models import WorkflowJob
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+def create_job(db: Session, project_id: int, user_id: int, workflow: str, params: dict,
+               idempotency_key: Optional[str] = None) -> WorkflowJob:
+    """Создает запись о фоновой задаче в статусе queued."""
+    try:
+        job = WorkflowJob(
+            job_id=str(uuid.uuid4()),
+            project_id=project_id,
+            user_id=user_id,
+            workflow=workflow,
+            params=params,
+            idempotency_key=idempotency_key,
+            status="queued",
+            progress={},
+            tokens=0,
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        logger.info(f"Задача {job.job_id} ({workflow}) создана для проекта {project_id} пользователем {user_id}")
+        return job
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка создания задачи {workflow} для проекта {project_id}: {e}")
+        raise
+
+
+def get_job(db: Session, job_id: str) -> Optional[WorkflowJob]:
+    """Находит задачу по ID. Возвращает WorkflowJob или None."""
+    try:
+        return db.query(WorkflowJob).filter(WorkflowJob.job_id == job_id).first()
+    except Exception as e:
+        logger.error(f"Ошибка при поиске задачи {job_id}: {e}")
+        raise
+
+
+def get_project_jobs(db: Session, project_id: int, limit: int = 20) -> List[WorkflowJob]:
+    """Возвращает последние задачи проекта (сначала новые)."""
+    try:
+        return (
+            db.query(WorkflowJob)
+            .filter(WorkflowJob.project_id == project_id)
+            .order_by(WorkflowJob.created_at.desc())
+            .limit(limit)
+            .all()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения задач проекта {project_id}: {e}")
+        raise
+
+
+def get_active_project_jobs(db: Session, project_id: int) -> List[WorkflowJob]:
+    """Возвращает задачи проекта в статусах queued/running."""
+    try:
+        return (
+            db.query(WorkflowJob)
+            .filter(WorkflowJob.project_id == project_id, WorkflowJob.status.in_(ACTIVE_JOB_STATUSES))
+            .all()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения активных задач проекта {project_id}: {e}")
+        raise
+
+
+def find_job_by_idempotency_key(db: Session, project_id: int, idempotency_key: str,
+                                statuses: tuple, since: datetime) -> Optional[WorkflowJob]:
+    """Последняя задача проекта с этим ключом идемпотентности, созданная после since, в одном из statuses."""
+    try:
+        return (
+            db.query(WorkflowJob)
+            .filter(
+                WorkflowJob.project_id == project_id,
+                WorkflowJob.idempotency_key == idempotency_key,
+                WorkflowJob.status.in_(statuses),
+                WorkflowJob.created_at >= since,
+            )
+            .order_by(WorkflowJob.created_at.desc())
+            .first()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка поиска задачи по ключу идемпотентности для проекта {project_id}: {e}")
+        raise
+
+
+def update_job(db: Session, job_id: str, **fields) -> Optional[WorkflowJob]:
+    """Обновляет поля задачи (status, stage, progress, tokens, result, error, started_at, finished_at)."""
+    try:
+        job = db.query(WorkflowJob).filter(WorkflowJob.job_id == job_id).first()
+        if not job:
+            logger.warning(f"Задача {job_id} не найдена для обновления")
+            return None
+        for key, value in fields.items():
+            setattr(job, key, value)
+        db.commit()
+        return job
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка обновления задачи {job_id}: {e}")
+        raise
+
+
+def mark_orphaned_jobs(db: Session) -> int:
+    """
+    Помечает как orphaned все задачи, оставшиеся в queued/running.
+    Вызывается при старте сервера: исполнитель этих задач погиб вместе с прошлым процессом.
+    """
+    try:
+        count = (
+            db.query(WorkflowJob)
+            .filter(WorkflowJob.status.in_(ACTIVE_JOB_STATUSES))
+            .update(
+                {
+                    WorkflowJob.status: "orphaned",
+                    WorkflowJob.error: "Сервер был перезапущен во время выполнения задачи",
+                    WorkflowJob.finished_at: datetime.utcnow(),
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        if count:
+            logger.warning(f"Помечено осиротевших задач после перезапуска: {count}")
+        return count
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка пометки осиротевших задач: {e}")
+        raise
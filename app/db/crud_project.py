@@ -3,6 +3,9 @@ import shutil
 from typing import Literal, Optional, List, Dict
 from db.schemas import ProjectInitialization, ProjectResponseWithAccess
 from db.models import Project, ProjectAccess
+from db.cache import TTLCache
+from services import metrics
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
 from pathlib import Path
 from fastapi import UploadFile
@@ -13,6 +16,21 @@ logger = logging.getLogger(__name__)
 PROJECTS_ROOT_DIR = "projects_root"
 PermissionLevel = Literal['READ', 'WRITE', 'ADMIN']
 
+# Кэш уровней доступа (project_id, user_id) -> уровень: get_access_level вызывается в каждом защищенном
+# эндпоинте. Сбрасывается при выдаче доступа и удалении проекта; изменения из других процессов видны
+# не позже чем через TTL.
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL_SECONDS", 30))
+_access_cache = TTLCache(maxsize=int(os.getenv("ACCESS_CACHE_SIZE", 4096)), ttl=ACCESS_CACHE_TTL)
+_NO_ACCESS = "NONE"  # Отсутствие доступа тоже кэшируем, чтобы чужие запросы не ходили в БД
+
+
+def invalidate_project_access(project_id: int, user_id: Optional[int] = None):
+    """Сбрасывает кэш доступа к проекту: для одного пользователя или для всех."""
+    if user_id is not None:
+        _access_cache.pop((project_id, user_id))
+    else:
+        _access_cache.discard_where(lambda key: key[0] == project_id)
+
 def get_project_by_id(db: Session, project_id: int) -> Optional[Project]:
     """
     Находит проект в базе данных по его уникальному ID.
@@ -72,6 +90,7 @@ def create_user_project(db: Session, project_data: ProjectInitialization, owner_
         )
         db.add(db_access)
         db.commit()
+        invalidate_project_access(db_project.project_id)
         
         logger.info(f"Проект {db_project.project_id} создан для владельца {owner_id}")
         return db_project
@@ -122,6 +141,7 @@ def delete_project(db: Session, project_id: int):
             # 3. Удаление самого проекта
             db.delete(db_project)
             db.commit()
+            invalidate_project_access(project_id)
             logger.info(f"Проект {project_id} удален")
             return True
         else:
@@ -155,6 +175,7 @@ def add_project_access(
             db_access.permission_level = level
             db.commit()
             db.refresh(db_access)
+            invalidate_project_access(project_id, user_id)
             logger.info(f"Доступ обновлен для пользователя {user_id} к проекту {project_id}: {level}")
             return {"action": "updated", "level": level}
         else:
@@ -167,6 +188,7 @@ def add_project_access(
             db.add(new_access)
             db.commit()
             db.refresh(new_access)
+            invalidate_project_access(project_id, user_id)
             logger.info(f"Доступ создан для пользователя {user_id} к проекту {project_id}: {level}")
             return {"action": "created", "level": level}
     except Exception as e:
@@ -179,33 +201,39 @@ def get_access_level(db: Session, project_id: int, user_id: int) -> Optional[str
     """
     Возвращает строковое значение уровня доступа ('READ', 'WRITE', 'ADMIN') 
     или None, если доступ не найден.
+    Владелец и запись о доступе проверяются одним запросом (проект LEFT JOIN доступ пользователя),
+    результат кэшируется на ACCESS_CACHE_TTL секунд.
     """
+    cached = _access_cache.get((project_id, user_id))
+    if cached is not None:
+        metrics.AUTH_CACHE.inc(cache="access", result="hit")
+        return None if cached == _NO_ACCESS else cached
+    metrics.AUTH_CACHE.inc(cache="access", result="miss")
     try:
-        # 1. Проверяем, является ли пользователь владельцем (Владелец всегда имеет ADMIN)
-        project = db.query(Project).filter(Project.project_id == project_id).first()
-        
-        if project and project.owner_id == user_id:
-            # Владелец проекта автоматически имеет наивысшие права
-            logger.debug(f"Пользователь {user_id} — владелец проекта {project_id}, доступ: ADMIN")
-            return "ADMIN" # Можно использовать "ADMIN", если это определено в вашей логике
-
-        # 2. Если не владелец, ищем запись в таблице прав доступа
-        access_record = db.query(ProjectAccess).filter(
-            ProjectAccess.project_id == project_id,
-            ProjectAccess.user_id == user_id
-        ).first()
-
-        if access_record:
-            logger.debug(f"Доступ пользователя {user_id} к проекту {project_id}: {access_record.permission_level}")
-            return access_record.permission_level
-        
-        # Если не владелец и нет записи о доступе
-        logger.debug(f"Нет доступа для {user_id} к {project_id}")
-        return None
+        row = (
+            db.query(Project.owner_id, ProjectAccess.permission_level)
+            .outerjoin(ProjectAccess, and_(ProjectAccess.project_id == Project.project_id,
+                                           ProjectAccess.user_id == user_id))
+            .filter(Project.project_id == project_id)
+            .first()
+        )
     except Exception as e:
         logger.error(f"Ошибка проверки доступа {user_id} к {project_id}: {e}")
         raise
 
+    if row is None:
+        level = None
+        logger.debug(f"Проект {project_id} не найден, нет доступа для {user_id}")
+    elif row.owner_id == user_id:
+        # Владелец проекта автоматически имеет наивысшие права
+        level = "ADMIN"
+        logger.debug(f"Пользователь {user_id} — владелец проекта {project_id}, доступ: ADMIN")
+    else:
+        level = row.permission_level
+        logger.debug(f"Доступ пользователя {user_id} к проекту {project_id}: {level}")
+    _access_cache.set((project_id, user_id), level or _NO_ACCESS)
+    return level
+
 
 async def save_reports_to_project(
     folder_path: str,
@@ -266,6 +294,7 @@ def delete_project_data(db: Session, project_id: int):
     
     db.delete(project)
     db.commit()
+    invalidate_project_access(project_id)
     logger.info(f"Проект {project_id} удален из БД.")
     
     return project.topic_name, folder_path
\ No newline at end of file
@@ -1,44 +1,102 @@
 import logging
-from requests import Session
-from db.models import User
-from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from db.models import User, TokenUsage
+from datetime import date
+from typing import Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# Модель и этап для расхода, перенесенного из users.token_usage (там их не записывали)
+LEGACY_USAGE_LABEL = "legacy"
+LEGACY_BACKFILL_BATCH = 1000
 
-# --- ФУНКЦИЯ ДЛЯ ОБНОВЛЕНИЯ ТОКЕНОВ (добавьте в отдельный crud_user.py или utils.py) ---
-def update_user_token_usage(db: Session, user_id: int, tokens: int):
+
+# --- УЧЕТ ТОКЕНОВ ---
+def add_token_usage(db: Session, rows: List[Dict]):
+    """
+    Прибавляет расход пачкой строк {"user_id", "day", "model", "stage", "tokens"} одним
+    атомарным INSERT ... ON CONFLICT DO UPDATE: параллельные списания не теряются
+    и не блокируют строку users. Ключи строк в пачке должны быть уникальны.
+    """
+    if not rows:
+        return
+    try:
+        statement = insert(TokenUsage).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[TokenUsage.user_id, TokenUsage.day, TokenUsage.model, TokenUsage.stage],
+            set_={"tokens": TokenUsage.tokens + statement.excluded.tokens},
+        )
+        db.execute(statement)
+        db.commit()
+        logger.info(f"Расход токенов записан: {len(rows)} строк, {sum(row['tokens'] for row in rows)} токенов")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка записи расхода токенов ({len(rows)} строк): {e}")
+        raise
+
+
+def backfill_legacy_token_usage(db: Session) -> int:
     """
-    Обновляет использование токенов для пользователя за текущий месяц.
-    Проверяет последнюю дату в token_usage: если текущий месяц != последнему ключу,
-    добавляет новую запись. Иначе суммирует к существующей.
+    Переносит старую историю users.token_usage ({"YYYY-MM-DD": tokens}) в token_usage
+    строками с model и stage = LEGACY_USAGE_LABEL. Идемпотентно (ON CONFLICT DO NOTHING):
+    повторный запуск, в том числе из нескольких процессов сразу, ничего не удваивает.
+    Возвращает число перенесенных строк.
     """
     try:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            logger.error(f"Пользователь {user_id} не найден для обновления токенов")
-            raise ValueError(f"Пользователь {user_id} не найден")
-        
-        token_usage = user.token_usage or {}
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        # Получаем последний день из ключей (сортируем по дате)
-        if token_usage:
-            last_date = max(token_usage.keys())  # max по строке YYYY-MM-DD работает как дата
-            # Если текущий день != последний, добавляем новую (день "истёк")
-            if current_date != last_date:
-                token_usage[current_date] = tokens
-            else:
-                token_usage[current_date] += tokens
-        else:
-            # Первый раз — новая запись
-            token_usage[current_date] = tokens
-        
-        user.token_usage = token_usage
+        rows = []
+        for user_id, history in db.query(User.user_id, User.token_usage).all():
+            for day, tokens in (history or {}).items():
+                try:
+                    rows.append({"user_id": user_id, "day": date.fromisoformat(day), "model": LEGACY_USAGE_LABEL,
+                                 "stage": LEGACY_USAGE_LABEL, "tokens": int(tokens)})
+                except (TypeError, ValueError):
+                    logger.warning(f"Пропущена запись старого расхода пользователя {user_id}: {day}={tokens!r}")
+        inserted = 0
+        for start in range(0, len(rows), LEGACY_BACKFILL_BATCH):
+            statement = insert(TokenUsage).values(rows[start:start + LEGACY_BACKFILL_BATCH]).on_conflict_do_nothing(
+                index_elements=[TokenUsage.user_id, TokenUsage.day, TokenUsage.model, TokenUsage.stage])
+            inserted += db.execute(statement).rowcount
         db.commit()
-        logger.info(f"Токены обновлены для {user_id}: +{tokens} за {current_date}. Итого: {token_usage[current_date]}")
-        return user.token_usage
+        if inserted:
+            logger.info(f"Старый расход токенов перенесен в token_usage: {inserted} строк")
+        return inserted
     except Exception as e:
         db.rollback()
-        logger.error(f"Ошибка обновления токенов для {user_id}: {e}")
-        raise
\ No newline at end of file
+        logger.error(f"Ошибка переноса старого расхода токенов: {e}")
+        raise
+
+
+def get_user_monthly_token_usage(db: Session, user_id: int) -> Dict[str, int]:
+    """Расход токенов пользователя по месяцам: {"YYYY-MM": tokens, ...}."""
+    try:
+        month = func.to_char(TokenUsage.day, "YYYY-MM")
+        rows = (
+            db.query(month.label("month"), func.sum(TokenUsage.tokens).label("tokens"))
+            .filter(TokenUsage.user_id == user_id)
+            .group_by(month)
+            .order_by(month)
+            .all()
+        )
+        return {row.month: int(row.tokens) for row in rows}
+    except Exception as e:
+        logger.error(f"Ошибка получения расхода токенов для {user_id}: {e}")
+        raise
+
+
+def get_user_token_usage_breakdown(db: Session, user_id: int, month: Optional[str] = None) -> List[Dict]:
+    """Расход за месяц (YYYY-MM, по умолчанию текущий) в разрезе модели и этапа."""
+    try:
+        month = month or date.today().strftime("%Y-%m")
+        rows = (
+            db.query(TokenUsage.model, TokenUsage.stage, func.sum(TokenUsage.tokens).label("tokens"))
+            .filter(TokenUsage.user_id == user_id, func.to_char(TokenUsage.day, "YYYY-MM") == month)
+            .group_by(TokenUsage.model, TokenUsage.stage)
+            .order_by(func.sum(TokenUsage.tokens).desc())
+            .all()
+        )
+        return [{"model": row.model, "stage": row.stage, "tokens": int(row.tokens)} for row in rows]
+    except Exception as e:
+        logger.error(f"Ошибка получения разбивки токенов для {user_id} за {month}: {e}")
+        raise
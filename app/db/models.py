@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Table, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Date, DateTime, ForeignKey, Table, Boolean
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from . db import Base
 from datetime import datetime
@@ -18,8 +18,9 @@ class User(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=True)
-    # Новое поле: словарь использования токенов по месяцам (JSONB для PostgreSQL)
-    # Формат: {"YYYY-MM": tokens, ...}, обновляется ежемесячно
+    # Устаревшее: словарь использования токенов по дням {"YYYY-MM-DD": tokens, ...}.
+    # Больше не пополняется — расход пишется в таблицу token_usage (TokenUsage); при старте
+    # сервера история отсюда переносится туда (crud_user.backfill_legacy_token_usage)
     token_usage = Column(JSONB, default=dict, nullable=False)
 
     # Отношение: один пользователь может владеть многими проектами
@@ -63,4 +64,46 @@ class ProjectAccess(Base):
 
     # Отношения
     project = relationship("Project", back_populates="accessors")
-    user = relationship("User", back_populates="access_rights")
\ No newline at end of file
+    user = relationship("User", back_populates="access_rights")
+
+
+# --- 4. Таблица фоновых задач (Workflow Jobs) ---
+# Статусы задачи: queued -> running -> done | failed | cancelled.
+# orphaned — задача была в работе, когда сервер перезапустился.
+JobStatus = Literal['queued', 'running', 'done', 'failed', 'cancelled', 'orphaned']
+
+class WorkflowJob(Base):
+    __tablename__ = 'workflow_jobs'
+
+    job_id = Column(String, primary_key=True)  # uuid4
+    project_id = Column(Integer, ForeignKey('projects.project_id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False, index=True)
+    workflow = Column(String, nullable=False)  # expand, search, check, structure, scenario
+    params = Column(JSONB, default=dict, nullable=False)
+    # Ключ идемпотентности: повторный такой же запрос возвращает эту задачу вместо нового запуска
+    idempotency_key = Column(String, nullable=True, index=True)
+
+    status = Column(String, default='queued', nullable=False, index=True)
+    stage = Column(String, nullable=True)
+    # Последнее событие прогресса: {"event": "lens_done", "lens": 2, "total": 5, ...}
+    progress = Column(JSONB, default=dict, nullable=False)
+    tokens = Column(Integer, default=0, nullable=False)
+    result = Column(JSONB, nullable=True)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+# --- 5. Учет расхода токенов (Token Usage) ---
+# Одна строка на пользователя, день, модель и этап; списание — атомарный
+# INSERT ... ON CONFLICT DO UPDATE tokens = tokens + excluded.tokens (см. crud_user)
+class TokenUsage(Base):
+    __tablename__ = 'token_usage'
+
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    model = Column(String, primary_key=True)
+    stage = Column(String, primary_key=True)  # Workflow или этап пайплайна
+    tokens = Column(BigInteger, default=0, nullable=False)
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from typing import List, Optional, Dict
+from datetime import datetime
 
 #----------------DB-----------------------
 # --- ВХОДНЫЕ МОДЕЛИ (для запросов) ---
@@ -12,6 +13,10 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
+class PasswordChange(BaseModel):
+    current_password: str
+    new_password: str
+
 class ProjectShare(BaseModel):
     project_id: int
     target_username: str
@@ -40,6 +45,8 @@ class UserTokenUsage(BaseModel):
     """Схема для возврата использования токенов."""
     user_id: int
     token_usage: Dict[str, int]  # {"YYYY-MM": tokens, ...}
+    month: str  # Месяц, за который дана разбивка
+    breakdown: List[Dict] = []  # [{"model": ..., "stage": ..., "tokens": ...}, ...]
 
 class UpdateTokensRequest(BaseModel):
     """Схема для запроса обновления токенов."""
@@ -55,15 +62,32 @@ class ProjectInitialization(BaseModel):
 class WorkflowSchema(BaseModel):
     folder_path: str
     llm_model: str = "gemini-2.5-flash"
+    force: bool = False  # Запустить, даже если входы этапа не менялись с прошлого запуска (см. manifest.json)
 
 class WorkflowFactsSearchSchema(WorkflowSchema):
     search_type: str
+    max_workers: Optional[int] = None  # Параллельность линз blind spots (None — значение по умолчанию)
 
 class ScenarioStructureSchema(WorkflowSchema):
     num_series: int
 
 class ScenarioSchema(WorkflowSchema):
     temperature: float
+    resume: bool = False  # Продолжить с первой ненаписанной главы (по чекпоинтам)
+    parallel_series: bool = False  # Писать серии параллельно (мост между сериями — по описанию главы)
+    max_workers: Optional[int] = None  # Сколько серий одновременно (None — значение по умолчанию)
+
+class ScenarioPartSchema(WorkflowSchema):
+    """Параметры перегенерации одной главы или серии (id — из script_structure.json)."""
+    temperature: float = 1.0
+
+class PipelineSchema(WorkflowSchema):
+    """Параметры прогона всех этапов (от отчетов в DB до .docx) одной задачей."""
+    num_series: int
+    temperature: float = 1.0
+    parallel_series: bool = False
+    max_workers: Optional[int] = None  # Параллельность линз blind spots и серий
+    max_stages: Optional[int] = None  # Сколько этапов одновременно (None — PIPELINE_CONCURRENCY)
 
 
 class FileFolder(BaseModel):
@@ -76,6 +100,26 @@ class FileUpdate(BaseModel):
     content: str
 
 # --- ВЫХОДНЫЕ МОДЕЛИ (для ответов) ---
+class WorkflowJobResponse(BaseModel):
+    """Схема для возврата состояния фоновой задачи workflow."""
+    job_id: str
+    project_id: int
+    user_id: int
+    workflow: str
+    status: str
+    stage: Optional[str] = None
+    progress: Dict = {}
+    tokens: int = 0
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    queue_position: Optional[int] = None  # Для задач в очереди допуска: сколько задач впереди, включая эту
+
+    class Config:
+        from_attributes = True
+
 class FileContent(BaseModel):
     """Схема для отправки контента файла клиенту."""
     file_name: str
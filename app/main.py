@@ -1,11 +1,18 @@
 import logging
 from pathlib import Path
 import sys
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, JSONResponse
 import uvicorn
-from db.db import Base, engine
+from db.db import Base, engine, pool_status, SessionLocal
+from db.crud_user import backfill_legacy_token_usage
+from sqlalchemy import text
 from api import disk_routes, llm_routes, auth_routes, db_routes, files_routes
 from dotenv import load_dotenv
+from services.jobs import recover_orphaned_jobs
+from services import metrics
+from services import usage_buffer
+import time
 
 LOG_DIR = Path("logs")
 LOG_DIR.mkdir(exist_ok=True)
@@ -77,6 +84,23 @@ load_dotenv()
 
 app = FastAPI()
 Base.metadata.create_all(bind=engine)
+# Старая история расхода из users.token_usage — в таблицу token_usage (повторный запуск ничего не удваивает)
+with SessionLocal() as db:
+    backfill_legacy_token_usage(db)
+metrics.instrument_engine(engine)
+# Задачи, которые выполнялись до перезапуска, помечаем как orphaned
+recover_orphaned_jobs()
+
+
+@app.on_event("startup")
+def start_usage_buffer():
+    # Досписываем расход токенов из журнала, если прошлый процесс упал до записи в БД
+    usage_buffer.start()
+
+
+@app.on_event("shutdown")
+def flush_usage_buffer():
+    usage_buffer.stop()
 
 app.include_router(auth_routes.router_auth)
 app.include_router(db_routes.router_db)
@@ -87,6 +111,44 @@ app.include_router(files_routes.router_files)
 logger = logging.getLogger(__name__)
 logger.info("FastAPI app started with production logging")
 
+@app.middleware("http")
+async def measure_requests(request: Request, call_next):
+    """Длительность запросов по шаблону маршрута (/workflow/{project_id}/...), а не по реальному пути."""
+    started = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                                             route=getattr(route, "path", "unmatched"), status=status_code)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Метрики процесса в формате Prometheus."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/health/db", include_in_schema=False)
+def db_health():
+    """Пинг БД и загрузка пула соединений (для подбора DB_POOL_SIZE / DB_MAX_OVERFLOW под реальную нагрузку)."""
+    started = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except Exception as e:
+        # Текст исключения (хост, DSN, драйвер) — только в лог: эндпоинт без аутентификации
+        logger.error(f"Проверка БД не прошла: {e}", exc_info=True)
+        return JSONResponse(status_code=503, content={"status": "error", "error": "Database unavailable",
+                                                      "pool": pool_status()})
+    return {"status": "ok", "ping_ms": round((time.perf_counter() - started) * 1000, 1), "pool": pool_status()}
+
+
 #test route
 @app.get("/")
 def read_root():
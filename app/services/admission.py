@@ -0,0 +1,154 @@
+import os
+import logging
+import threading
+from collections import deque, Counter
+from dataclasses import dataclass
+from typing import Callable
+from concurrent.futures import Executor
+
+logger = logging.getLogger(__name__)
+
+# Лимиты одновременных workflow. Глобальный лимит — число потоков исполнителя (WORKFLOW_WORKERS в jobs.py)
+WORKFLOW_MAX_PER_USER = int(os.environ.get("WORKFLOW_MAX_PER_USER", 2))
+WORKFLOW_MAX_PER_PROJECT = int(os.environ.get("WORKFLOW_MAX_PER_PROJECT", 2))
+# Сколько задач может ждать в очереди: сверх этого новые запуски отклоняются сразу
+WORKFLOW_MAX_QUEUED_PER_USER = int(os.environ.get("WORKFLOW_MAX_QUEUED_PER_USER", 10))
+WORKFLOW_MAX_QUEUED = int(os.environ.get("WORKFLOW_MAX_QUEUED", 200))
+
+
+class WorkflowQuotaExceeded(Exception):
+    """Очередь пользователя (или общая) переполнена — запуск отклонен."""
+
+
+@dataclass
+class Ticket:
+    job_id: str
+    user_id: int
+    project_id: int
+    run: Callable[[], None]
+
+
+class AdmissionController:
+    """
+    Допуск workflow к исполнителю: не больше max_running задач всего, per_user на пользователя
+    и per_project на проект. Остальные ждут в очередях пользователей, которые обходятся по кругу —
+    пользователь с десятью задачами не задерживает того, кто запустил одну.
+    """
+
+    def __init__(self, executor: Executor, max_running: int, per_user: int = WORKFLOW_MAX_PER_USER,
+                 per_project: int = WORKFLOW_MAX_PER_PROJECT, max_queued_per_user: int = WORKFLOW_MAX_QUEUED_PER_USER,
+                 max_queued: int = WORKFLOW_MAX_QUEUED):
+        self.executor = executor
+        self.max_running = max_running
+        self.per_user = per_user
+        self.per_project = per_project
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._queues: dict[int, deque[Ticket]] = {}
+        self._turn: deque[int] = deque()  # Порядок обхода пользователей с непустой очередью
+        self._running_users: Counter = Counter()
+        self._running_projects: Counter = Counter()
+        self._running = 0
+
+    def check(self, user_id: int):
+        """Бросает WorkflowQuotaExceeded, если новую задачу пользователя уже некуда ставить."""
+        with self._lock:
+            queued = sum(len(q) for q in self._queues.values())
+            if queued >= self.max_queued:
+                raise WorkflowQuotaExceeded(f"Очередь workflow переполнена ({queued} задач), попробуйте позже")
+            user_queued = len(self._queues.get(user_id, ()))
+            if user_queued >= self.max_queued_per_user:
+                raise WorkflowQuotaExceeded(
+                    f"У пользователя уже {user_queued} задач в очереди (лимит {self.max_queued_per_user})")
+
+    def submit(self, ticket: Ticket) -> int:
+        """Ставит задачу в очередь пользователя и запускает все, что можно. Возвращает позицию (0 — запущена)."""
+        with self._lock:
+            if ticket.user_id not in self._queues:
+                self._queues[ticket.user_id] = deque()
+                self._turn.append(ticket.user_id)
+            self._queues[ticket.user_id].append(ticket)
+            self._dispatch()
+            return self._position(ticket.job_id)
+
+    def remove(self, job_id: str) -> Ticket | None:
+        """Убирает еще не запущенную задачу из очереди. None — задачи в очереди нет (уже идет или завершена)."""
+        with self._lock:
+            for user_id, queue in self._queues.items():
+                for ticket in queue:
+                    if ticket.job_id == job_id:
+                        queue.remove(ticket)
+                        self._drop_empty(user_id)
+                        return ticket
+        return None
+
+    def position(self, job_id: str) -> int:
+        with self._lock:
+            return self._position(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "running_by_user": dict(self._running_users),
+                "queued_by_user": {user_id: len(q) for user_id, q in self._queues.items()},
+            }
+
+    # --- ВНУТРЕННЕЕ (вызывается под self._lock) ---
+    def _position(self, job_id: str) -> int:
+        """Примерная позиция в общей очереди с учетом обхода по кругу (1 — следующая)."""
+        rounds = [list(self._queues[user_id]) for user_id in self._turn]
+        position = 0
+        for depth in range(max((len(r) for r in rounds), default=0)):
+            for tickets in rounds:
+                if depth < len(tickets):
+                    position += 1
+                    if tickets[depth].job_id == job_id:
+                        return position
+        return 0
+
+    def _drop_empty(self, user_id: int):
+        if not self._queues.get(user_id):
+            self._queues.pop(user_id, None)
+            if user_id in self._turn:
+                self._turn.remove(user_id)
+
+    def _next_ticket(self) -> Ticket | None:
+        """Первая задача, которую можно запустить: пользователи по кругу, внутри пользователя — FIFO."""
+        for _ in range(len(self._turn)):
+            user_id = self._turn[0]
+            self._turn.rotate(-1)  # Кто бы ни получил слот, следующим рассматривается другой пользователь
+            if self._running_users[user_id] >= self.per_user:
+                continue
+            queue = self._queues[user_id]
+            for ticket in queue:
+                if self._running_projects[ticket.project_id] < self.per_project:
+                    queue.remove(ticket)
+                    self._drop_empty(user_id)
+                    return ticket
+        return None
+
+    def _dispatch(self):
+        while self._running < self.max_running:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            self._running += 1
+            self._running_users[ticket.user_id] += 1
+            self._running_projects[ticket.project_id] += 1
+            logger.info(f"Задача {ticket.job_id} допущена к запуску (выполняется {self._running}/{self.max_running})")
+            self.executor.submit(self._execute, ticket)
+
+    def _execute(self, ticket: Ticket):
+        try:
+            ticket.run()
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._running_users[ticket.user_id] -= 1
+                self._running_projects[ticket.project_id] -= 1
+                self._running_users += Counter()  # Выбрасываем нулевые счетчики
+                self._running_projects += Counter()
+                self._dispatch()
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Сколько событий может накопиться у одного подписчика, пока он их не прочитал
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+_lock = threading.Lock()
+# Очередь подписчика живет в цикле событий его SSE-запроса: project_id -> {очередь: ее цикл}
+_subscribers: dict[int, dict[asyncio.Queue, asyncio.AbstractEventLoop]] = defaultdict(dict)
+
+
+def subscribe(project_id: int) -> asyncio.Queue:
+    """
+    Подписывает на события проекта. Вызывается из корутины: возвращает asyncio.Queue,
+    которую можно ждать через await без опроса и без потока на подписчика.
+    """
+    q = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        _subscribers[project_id][q] = loop
+    logger.debug(f"Новый подписчик на события проекта {project_id}")
+    return q
+
+
+def unsubscribe(project_id: int, q: asyncio.Queue):
+    with _lock:
+        _subscribers[project_id].pop(q, None)
+        if not _subscribers[project_id]:
+            del _subscribers[project_id]
+    logger.debug(f"Подписчик отключился от событий проекта {project_id}")
+
+
+def _put(q: asyncio.Queue, event: dict):
+    # Медленный подписчик теряет самые старые события
+    if q.full():
+        q.get_nowait()
+    q.put_nowait(event)
+
+
+def publish(project_id: int, event: dict):
+    """
+    Рассылает событие всем подписчикам проекта. Вызывается из потоков задач:
+    событие передается в цикл подписчика через call_soon_threadsafe.
+    """
+    with _lock:
+        targets = list(_subscribers.get(project_id, {}).items())
+    for q, loop in targets:
+        try:
+            loop.call_soon_threadsafe(_put, q, event)
+        except RuntimeError:
+            # Цикл подписчика уже закрыт — он отпишется сам в finally своего стрима
+            pass
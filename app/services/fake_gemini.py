@@ -0,0 +1,327 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import typing
+from datetime import datetime, timedelta, timezone
+
+from google.genai import errors, types
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Настройки локальной заглушки Gemini (LLM_BACKEND=fake)
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", 0.5))          # средняя задержка ответа, с
+FAKE_LLM_JITTER = float(os.environ.get("FAKE_LLM_JITTER", 0.1))            # разброс задержки, с
+FAKE_LLM_429_RATE = float(os.environ.get("FAKE_LLM_429_RATE", 0))          # доля запросов, отвечающих 429
+FAKE_LLM_RETRY_DELAY = int(os.environ.get("FAKE_LLM_RETRY_DELAY", 1))      # retryDelay в ответе 429, с
+FAKE_LLM_OUTPUT_TOKENS = int(os.environ.get("FAKE_LLM_OUTPUT_TOKENS", 600)) # размер текстового ответа
+FAKE_LLM_BLOCKS = int(os.environ.get("FAKE_LLM_BLOCKS", 5))                # гипотез/проверок/паттернов в ответе
+FAKE_LLM_CHAPTERS = int(os.environ.get("FAKE_LLM_CHAPTERS", 4))            # глав в серии структуры
+FAKE_LLM_STREAM_CHUNKS = int(os.environ.get("FAKE_LLM_STREAM_CHUNKS", 8))  # на сколько чанков делится поток
+FAKE_LLM_SEED = int(os.environ.get("FAKE_LLM_SEED", 42))
+
+_WORDS = ("архив", "письмо", "экспедиция", "совет", "завод", "инженер", "свидетель", "карта", "донесение",
+          "министерство", "фотография", "дневник", "граница", "протокол", "станция", "комиссия")
+
+
+def _seed_of(*parts) -> int:
+    return int(hashlib.sha256("|".join(map(str, parts)).encode("utf-8")).hexdigest()[:12], 16)
+
+
+def _filler(seed: int, tokens: int) -> str:
+    """Детерминированный "текст" примерно на tokens токенов (~4 символа на токен)."""
+    rnd = random.Random(seed)
+    words, length = [], 0
+    while length < tokens * 4:
+        word = rnd.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).capitalize() + "."
+
+
+class FakeGeminiBackend:
+    """
+    Детерминированная замена genai.Client для прогонов пайплайна без Gemini API.
+    Повторяет ту часть интерфейса клиента, которой пользуется services.gemini_api
+    (models, files, caches и их async-варианты в aio), и по тегам в промпте
+    возвращает ответы в нужном формате: блоки гипотез/проверок, структуру сценария, текст глав.
+    Один и тот же промпт всегда дает один и тот же ответ; задержка и 429 — из собственного seed.
+    """
+
+    def __init__(self, latency: float = FAKE_LLM_LATENCY, jitter: float = FAKE_LLM_JITTER,
+                 rate_limit_rate: float = FAKE_LLM_429_RATE, output_tokens: int = FAKE_LLM_OUTPUT_TOKENS,
+                 blocks: int = FAKE_LLM_BLOCKS, chapters: int = FAKE_LLM_CHAPTERS, seed: int = FAKE_LLM_SEED):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.output_tokens = output_tokens
+        self.blocks = blocks
+        self.chapters = chapters
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "uploads": 0, "caches": 0, "latency_seconds": 0.0}
+        self.models = _FakeModels(self)
+        self.files = _FakeFiles(self)
+        self.caches = _FakeCaches(self)
+        self.aio = _FakeAio(self)
+
+    # --- поведение "сервера" ---
+    def _next_call(self) -> tuple[float, bool]:
+        """Задержка и признак 429 для очередного запроса (под локом — порядок воспроизводим)."""
+        with self._lock:
+            self.stats["requests"] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            self.stats["latency_seconds"] += delay
+            rate_limited = self._random.random() < self.rate_limit_rate
+            if rate_limited:
+                self.stats["rate_limited"] += 1
+        return delay, rate_limited
+
+    def _rate_limit_error(self) -> errors.ClientError:
+        return errors.ClientError(429, {"error": {
+            "code": 429,
+            "message": "Resource has been exhausted (fake backend).",
+            "status": "RESOURCE_EXHAUSTED",
+            "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{FAKE_LLM_RETRY_DELAY}s"}],
+        }})
+
+    def _respond(self, model: str, contents, config) -> "_FakeResponse":
+        prompt = next((item for item in contents if isinstance(item, str)), "")
+        schema = getattr(config, "response_schema", None) if config else None
+        seed = _seed_of(model, prompt, getattr(config, "temperature", None) if config else None)
+
+        parsed = None
+        if schema is not None:
+            parsed = self._structured(schema, prompt, seed)
+            text = _dump_json(parsed)
+        elif "[НАЧАЛО ПРОВЕРКИ]" in prompt:
+            text = self._blocks("НАЧАЛО ПРОВЕРКИ", "КОНЕЦ ПРОВЕРКИ", "Вердикт: Подтверждено. Обоснование:", seed)
+        elif "[НАЧАЛО ГИПОТЕЗЫ]" in prompt:
+            text = self._blocks("НАЧАЛО ГИПОТЕЗЫ", "КОНЕЦ ГИПОТЕЗЫ", "Описание:", seed)
+        elif "[НАЧАЛО ПАТТЕРНА]" in prompt:
+            text = self._blocks("НАЧАЛО ПАТТЕРНА", "КОНЕЦ ПАТТЕРНА", "Тип: Неожиданная связь персон. Описание:", seed)
+        elif "[НАЧАЛО СВЯЗИ]" in prompt:
+            text = self._blocks("НАЧАЛО СВЯЗИ", "КОНЕЦ СВЯЗИ", "Описание:", seed)
+        else:
+            # Текст главы или расширение базы — просто связный "текст" нужного размера
+            text = _filler(seed, self.output_tokens)
+
+        prompt_tokens = _count_input_tokens(contents)
+        cached_tokens = getattr(config, "cached_content", None) and self.caches.token_count(config.cached_content)
+        prompt_tokens += cached_tokens or 0
+        output_tokens = max(1, len(text) // 4)
+        usage = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            cached_content_token_count=cached_tokens or None,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+        return _FakeResponse(text=text, parsed=parsed, usage_metadata=usage)
+
+    def _blocks(self, start_tag: str, end_tag: str, lead: str, seed: int) -> str:
+        per_block = max(10, self.output_tokens // max(1, self.blocks))
+        return "\n\n".join(
+            f"[{start_tag}] {lead} {_filler(seed + i, per_block)} [{end_tag}]"
+            for i in range(self.blocks)
+        )
+
+    def _structured(self, schema, prompt: str, seed: int):
+        """Ответ по response_schema. Для структуры сценария число серий берется из промпта."""
+        match = re.search(r"строго (\d+) сери", prompt)
+        items = int(match.group(1)) if match else 1
+        return _fake_value(schema, random.Random(seed), items=items, chapters=self.chapters)
+
+
+class _FakeResponse:
+    def __init__(self, text: str, parsed, usage_metadata):
+        self.text = text
+        self.parsed = parsed
+        self.usage_metadata = usage_metadata
+
+
+class _FakeModels:
+    def __init__(self, backend: FakeGeminiBackend):
+        self._backend = backend
+
+    def generate_content(self, model: str, contents, config=None):
+        delay, rate_limited = self._backend._next_call()
+        time.sleep(delay)
+        if rate_limited:
+            raise self._backend._rate_limit_error()
+        return self._backend._respond(model, contents, config)
+
+
+    def generate_content_stream(self, model: str, contents, config=None):
+        """Тот же ответ, что generate_content, но кусками; задержка делится между чанками."""
+        delay, rate_limited = self._backend._next_call()
+        if rate_limited:
+            time.sleep(delay)
+            raise self._backend._rate_limit_error()
+        response = self._backend._respond(model, contents, config)
+        pieces = _split_text(response.text, FAKE_LLM_STREAM_CHUNKS)
+        for i, piece in enumerate(pieces):
+            time.sleep(delay / len(pieces))
+            last = i == len(pieces) - 1
+            yield _FakeResponse(text=piece, parsed=None, usage_metadata=response.usage_metadata if last else None)
+
+
+class _FakeAsyncModels:
+    def __init__(self, backend: FakeGeminiBackend):
+        self._backend = backend
+
+    async def generate_content(self, model: str, contents, config=None):
+        delay, rate_limited = self._backend._next_call()
+        await asyncio.sleep(delay)
+        if rate_limited:
+            raise self._backend._rate_limit_error()
+        return self._backend._respond(model, contents, config)
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        """Как у SDK: корутина, которая возвращает асинхронный итератор чанков."""
+        delay, rate_limited = self._backend._next_call()
+        if rate_limited:
+            await asyncio.sleep(delay)
+            raise self._backend._rate_limit_error()
+        response = self._backend._respond(model, contents, config)
+        pieces = _split_text(response.text, FAKE_LLM_STREAM_CHUNKS)
+
+        async def chunks():
+            for i, piece in enumerate(pieces):
+                await asyncio.sleep(delay / len(pieces))
+                last = i == len(pieces) - 1
+                yield _FakeResponse(text=piece, parsed=None, usage_metadata=response.usage_metadata if last else None)
+        return chunks()
+
+
+class _FakeFiles:
+    def __init__(self, backend: FakeGeminiBackend):
+        self._backend = backend
+
+    def upload(self, file, config=None):
+        with self._backend._lock:
+            self._backend.stats["uploads"] += 1
+        path = str(file)
+        mime_type = (config or {}).get("mime_type", "application/octet-stream")
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        now = datetime.now(timezone.utc)
+        return types.File(
+            name=f"files/fake-{digest}",
+            uri=f"fake://files/{digest}",
+            mime_type=mime_type,
+            size_bytes=os.path.getsize(path),
+            create_time=now,
+            expiration_time=now + timedelta(hours=48),
+        )
+
+
+class _FakeAsyncFiles:
+    def __init__(self, files: _FakeFiles):
+        self._files = files
+
+    async def upload(self, file, config=None):
+        return await asyncio.to_thread(self._files.upload, file=file, config=config)
+
+
+class _FakeCaches:
+    def __init__(self, backend: FakeGeminiBackend):
+        self._backend = backend
+        self._caches: dict[str, dict] = {}
+
+    def create(self, model: str, config):
+        with self._backend._lock:
+            self._backend.stats["caches"] += 1
+            name = f"cachedContents/fake-{len(self._caches) + 1}"
+            expire_time = datetime.now(timezone.utc) + timedelta(seconds=_ttl_seconds(config.ttl))
+            self._caches[name] = {"tokens": _count_input_tokens(config.contents or []), "expire_time": expire_time}
+        return types.CachedContent(name=name, model=model, expire_time=expire_time)
+
+    def update(self, name: str, config):
+        with self._backend._lock:
+            cache = self._caches[name]
+            cache["expire_time"] = datetime.now(timezone.utc) + timedelta(seconds=_ttl_seconds(config.ttl))
+        return types.CachedContent(name=name, expire_time=cache["expire_time"])
+
+    def delete(self, name: str):
+        with self._backend._lock:
+            self._caches.pop(name, None)
+
+    def token_count(self, name: str) -> int:
+        with self._backend._lock:
+            return self._caches.get(name, {}).get("tokens", 0)
+
+
+class _FakeAio:
+    def __init__(self, backend: FakeGeminiBackend):
+        self.models = _FakeAsyncModels(backend)
+        self.files = _FakeAsyncFiles(backend.files)
+
+
+def _split_text(text: str, parts: int) -> list[str]:
+    size = max(1, -(-len(text) // max(1, parts)))
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+def _ttl_seconds(ttl: str | None) -> int:
+    return int(str(ttl or "3600s").rstrip("s"))
+
+
+def _count_input_tokens(contents) -> int:
+    """Входные токены так, как их считал бы Gemini: текст ~4 символа на токен, файлы — по размеру."""
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item) // 4
+        elif getattr(item, "size_bytes", None):
+            total += item.size_bytes // 4 if item.mime_type == "text/plain" else item.size_bytes // 100
+        elif getattr(item, "inline_data", None) is not None and item.inline_data.data is not None:
+            total += len(item.inline_data.data) // 4
+    return total
+
+
+def _dump_json(value) -> str:
+    return json.dumps(_to_plain(value), ensure_ascii=False)
+
+
+def _to_plain(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, list):
+        return [_to_plain(item) for item in value]
+    return value
+
+
+def _fake_value(annotation, rnd: random.Random, items: int = 1, chapters: int = 4, index: int = 1):
+    """
+    Строит значение по типу response_schema: pydantic-модели, list[...], str, int, float, bool.
+    Поля *_number нумеруются по порядку, вложенные списки (главы) получают chapters элементов.
+    """
+    origin = typing.get_origin(annotation)
+    if origin is list:
+        (item_type,) = typing.get_args(annotation)
+        return [_fake_value(item_type, rnd, chapters=chapters, index=i) for i in range(1, items + 1)]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        values = {}
+        for field_name, field in annotation.model_fields.items():
+            if field_name.endswith("_number"):
+                values[field_name] = index
+            elif typing.get_origin(field.annotation) is list:
+                values[field_name] = _fake_value(field.annotation, rnd, items=chapters, chapters=chapters)
+            elif not field.is_required():
+                continue
+            else:
+                values[field_name] = _fake_value(field.annotation, rnd, chapters=chapters, index=index)
+        return annotation.model_validate(values)
+    if annotation is int:
+        return index
+    if annotation is float:
+        return round(rnd.random(), 3)
+    if annotation is bool:
+        return True
+    return _filler(rnd.getrandbits(32), 12)
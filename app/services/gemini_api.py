@@ -8,19 +8,104 @@ import time
 import random
 from google.api_core.exceptions import ResourceExhausted
 import re
+import json
+import threading
+import asyncio
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager, asynccontextmanager
+from services.rate_limiter import get_limiter, estimate_tokens
+from services.progress import WorkflowCancelled
+from services.manifest import file_sha256
+from services import metrics
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if not GEMINI_API_KEY:
-    raise ValueError("Set GEMINI_API_KEY environment variable")
-
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Бэкенд LLM: "gemini" — настоящий API, "fake" — локальная детерминированная заглушка
+# (services.fake_gemini) для прогонов и бенчмарков пайплайна без ключа и сети
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
 MODEL_NAME = 'gemini-2.5-flash' 
 
 
+def create_backend(name: str = LLM_BACKEND):
+    """
+    Создает клиент LLM. Любой бэкенд обязан повторять используемую здесь часть
+    интерфейса genai.Client: models.generate_content, files.upload, caches.create/update/delete
+    и их асинхронные варианты в aio.
+    """
+    if name == 'fake':
+        from services.fake_gemini import FakeGeminiBackend
+        logger.warning("LLM_BACKEND=fake: запросы обслуживает локальная заглушка, Gemini API не вызывается")
+        return FakeGeminiBackend()
+    if name != 'gemini':
+        raise ValueError(f"Неизвестный LLM_BACKEND: {name}")
+    if not GEMINI_API_KEY:
+        raise ValueError("Set GEMINI_API_KEY environment variable")
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+def set_backend(backend):
+    """Подменяет клиент LLM для всего процесса (например, заглушкой с другими задержками в бенчмарке)."""
+    global client
+    client = backend
+    return client
+
+
+client = create_backend()
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    # 1. Проверяем "правильный" тип (на случай, если SDK это исправит)
+    is_rate_limit_type = isinstance(e, ResourceExhausted)
+    
+    # 2. Проверяем "неправильный" тип (ловим по тексту, как в вашем логе)
+    error_text = str(e).upper()
+    is_rate_limit_text = "429" in error_text and "RESOURCE_EXHAUSTED" in error_text
+    return is_rate_limit_type or is_rate_limit_text
+
+
+def _rate_limit_delay(e: Exception, retries: int, base_delay: int = 5) -> float:
+    """Задержка перед ретраем: retryDelay из ответа API или экспоненциальная."""
+    delay = (base_delay * (2 ** (retries - 1))) + random.uniform(0, 1)
+    try:
+        match = re.search(r"retryDelay': '(\d+)", str(e))
+        if match:
+            api_delay = int(match.group(1))
+            delay = api_delay + random.uniform(0, 1)
+            logger.warning(f"Ошибка 429: API запросил задержку {api_delay}с.")
+    except Exception:
+        pass # Используем экспоненциальную задержку, если парсинг не удался
+    return delay
+
+
+# --- ОБЩИЙ ЦИКЛ СОБЫТИЙ ДЛЯ АСИНХРОННЫХ WORKFLOW ---
+# client.aio держит пул соединений httpx, привязанный к циклу событий, в котором он начал работу.
+# asyncio.run() в каждом этапе создавал бы и закрывал свой цикл при одном клиенте на процесс,
+# поэтому все корутины workflow выполняются в одном долгоживущем цикле в отдельном потоке.
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm_event_loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coro):
+    """
+    Выполняет корутину в общем цикле событий процесса и ждет результат в вызывающем потоке
+    (вместо asyncio.run). Контекст вызывающего потока — этап для метрик — переносится в корутину.
+    Внутри корутин нельзя блокировать цикл: он общий для всех одновременно идущих этапов.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
 def retry_on_rate_limit(func, *args, max_retries=10, **kwargs):
     """
     Общая функция для обработки ошибок с ретраями для 429.
@@ -29,38 +114,22 @@ def retry_on_rate_limit(func, *args, max_retries=10, **kwargs):
     Если все ретраи исчерпаны, поднимает исключение.
     """
     retries = 0
-    base_delay = 5
     while retries < max_retries:
         try:
             return func(*args, **kwargs)
+        except WorkflowCancelled:
+            raise
         
         # Ловим ВООБЩЕ ВСЕ ошибки, чтобы проанализировать их
         except Exception as e:
-            
-            # 1. Проверяем "правильный" тип (на случай, если SDK это исправит)
-            is_rate_limit_type = isinstance(e, ResourceExhausted)
-            
-            # 2. Проверяем "неправильный" тип (ловим по тексту, как в вашем логе)
-            error_text = str(e).upper()
-            is_rate_limit_text = "429" in error_text and "RESOURCE_EXHAUSTED" in error_text
-
             # Если это ошибка 429 (любым способом)
-            if is_rate_limit_type or is_rate_limit_text:
+            if _is_rate_limit_error(e):
                 retries += 1
                 if retries >= max_retries:
                     logger.error(f"Достигнут лимит попыток ({max_retries}). Запрос не выполнен.")
+                    metrics.LLM_RETRIES_EXHAUSTED.inc()
                     raise e
-                
-                delay = (base_delay * (2 ** (retries - 1))) + random.uniform(0, 1)
-                try:
-                    match = re.search(r"retryDelay': '(\d+)", str(e))
-                    if match:
-                        api_delay = int(match.group(1))
-                        delay = api_delay + random.uniform(0, 1)
-                        logger.warning(f"Ошибка 429: API запросил задержку {api_delay}с.")
-                except Exception:
-                    pass # Используем экспоненциальную задержку, если парсинг не удался
-
+                delay = _rate_limit_delay(e, retries)
                 logger.warning(f"Ошибка 429 (Попытка {retries}/{max_retries}). Ждем {delay:.2f} секунд...")
                 time.sleep(delay)
             
@@ -70,34 +139,181 @@ def retry_on_rate_limit(func, *args, max_retries=10, **kwargs):
                 raise e # Немедленно "поднимаем" ее
 
 
+async def aretry_on_rate_limit(func, *args, max_retries=10, **kwargs):
+    """Асинхронный вариант retry_on_rate_limit: func — корутина, ожидание через asyncio.sleep."""
+    retries = 0
+    while retries < max_retries:
+        try:
+            return await func(*args, **kwargs)
+        except WorkflowCancelled:
+            raise
+        except Exception as e:
+            if _is_rate_limit_error(e):
+                retries += 1
+                if retries >= max_retries:
+                    logger.error(f"Достигнут лимит попыток ({max_retries}). Запрос не выполнен.")
+                    metrics.LLM_RETRIES_EXHAUSTED.inc()
+                    raise e
+                delay = _rate_limit_delay(e, retries)
+                logger.warning(f"Ошибка 429 (Попытка {retries}/{max_retries}). Ждем {delay:.2f} секунд...")
+                await asyncio.sleep(delay)
+            else:
+                logger.error(f"Произошла непредвиденная ошибка (не 429), ретрай не выполняется: {e}", exc_info=True)
+                raise e
+
+
+# --- КЭШ ЗАГРУЗОК В FILES API ---
+# Файлы в Files API живут ~48 часов. Один и тот же PDF из DB/ нужен почти каждому workflow,
+# поэтому храним соответствие "sha256 содержимого + mime" -> удаленный файл на диске
+# и загружаем заново только при промахе или когда срок жизни файла подходит к концу.
+# Служебные файлы процесса — в APP_CACHE_DIR (по умолчанию app/cache), а не относительно рабочей папки
+CACHE_DIR = pathlib.Path(os.environ.get('APP_CACHE_DIR', pathlib.Path(__file__).resolve().parent.parent / 'cache'))
+UPLOAD_CACHE_FILE = pathlib.Path(os.environ.get('GEMINI_UPLOAD_CACHE_FILE', CACHE_DIR / 'gemini_uploads.json'))
+UPLOAD_CACHE_MARGIN = timedelta(seconds=int(os.environ.get('GEMINI_UPLOAD_CACHE_MARGIN_SECONDS', 3600)))
+FILES_API_TTL = timedelta(hours=48)
+
+_upload_cache_lock = threading.Lock()
+_upload_cache: dict | None = None
+_upload_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "bytes_uploaded": 0}
+
+
+def _get_mime_type(path: str) -> str:
+    if path.endswith('.txt'):
+        return 'text/plain'
+    elif path.endswith('.pdf'):
+        return 'application/pdf'
+    raise ValueError(f"Неподдерживаемый формат файла: {path}. Только .txt или .pdf.")
+
+
+def _load_upload_cache() -> dict:
+    """Лениво читает кэш загрузок с диска (вызывать под _upload_cache_lock)."""
+    global _upload_cache
+    if _upload_cache is None:
+        try:
+            with open(UPLOAD_CACHE_FILE, 'r', encoding='utf-8') as f:
+                _upload_cache = json.load(f)
+        except FileNotFoundError:
+            _upload_cache = {}
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Не удалось прочитать кэш загрузок {UPLOAD_CACHE_FILE}: {e}. Начинаем с пустого кэша.")
+            _upload_cache = {}
+    return _upload_cache
+
+
+def _save_upload_cache():
+    """Атомарно сохраняет кэш загрузок на диск (вызывать под _upload_cache_lock)."""
+    try:
+        UPLOAD_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = UPLOAD_CACHE_FILE.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(_upload_cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, UPLOAD_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш загрузок {UPLOAD_CACHE_FILE}: {e}")
+
+
+def _expiration_of(file: types.File) -> datetime:
+    if file.expiration_time:
+        return file.expiration_time
+    created = file.create_time or datetime.now(timezone.utc)
+    return created + FILES_API_TTL
+
+
+def _lookup_upload(path: str, mime_type: str) -> tuple[str, types.File | None]:
+    """Возвращает ключ кэша и действующий удаленный файл (или None при промахе/истечении)."""
+    key = f"{file_sha256(path)}:{mime_type}"
+    now = datetime.now(timezone.utc)
+    with _upload_cache_lock:
+        entry = _load_upload_cache().get(key)
+        if entry:
+            expires_at = datetime.fromisoformat(entry["expires_at"])
+            if expires_at - UPLOAD_CACHE_MARGIN > now:
+                _upload_cache_stats["hits"] += 1
+                logger.info(f"Файл {path} найден в кэше загрузок: {entry['file']['name']}")
+                return key, types.File.model_validate(entry["file"])
+            _upload_cache_stats["expired"] += 1
+        _upload_cache_stats["misses"] += 1
+    return key, None
+
+
+def _remember_upload(key: str, path: str, file: types.File) -> int:
+    """Запоминает загруженный файл в кэше. Возвращает отправленный объем, байт."""
+    size = os.path.getsize(path)
+    metrics.LLM_UPLOAD_BYTES.inc(size, mime_type=file.mime_type or "unknown")
+    with _upload_cache_lock:
+        _upload_cache_stats["bytes_uploaded"] += size
+        _load_upload_cache()[key] = {
+            "file": file.model_dump(mode='json', exclude_none=True),
+            "expires_at": _expiration_of(file).isoformat(),
+        }
+        _save_upload_cache()
+    logger.info(f"Файл {path} загружен в Files API: {file.name}")
+    return size
+
+
+def _cached_upload(path: str, mime_type: str) -> tuple[types.File, int]:
+    """Удаленный файл и сколько байт реально отправлено (0 — взят из кэша загрузок)."""
+    key, file = _lookup_upload(path, mime_type)
+    metrics.LLM_UPLOAD_CACHE.inc(result="miss" if file is None else "hit")
+    if file is not None:
+        return file, 0
+    with metrics.LLM_UPLOAD_SECONDS.time(mime_type=mime_type):
+        file = client.files.upload(file=path, config=dict(mime_type=mime_type))
+    return file, _remember_upload(key, path, file)
+
+
+async def _acached_upload(path: str, mime_type: str) -> tuple[types.File, int]:
+    # Хэширование больших PDF — блокирующее чтение с диска, уносим его из event loop
+    key, file = await asyncio.to_thread(_lookup_upload, path, mime_type)
+    metrics.LLM_UPLOAD_CACHE.inc(result="miss" if file is None else "hit")
+    if file is not None:
+        return file, 0
+    with metrics.LLM_UPLOAD_SECONDS.time(mime_type=mime_type):
+        file = await client.aio.files.upload(file=path, config=dict(mime_type=mime_type))
+    return file, await asyncio.to_thread(_remember_upload, key, path, file)
+
+
+def get_upload_cache_stats() -> dict:
+    """Возвращает счетчики кэша загрузок (hits/misses/expired/bytes_uploaded)."""
+    with _upload_cache_lock:
+        return dict(_upload_cache_stats)
+
+
+def upload_file(file_path) -> tuple[types.File, int]:
+    """Загружает один файл через кэш загрузок. Возвращает (файл, отправлено байт; 0 — попадание в кэш)."""
+    path = str(file_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Файл не найден: {path}")
+    return _cached_upload(path, _get_mime_type(path))
+
+
 def upload_files(file_paths):
-    uploaded = []
-    for path in file_paths:
-        path = str(path)
+    return [upload_file(path)[0] for path in file_paths]
+
+
+async def aupload_file(file_path) -> tuple[types.File, int]:
+    """Асинхронный upload_file: тот же кэш загрузок и тот же результат (файл, отправлено байт)."""
+    path = str(file_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Файл не найден: {path}")
+    return await _acached_upload(path, _get_mime_type(path))
+
+
+async def aupload_files(file_paths):
+    """Асинхронный upload_files: файлы загружаются параллельно, через тот же кэш загрузок."""
+    paths = [str(path) for path in file_paths]
+    for path in paths:
         if not os.path.exists(path):
             raise FileNotFoundError(f"Файл не найден: {path}")
-        if path.endswith('.txt'):
-            mime_type = 'text/plain'
-        elif path.endswith('.pdf') :
-            mime_type = 'application/pdf'
-        else:
-            raise ValueError(f"Неподдерживаемый формат файла: {path}. Только .txt или .pdf.")
-        file = client.files.upload(file=path, config=dict(mime_type=mime_type))
-        uploaded.append(file)
-    return uploaded
+    uploads = await asyncio.gather(*(_acached_upload(path, _get_mime_type(path)) for path in paths))
+    return [file for file, _ in uploads]
 
 
 def upload_small_file(file_path):
     file_path = str(file_path)
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Файл не найден: {file_path}")
-    if file_path.endswith('.txt'):
-        mime_type = 'text/plain'
-    elif file_path.endswith('.pdf') :
-        mime_type = 'application/pdf'
-    else:
-        raise ValueError(f"Неподдерживаемый формат файла: {file_path}. Только .txt или .pdf.")
-    
+    mime_type = _get_mime_type(file_path)
     filepath = pathlib.Path(file_path)
     file = types.Part.from_bytes(
         data=filepath.read_bytes(),
@@ -106,50 +322,221 @@ def upload_small_file(file_path):
     return [file]
 
 
-def _generate_content(model_name, contents, config):
-    """Внутренняя функция для генерации контента с обработкой токенов."""
-    response = client.models.generate_content(
-        model=model_name,
-        contents=contents,
-        config=config,
-    )
+# --- КЭШ КОНТЕКСТА (CACHED CONTENT) ---
+# Внутри одного workflow десятки вызовов отправляют один и тот же набор файлов
+# и отличаются только короткой инструкцией. Явный cached content позволяет
+# не оплачивать эти входные токены заново на каждой главе/линзе.
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL_SECONDS', 900))
+
+
+class ContextCache:
+    """
+    Cached content для стабильного набора файлов одного запуска workflow.
+    Если кэш создать не удалось (например, файлов меньше минимального размера кэша),
+    name остается None и вызовы LLM отправляют файлы как обычно.
+    """
+
+    def __init__(self, files, model_name: str, ttl_seconds: int = CONTEXT_CACHE_TTL_SECONDS):
+        self.files = files
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._name = None
+        self._expire_time = None
+        try:
+            cache = client.caches.create(
+                model=model_name,
+                config=types.CreateCachedContentConfig(
+                    contents=files,
+                    ttl=f"{ttl_seconds}s",
+                    display_name="artwriter-workflow",
+                ),
+            )
+            self._name = cache.name
+            self._expire_time = cache.expire_time
+            logger.info(f"Создан кэш контекста {cache.name} для {len(files)} файлов (TTL {ttl_seconds}с)")
+        except Exception as e:
+            logger.warning(f"Кэш контекста не создан, файлы будут отправляться в каждом запросе: {e}")
+
+    @property
+    def name(self) -> str | None:
+        """Имя кэша для запроса. Продлевает TTL, если до истечения осталось меньше половины срока."""
+        with self._lock:
+            if self._name and self._expire_time:
+                remaining = self._expire_time - datetime.now(timezone.utc)
+                if remaining < timedelta(seconds=self.ttl_seconds / 2):
+                    try:
+                        cache = client.caches.update(
+                            name=self._name,
+                            config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+                        )
+                        self._expire_time = cache.expire_time
+                        logger.info(f"TTL кэша контекста {self._name} продлен до {self._expire_time}")
+                    except Exception as e:
+                        logger.warning(f"Не удалось продлить кэш контекста {self._name}: {e}")
+                        if remaining.total_seconds() <= 0:
+                            self._name = None
+            return self._name
+
+    def delete(self):
+        with self._lock:
+            if not self._name:
+                return
+            try:
+                client.caches.delete(name=self._name)
+                logger.info(f"Кэш контекста {self._name} удален")
+            except Exception as e:
+                logger.warning(f"Не удалось удалить кэш контекста {self._name}: {e}")
+            self._name = None
+
+
+@contextmanager
+def context_cache(files, model_name: str, ttl_seconds: int = CONTEXT_CACHE_TTL_SECONDS):
+    """Создает кэш контекста на время блока with и гарантированно удаляет его после."""
+    cache = ContextCache(files, model_name, ttl_seconds) if files else None
+    try:
+        yield cache
+    finally:
+        if cache:
+            cache.delete()
+
+
+@asynccontextmanager
+async def acontext_cache(files, model_name: str, ttl_seconds: int = CONTEXT_CACHE_TTL_SECONDS):
+    """Асинхронный context_cache: создание и удаление кэша — блокирующие вызовы, уносим их из цикла событий."""
+    cache = await asyncio.to_thread(ContextCache, files, model_name, ttl_seconds) if files else None
+    try:
+        yield cache
+    finally:
+        if cache:
+            await asyncio.to_thread(cache.delete)
+
+
+def _with_context(prompt, files, context: ContextCache | None):
+    """Собирает contents запроса и имя кэша: при рабочем кэше файлы уже лежат в нем."""
+    cache_name = context.name if context else None
+    if cache_name:
+        return [prompt], cache_name
+    content = [prompt]
+    if files:
+        content.extend(files)
+    return content, None
+
+
+def _log_usage(response):
+    """Логирует расход токенов ответа. Возвращает total_token_count или None."""
     if response.usage_metadata:
         total_tokens = response.usage_metadata.total_token_count
-        logger.info(f"✅ Генерация завершена. Сгенерировано {len(response.text)} символов.")
+        logger.info(f"✅ Генерация завершена. Сгенерировано {len(response.text or '')} символов.")
         logger.info("--- Использование токенов ---")
         logger.info(f"Входных токенов (Промпт + Файлы): {response.usage_metadata.prompt_token_count}")
         logger.info(f"Выходных токенов (Ответ LLM): {response.usage_metadata.candidates_token_count}")
+        if response.usage_metadata.cached_content_token_count:
+            logger.info(f"Из них из кэша контекста: {response.usage_metadata.cached_content_token_count}")
         logger.info(f"Всего токенов: {total_tokens}")
-    else:
-        logger.warning("ℹ️ Метаданные об использовании токенов не найдены в ответе.")
-        total_tokens = None
-    return response, total_tokens
+        return total_tokens
+    logger.warning("ℹ️ Метаданные об использовании токенов не найдены в ответе.")
+    return None
+
+
+@contextmanager
+def _measure_llm_request(model_name, mode):
+    """Замер запроса к LLM для /metrics: длительность с исходом (ok / rate_limited / error / cancelled)."""
+    stage = metrics.current_stage.get()
+    with metrics.LLM_REQUEST_SECONDS.time(model=model_name, stage=stage, mode=mode, outcome="ok") as labels:
+        try:
+            yield
+        except WorkflowCancelled:
+            labels["outcome"] = "cancelled"
+            raise
+        except Exception as e:
+            labels["outcome"] = "error"
+            if _is_rate_limit_error(e):
+                labels["outcome"] = "rate_limited"
+                metrics.LLM_RATE_LIMITED.inc(model=model_name, stage=stage)
+            raise
+
+
+def _generate_content(model_name, contents, config):
+    """Внутренняя функция для генерации контента с обработкой токенов."""
+    # Общий для процесса лимитер: ждем квоту заранее, а не ловим 429 всей толпой
+    limiter = get_limiter(model_name)
+    estimated_tokens = estimate_tokens(contents)
+    waited = limiter.acquire(estimated_tokens)
+    metrics.LLM_LIMITER_WAIT_SECONDS.observe(waited, model=model_name, stage=metrics.current_stage.get())
+    with _measure_llm_request(model_name, "sync"):
+        response = client.models.generate_content(
+            model=model_name,
+            contents=contents,
+            config=config,
+        )
+    limiter.reconcile(estimated_tokens, response.usage_metadata.prompt_token_count if response.usage_metadata else None)
+    metrics.record_usage(model_name, response.usage_metadata)
+    return response, _log_usage(response)
+
+
+async def _agenerate_content(model_name, contents, config):
+    """Асинхронный _generate_content на client.aio — не занимает поток на время запроса."""
+    limiter = get_limiter(model_name)
+    estimated_tokens = estimate_tokens(contents)
+    waited = await limiter.aacquire(estimated_tokens)
+    metrics.LLM_LIMITER_WAIT_SECONDS.observe(waited, model=model_name, stage=metrics.current_stage.get())
+    with _measure_llm_request(model_name, "async"):
+        response = await client.aio.models.generate_content(
+            model=model_name,
+            contents=contents,
+            config=config,
+        )
+    metrics.record_usage(model_name, response.usage_metadata)
+    limiter.reconcile(estimated_tokens, response.usage_metadata.prompt_token_count if response.usage_metadata else None)
+    return response, _log_usage(response)
+
+
+def _llm_request(prompt, files, web_search, thinking, temperature, max_output_tokens, context):
+    """Собирает contents и config для call_llm/acall_llm."""
+    tools = []
+    thinking_budget = 1024 if thinking else 0
+    # Кэш нельзя совмещать с tools в запросе, поэтому с веб-поиском файлы идут напрямую
+    content, cache_name = _with_context(prompt, files, None if web_search else context)
+    if web_search:
+        grounding_tool = types.Tool(
+            google_search=types.GoogleSearch()
+        )
+        tools = [grounding_tool]
+    config = types.GenerateContentConfig(
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        tools=tools or None,
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+        cached_content=cache_name
+    )
+    return content, config
+
+
+def _structured_request(prompt, structure, files, temperature, max_output_tokens, context):
+    """Собирает contents и config для structured_call_llm/astructured_call_llm."""
+    content, cache_name = _with_context(prompt, files, context)
+    config = types.GenerateContentConfig(
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        response_schema=structure,
+        response_mime_type='application/json',
+        cached_content=cache_name
+    )
+    return content, config
 
 
 def call_llm(prompt, files=None, model_name=MODEL_NAME, 
-             web_search=False, thinking=True, temperature=1, max_output_tokens=10000):
+             web_search=False, thinking=True, temperature=1, max_output_tokens=10000,
+             context: ContextCache | None = None):
     """
     Вызов LLM с возвратом статуса, ответа и токенов.
+    context: кэш контекста с теми же files (файлы тогда не отправляются повторно).
     Возвращает: (status: str, response: str or None, tokens: int or None)
     status: 'success' или 'error: description'
     """
     try:
-        content = [prompt]
-        tools = []
-        thinking_budget = 1024 if thinking else 0
-        if files:
-            content.extend(files)
-        if web_search:
-            grounding_tool = types.Tool(
-                google_search=types.GoogleSearch()
-            )
-            tools = [grounding_tool]
-        config = types.GenerateContentConfig(
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-            tools=tools,
-            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget)
-        )
+        content, config = _llm_request(prompt, files, web_search, thinking, temperature, max_output_tokens, context)
         
         # Используем общую функцию ретраев
         response, total_tokens = retry_on_rate_limit(
@@ -164,22 +551,203 @@ def call_llm(prompt, files=None, model_name=MODEL_NAME,
         return "error: " + error_msg, None, None
 
 
-def structured_call_llm(prompt, structure, files=None, model_name=MODEL_NAME, temperature=0.7, max_output_tokens=4096):
+async def acall_llm(prompt, files=None, model_name=MODEL_NAME,
+                    web_search=False, thinking=True, temperature=1, max_output_tokens=10000,
+                    context: ContextCache | None = None):
+    """Асинхронный call_llm: те же параметры и тот же результат (status, response, tokens)."""
+    try:
+        # context.name может синхронно продлить TTL кэша — не в цикле событий
+        content, config = await asyncio.to_thread(
+            _llm_request, prompt, files, web_search, thinking, temperature, max_output_tokens, context)
+        response, total_tokens = await aretry_on_rate_limit(
+            _agenerate_content, model_name, content, config
+        )
+        return "success", response.text, total_tokens
+    except Exception as e:
+        error_msg = f"Ошибка при вызове LLM: {str(e)}"
+        logger.error(error_msg)
+        return "error: " + error_msg, None, None
+
+
+class StreamInterrupted(Exception):
+    """Поток оборвался после того, как часть ответа уже ушла в on_delta: такой запрос не повторяем."""
+
+
+def _stream_content(model_name, contents, config, on_delta=None, output_file=None):
+    """
+    Потоковая генерация: отдает дельты текста в on_delta и дописывает их в output_file.part
+    по мере прихода. Файл переименовывается в output_file только после полного ответа,
+    поэтому оборванная генерация не выглядит готовым результатом.
+    Ошибка (в том числе 429) после первой отданной дельты превращается в StreamInterrupted:
+    повтор начал бы ответ заново, и подписчики получили бы начало текста дважды.
+    Возвращает (полный текст, usage_metadata последнего чанка).
+    """
+    limiter = get_limiter(model_name)
+    estimated_tokens = estimate_tokens(contents)
+    waited = limiter.acquire(estimated_tokens)
+    metrics.LLM_LIMITER_WAIT_SECONDS.observe(waited, model=model_name, stage=metrics.current_stage.get())
+    part_file = pathlib.Path(f"{output_file}.part") if output_file else None
+    out = open(part_file, 'w', encoding='utf-8') if part_file else None
+    chunks, usage, completed = [], None, False
+    try:
+        with _measure_llm_request(model_name, "stream"):
+            stream = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+            try:
+                for chunk in stream:
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    delta = chunk.text
+                    if not delta:
+                        continue
+                    chunks.append(delta)
+                    if out:
+                        out.write(delta)
+                        out.flush()
+                    if on_delta:
+                        on_delta(delta)
+                completed = True
+            except WorkflowCancelled as e:
+                # Точного расхода у оборванного ответа нет — оцениваем: весь вход плюс уже полученный текст
+                e.partial_tokens = estimated_tokens + len("".join(chunks)) // 4
+                raise
+            finally:
+                # Закрываем поток и при досрочной остановке (исключение из on_delta) — генерация прерывается
+                if hasattr(stream, "close"):
+                    stream.close()
+                if out:
+                    out.close()
+                    # Недописанный файл не оставляем: готовым считается только переименованный результат
+                    if not completed:
+                        part_file.unlink(missing_ok=True)
+    except WorkflowCancelled:
+        raise
+    except Exception as e:
+        if not (chunks and on_delta):
+            raise
+        logger.error(f"Потоковая генерация оборвалась после {len(chunks)} фрагментов, повтор не выполняется: {e}")
+        raise StreamInterrupted(f"генерация оборвалась на середине ответа ({type(e).__name__})") from e
+    limiter.reconcile(estimated_tokens, usage.prompt_token_count if usage else None)
+    metrics.record_usage(model_name, usage)
+    if part_file:
+        os.replace(part_file, output_file)
+    return "".join(chunks), usage
+
+
+def stream_call_llm(prompt, files=None, model_name=MODEL_NAME,
+                    web_search=False, thinking=True, temperature=1, max_output_tokens=10000,
+                    context: ContextCache | None = None, on_delta=None, output_file=None):
+    """
+    Потоковый call_llm на generate_content_stream.
+    on_delta(text): вызывается на каждый фрагмент ответа; исключение из него останавливает генерацию
+    (WorkflowCancelled пробрасывается наверх с оценкой потраченных токенов в partial_tokens).
+    output_file: куда по мере генерации писать текст (через временный output_file.part).
+    429 до первого фрагмента повторяется как обычно; после — запрос завершается ошибкой без повтора.
+    Возвращает то же, что call_llm: (status, response, tokens), токены — из usage_metadata.
+    """
+    try:
+        content, config = _llm_request(prompt, files, web_search, thinking, temperature, max_output_tokens, context)
+        text, usage = retry_on_rate_limit(
+            _stream_content, model_name, content, config, on_delta=on_delta, output_file=output_file
+        )
+        total_tokens = usage.total_token_count if usage else None
+        logger.info(f"✅ Потоковая генерация завершена. Сгенерировано {len(text)} символов, токенов: {total_tokens}")
+        return "success", text, total_tokens
+    except WorkflowCancelled:
+        logger.info("Потоковая генерация прервана: выполнение отменено")
+        raise
+    except Exception as e:
+        error_msg = f"Ошибка при потоковом вызове LLM: {str(e)}"
+        logger.error(error_msg)
+        return "error: " + error_msg, None, None
+
+
+async def _astream_content(model_name, contents, config, on_delta=None, output_file=None):
+    """
+    Асинхронный _stream_content на client.aio: та же запись через output_file.part
+    и то же правило про ошибки после первой дельты.
+    on_delta вызывается в общем цикле событий и не должен блокировать.
+    """
+    limiter = get_limiter(model_name)
+    estimated_tokens = estimate_tokens(contents)
+    waited = await limiter.aacquire(estimated_tokens)
+    metrics.LLM_LIMITER_WAIT_SECONDS.observe(waited, model=model_name, stage=metrics.current_stage.get())
+    part_file = pathlib.Path(f"{output_file}.part") if output_file else None
+    # Дельты — короткие дописывания в открытый файл, их не уносим в поток
+    out = open(part_file, 'w', encoding='utf-8') if part_file else None
+    chunks, usage, completed = [], None, False
+    try:
+        with _measure_llm_request(model_name, "async_stream"):
+            stream = await client.aio.models.generate_content_stream(model=model_name, contents=contents, config=config)
+            try:
+                async for chunk in stream:
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    delta = chunk.text
+                    if not delta:
+                        continue
+                    chunks.append(delta)
+                    if out:
+                        out.write(delta)
+                        out.flush()
+                    if on_delta:
+                        on_delta(delta)
+                completed = True
+            except WorkflowCancelled as e:
+                e.partial_tokens = estimated_tokens + len("".join(chunks)) // 4
+                raise
+            finally:
+                if hasattr(stream, "aclose"):
+                    await stream.aclose()
+                if out:
+                    out.close()
+                    if not completed:
+                        part_file.unlink(missing_ok=True)
+    except WorkflowCancelled:
+        raise
+    except Exception as e:
+        if not (chunks and on_delta):
+            raise
+        logger.error(f"Потоковая генерация оборвалась после {len(chunks)} фрагментов, повтор не выполняется: {e}")
+        raise StreamInterrupted(f"генерация оборвалась на середине ответа ({type(e).__name__})") from e
+    limiter.reconcile(estimated_tokens, usage.prompt_token_count if usage else None)
+    metrics.record_usage(model_name, usage)
+    if part_file:
+        os.replace(part_file, output_file)
+    return "".join(chunks), usage
+
+
+async def astream_call_llm(prompt, files=None, model_name=MODEL_NAME,
+                           web_search=False, thinking=True, temperature=1, max_output_tokens=10000,
+                           context: ContextCache | None = None, on_delta=None, output_file=None):
+    """Асинхронный stream_call_llm: те же параметры, тот же результат и те же правила повтора и отмены."""
+    try:
+        content, config = await asyncio.to_thread(
+            _llm_request, prompt, files, web_search, thinking, temperature, max_output_tokens, context)
+        text, usage = await aretry_on_rate_limit(
+            _astream_content, model_name, content, config, on_delta=on_delta, output_file=output_file
+        )
+        total_tokens = usage.total_token_count if usage else None
+        logger.info(f"✅ Потоковая генерация завершена. Сгенерировано {len(text)} символов, токенов: {total_tokens}")
+        return "success", text, total_tokens
+    except WorkflowCancelled:
+        logger.info("Потоковая генерация прервана: выполнение отменено")
+        raise
+    except Exception as e:
+        error_msg = f"Ошибка при потоковом вызове LLM: {str(e)}"
+        logger.error(error_msg)
+        return "error: " + error_msg, None, None
+
+
+def structured_call_llm(prompt, structure, files=None, model_name=MODEL_NAME, temperature=0.7, max_output_tokens=4096,
+                        context: ContextCache | None = None):
     """
     Структурированный вызов LLM с возвратом статуса, ответа и токенов.
+    context: кэш контекста с теми же files (файлы тогда не отправляются повторно).
     Возвращает: (status: str, response: dict or None, tokens: int or None)
     response: распарсенный JSON или None
     """
     try:
-        content = [prompt]
-        if files:
-            content.extend(files)
-        config = types.GenerateContentConfig(
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-            response_schema=structure,
-            response_mime_type='application/json'
-        )
+        content, config = _structured_request(prompt, structure, files, temperature, max_output_tokens, context)
         
         # Используем общую функцию ретраев
         response, total_tokens = retry_on_rate_limit(
@@ -192,4 +760,20 @@ def structured_call_llm(prompt, structure, files=None, model_name=MODEL_NAME, te
     except Exception as e:
         error_msg = f"Ошибка при структурированном вызове LLM: {str(e)}"
         logger.error(error_msg)
-        return "error: " + error_msg, None, None
\ No newline at end of file
+        return "error: " + error_msg, None, None
+
+
+async def astructured_call_llm(prompt, structure, files=None, model_name=MODEL_NAME, temperature=0.7,
+                               max_output_tokens=4096, context: ContextCache | None = None):
+    """Асинхронный structured_call_llm: те же параметры и тот же результат."""
+    try:
+        content, config = await asyncio.to_thread(
+            _structured_request, prompt, structure, files, temperature, max_output_tokens, context)
+        response, total_tokens = await aretry_on_rate_limit(
+            _agenerate_content, model_name, content, config
+        )
+        return "success", response, total_tokens
+    except Exception as e:
+        error_msg = f"Ошибка при структурированном вызове LLM: {str(e)}"
+        logger.error(error_msg)
+        return "error: " + error_msg, None, None
@@ -0,0 +1,322 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from db.db import SessionLocal, engine
+from sqlalchemy import text
+from db.crud_job import create_job, update_job, mark_orphaned_jobs, find_job_by_idempotency_key, ACTIVE_JOB_STATUSES
+from db.models import WorkflowJob
+from sqlalchemy.orm import Session
+from services import workflows as wrk
+from services.progress import WorkflowProgress, WorkflowCancelled
+from services.admission import AdmissionController, Ticket
+from services import events
+from services import metrics
+from services import usage_buffer
+
+logger = logging.getLogger(__name__)
+
+# Сколько workflow может выполняться одновременно во всем процессе
+WORKFLOW_WORKERS = int(os.environ.get("WORKFLOW_WORKERS", 4))
+
+_executor = ThreadPoolExecutor(max_workers=WORKFLOW_WORKERS, thread_name_prefix="workflow_job")
+# Задачи попадают в исполнитель только через контроллер допуска (лимиты на пользователя и проект, очередь по кругу)
+_admission = AdmissionController(_executor, max_running=WORKFLOW_WORKERS)
+
+metrics.Gauge("workflow_jobs_queued", "Задачи workflow в очереди допуска",
+              collect=lambda: {(): _admission.stats()["queued"]})
+
+# Окна идемпотентности: сколько повтор запроса возвращает уже готовый результат вместо нового запуска.
+# Ключ клиента (заголовок Idempotency-Key) означает "тот же самый запрос" — окно длинное.
+# Ключ, выведенный из параметров, ловит двойные клики и перезапуски Streamlit — окно короткое,
+# чтобы осознанный перезапуск после правки файлов проекта не вернул старый результат.
+IDEMPOTENCY_CLIENT_WINDOW = int(os.environ.get("IDEMPOTENCY_CLIENT_WINDOW_SECONDS", 24 * 3600))
+IDEMPOTENCY_DERIVED_WINDOW = int(os.environ.get("IDEMPOTENCY_DERIVED_WINDOW_SECONDS", 120))
+
+# Поиск дубля и создание задачи должны быть атомарны, иначе два одновременных запроса создадут две задачи
+_submit_lock = threading.Lock()
+
+# Прогресс еще не завершенных задач этого процесса (через него задачу можно отменить)
+_active_lock = threading.Lock()
+_active: dict[str, WorkflowProgress] = {}
+
+
+# --- РЕЕСТР WORKFLOW ---
+# Каждый workflow принимает сохраненные в задаче параметры и объект прогресса,
+# возвращает (status, tokens), как и функции из services.workflows.
+WORKFLOWS = {
+    # Этапы пайплайна идут через манифест: при неизменившихся входах задача — no-op.
+    # Все workflow работают на асинхронном клиенте (run_async): задача занимает один поток,
+    # который ждет корутину, а запросы к LLM идут в общем цикле событий
+    "expand": lambda p, progress: wrk.run_stage(
+        "expand", p["folder_path"], p, progress=progress, force=p.get("force", False)),
+    "search": lambda p, progress: wrk.run_stage(
+        "search_main" if p["search_type"] == "main" else "search_blind",
+        p["folder_path"], p, progress=progress, force=p.get("force", False)),
+    # Проверка blind spots не входит в граф (структура берет гипотезы blind spots без проверки)
+    "check": lambda p, progress: (
+        wrk.run_stage("check_main", p["folder_path"], p, progress=progress, force=p.get("force", False))
+        if p["search_type"] == "main" else
+        wrk.run_async(wrk.acheck_hypotheses(p["folder_path"], p["llm_model"], p["search_type"], progress=progress))),
+    "structure": lambda p, progress: wrk.run_stage(
+        "structure", p["folder_path"], p, progress=progress, force=p.get("force", False)),
+    "scenario": lambda p, progress: wrk.run_stage(
+        "scenario", p["folder_path"], p, progress=progress, force=p.get("force", False) or p.get("resume", False)),
+    # Одна глава или одна серия готового сценария
+    "regenerate": lambda p, progress: wrk.run_async(wrk.aregenerate_scenario_part(
+        p["folder_path"], p["llm_model"], p["temperature"], chapter_id=p.get("chapter_id"),
+        serie_id=p.get("serie_id"), progress=progress)),
+    # Все этапы по графу зависимостей (services.workflows.PIPELINE_STAGES)
+    "pipeline": lambda p, progress: wrk.run_pipeline(
+        p["folder_path"], p, max_workers=p.get("max_stages"), progress=progress),
+}
+
+WORKFLOW_MESSAGES = {
+    "expand": "Database expanded successfully",
+    "search": "Facts search completed",
+    "check": "Hypotheses checked successfully",
+    "structure": "Scenario structure created",
+    "scenario": "Scenario text generated",
+    "pipeline": "Pipeline completed: scenario generated",
+    "regenerate": "Scenario part regenerated",
+}
+
+
+# События, которые только рассылаются подписчикам и не сохраняются в задаче (слишком частые)
+TRANSIENT_EVENTS = {"text_delta"}
+# Прогресс задачи пишется в БД не чаще раза в N секунд: подписчики SSE получают каждое событие сразу,
+# а опросу статуса хватает последнего. Отложенное событие дописывается вместе с итогом задачи
+JOB_PROGRESS_WRITE_INTERVAL = float(os.environ.get("JOB_PROGRESS_WRITE_SECONDS", 2))
+
+_progress_lock = threading.Lock()
+_progress_writes: dict[str, tuple[float, Optional[dict]]] = {}  # job_id -> (время записи, еще не записанное)
+
+
+def _on_progress(job_id: str, project_id: int, event: dict):
+    """
+    Рассылает событие прогресса подписчикам проекта (SSE, вместе с текстом)
+    и сохраняет его в задаче (без сгенерированного текста, не чаще JOB_PROGRESS_WRITE_INTERVAL).
+    """
+    events.publish(project_id, {"job_id": job_id, **event})
+    if event.get("event") in TRANSIENT_EVENTS:
+        return
+    progress = {k: v for k, v in event.items() if k != "text"}
+    now = time.monotonic()
+    with _progress_lock:
+        written_at, _ = _progress_writes.get(job_id, (float("-inf"), None))
+        if now - written_at < JOB_PROGRESS_WRITE_INTERVAL:
+            _progress_writes[job_id] = (written_at, progress)
+            return
+        _progress_writes[job_id] = (now, None)
+    with SessionLocal() as db:
+        update_job(db, job_id, **_progress_fields(progress))
+
+
+def _progress_fields(progress: dict) -> dict:
+    return {"stage": progress.get("stage"), "progress": progress, "tokens": progress.get("tokens", 0)}
+
+
+def _unwritten_progress(job_id: str) -> dict:
+    """Поля последнего отложенного события задачи — для итоговой записи (и забывает задачу)."""
+    with _progress_lock:
+        _, progress = _progress_writes.pop(job_id, (0.0, None))
+    if progress is None:
+        return {}
+    fields = _progress_fields(progress)
+    fields.pop("tokens")  # Итоговые токены задача пишет сама
+    return fields
+
+
+def _run_job(job_id: str, project_id: int, workflow: str, params: dict, user_id: int, progress: WorkflowProgress):
+    """Выполняет workflow в фоне, по завершении списывает токены и сохраняет результат."""
+    try:
+        if progress.cancelled:
+            # Отменили, пока задача стояла в очереди — даже не начинаем
+            with SessionLocal() as db:
+                update_job(db, job_id, status="cancelled", finished_at=datetime.utcnow(),
+                           error="Задача отменена до запуска")
+            logger.info(f"Задача {job_id} ({workflow}) отменена до запуска")
+            events.publish(project_id, {"job_id": job_id, "event": "job_cancelled", "tokens": 0})
+            return
+
+        with SessionLocal() as db:
+            update_job(db, job_id, status="running", stage=workflow, started_at=datetime.utcnow())
+        logger.info(f"Задача {job_id} ({workflow}) запущена")
+        events.publish(project_id, {"job_id": job_id, "event": "job_started", "workflow": workflow})
+
+        cancelled = False
+        started = time.perf_counter()
+        metrics.WORKFLOW_JOBS_RUNNING.inc(workflow=workflow)
+        try:
+            with metrics.stage(workflow):
+                status, _ = WORKFLOWS[workflow](params, progress)
+        except WorkflowCancelled as e:
+            logger.info(f"Задача {job_id} ({workflow}) остановлена: {e}")
+            status, cancelled = str(e), True
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка в задаче {job_id} ({workflow}): {e}", exc_info=True)
+            status = f"error: {e}"
+        finally:
+            metrics.WORKFLOW_JOBS_RUNNING.dec(workflow=workflow)
+        outcome = "cancelled" if cancelled else "done" if status == "success" else "failed"
+        metrics.WORKFLOW_JOB_SECONDS.observe(time.perf_counter() - started, workflow=workflow, status=outcome)
+
+        # Списываем все реально потраченные токены — в том числе при ошибке или отмене на середине workflow
+        tokens = progress.tokens
+        try:
+            # Для пайплайна — отдельной строкой на каждый этап. В БД уйдет пачкой (services.usage_buffer)
+            for stage, stage_tokens in progress.tokens_by_stage().items():
+                usage_buffer.record(user_id, stage_tokens, model=params.get("llm_model", "unknown"), stage=stage)
+        except Exception as e:
+            logger.error(f"Не удалось списать {tokens} токенов за задачу {job_id}: {e}")
+
+        progress_fields = _unwritten_progress(job_id)
+        with SessionLocal() as db:
+            if cancelled:
+                update_job(db, job_id, status="cancelled", tokens=tokens, finished_at=datetime.utcnow(),
+                           error="Задача отменена пользователем", **progress_fields)
+                events.publish(project_id, {"job_id": job_id, "event": "job_cancelled", "tokens": tokens})
+            elif status == "success":
+                result = {"status": "ok", "message": WORKFLOW_MESSAGES[workflow]}
+                update_job(db, job_id, status="done", tokens=tokens, finished_at=datetime.utcnow(), result=result,
+                           **progress_fields)
+                logger.info(f"Задача {job_id} ({workflow}) завершена, токенов: {tokens}")
+                events.publish(project_id, {"job_id": job_id, "event": "job_done", "tokens": tokens, "result": result})
+            else:
+                update_job(db, job_id, status="failed", tokens=tokens, finished_at=datetime.utcnow(),
+                           error=str(status), **progress_fields)
+                logger.error(f"Задача {job_id} ({workflow}) завершилась с ошибкой: {status}")
+                events.publish(project_id, {"job_id": job_id, "event": "job_failed", "tokens": tokens, "error": str(status)})
+    finally:
+        with _active_lock:
+            _active.pop(job_id, None)
+        with _progress_lock:
+            _progress_writes.pop(job_id, None)
+
+
+def _idempotency_key(project_id: int, user_id: int, workflow: str, params: dict,
+                     client_key: Optional[str]) -> tuple[str, int]:
+    """Ключ идемпотентности и окно повторного использования результата (секунды)."""
+    if client_key:
+        # Ключи клиентов разных пользователей не должны пересекаться
+        return f"client:{user_id}:{client_key}", IDEMPOTENCY_CLIENT_WINDOW
+    payload = json.dumps({"project_id": project_id, "workflow": workflow, "params": params},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return "params:" + hashlib.sha256(payload.encode("utf-8")).hexdigest(), IDEMPOTENCY_DERIVED_WINDOW
+
+
+def submit_job(db: Session, project_id: int, user_id: int, workflow: str, params: dict,
+               idempotency_key: Optional[str] = None) -> WorkflowJob:
+    """
+    Создает задачу и передает ее контроллеру допуска. Возвращает сразу: задача либо уже
+    запущена, либо ждет в очереди (status queued, позиция — в progress).
+
+    Такой же запрос (тот же idempotency_key или те же проект, workflow и параметры) не запускает
+    модель повторно: пока задача в очереди или выполняется, возвращается она же, а в пределах окна
+    идемпотентности — и уже завершенная успешно. Упавшие и отмененные задачи не переиспользуются.
+    Бросает WorkflowQuotaExceeded, если очередь пользователя переполнена — тогда задача не создается.
+    """
+    if workflow not in WORKFLOWS:
+        raise ValueError(f"Неизвестный workflow: {workflow}")
+    key, window = _idempotency_key(project_id, user_id, workflow, params, idempotency_key)
+    with _submit_lock:
+        now = datetime.utcnow()
+        existing = (
+            # Активная задача этого процесса — с любым возрастом (долгий пайплайн может идти дольше окна)
+            find_job_by_idempotency_key(db, project_id, key, ACTIVE_JOB_STATUSES, datetime.min)
+            or find_job_by_idempotency_key(db, project_id, key, ("done",), now - timedelta(seconds=window))
+        )
+        with _active_lock:
+            reusable = existing is not None and (existing.status == "done" or existing.job_id in _active)
+        if reusable:
+            logger.info(f"Повторный запрос {workflow} для проекта {project_id} от {user_id}: "
+                        f"возвращена задача {existing.job_id} ({existing.status})")
+            return existing
+
+        # Проверка квоты и постановка в очередь — под одним локом, иначе два запроса пройдут check вместе
+        _admission.check(user_id)
+        job = create_job(db, project_id, user_id, workflow, params, idempotency_key=key)
+        job_id = job.job_id
+        progress = WorkflowProgress(on_event=lambda event: _on_progress(job_id, project_id, event), stage=workflow)
+        with _active_lock:
+            _active[job_id] = progress
+        position = _admission.submit(Ticket(
+            job_id, user_id, project_id, lambda: _run_job(job_id, project_id, workflow, params, user_id, progress)))
+    if position:
+        logger.info(f"Задача {job_id} ({workflow}) ждет в очереди, позиция {position}")
+        queued = {"event": "job_queued", "position": position}
+        update_job(db, job_id, progress=queued)
+        events.publish(project_id, {"job_id": job_id, **queued})
+    return job
+
+
+def job_queue_position(job_id: str) -> int:
+    """Позиция задачи в очереди допуска (0 — задача не в очереди)."""
+    return _admission.position(job_id)
+
+
+def get_admission_stats() -> dict:
+    return _admission.stats()
+
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Просит задачу остановиться. Workflow проверяет отмену между вызовами LLM и обрывает
+    потоковую генерацию; уже сохраненные линзы/главы остаются на диске.
+    Задача из очереди допуска снимается сразу, не дожидаясь свободного слота.
+    Возвращает False, если задача не выполняется в этом процессе.
+    """
+    with _active_lock:
+        progress = _active.get(job_id)
+    if progress is None:
+        return False
+    progress.cancel()
+    ticket = _admission.remove(job_id)
+    if ticket is not None:
+        # _run_job увидит отмену и только запишет статус cancelled
+        ticket.run()
+    logger.info(f"Запрошена отмена задачи {job_id}")
+    return True
+
+
+# Advisory-блокировка Postgres "процесс сервера жив": каждый процесс держит ее в режиме shared все
+# время работы на отдельном соединении. Осиротевшими задачи помечает только процесс, взявший ее
+# эксклюзивно, то есть когда других живых процессов нет. Иначе при нескольких воркерах uvicorn
+# новый воркер пометил бы orphaned задачи, которые прямо сейчас выполняют соседи.
+WORKERS_LOCK_KEY = 0x41525457  # "ARTW"
+_workers_lock_connection = None
+
+
+def recover_orphaned_jobs() -> int:
+    """
+    Вызывается при старте: задачи прошлых процессов уже никто не выполнит. Если работают другие
+    процессы сервера, ничего не помечает: задачи погибшего воркера будут помечены при полном перезапуске.
+    """
+    global _workers_lock_connection
+    connection = engine.connect()
+    try:
+        alone = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": WORKERS_LOCK_KEY}).scalar()
+        count = 0
+        if alone:
+            with SessionLocal() as db:
+                count = mark_orphaned_jobs(db)
+        else:
+            logger.warning("Работают другие процессы сервера: осиротевшие задачи не помечаются, "
+                           "их выполняют или выполняли соседние воркеры")
+        # Shared берем до снятия эксклюзивной, чтобы между ними никто не успел начать восстановление
+        connection.execute(text("SELECT pg_advisory_lock_shared(:key)"), {"key": WORKERS_LOCK_KEY})
+        if alone:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": WORKERS_LOCK_KEY})
+        # Блокировки сессионные и переживают commit; соединение не должно висеть в открытой транзакции
+        connection.commit()
+    except Exception:
+        connection.close()
+        raise
+    _workers_lock_connection = connection
+    return count
@@ -0,0 +1,88 @@
+import os
+import json
+import inspect
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+
+# Манифест одного проекта пишут параллельные этапы — сериализуем запись по пути файла
+_locks_guard = threading.Lock()
+_locks: dict[str, threading.Lock] = {}
+
+
+def _lock_for(topic_path: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(str(Path(topic_path).resolve()), threading.Lock())
+
+
+def file_sha256(path: str | Path) -> str:
+    """sha256 содержимого файла; читает блоками по 1 МБ, не загружая файл в память целиком."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def artifact_hash(topic_path: str, artifact: str, exclude: set[str] = frozenset()) -> str | None:
+    """
+    Хэш содержимого артефакта: файла или папки (все файлы папки, кроме exclude).
+    None — артефакта нет.
+    """
+    root = Path(topic_path)
+    path = root / artifact
+    if path.is_file():
+        return file_sha256(path)
+    if not path.is_dir():
+        return None
+    digest = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        relative = file.relative_to(root).as_posix()
+        if relative in exclude:
+            continue
+        digest.update(relative.encode("utf-8"))
+        digest.update(file_sha256(file).encode("ascii"))
+    return digest.hexdigest()
+
+
+def prompt_version(prompt_functions) -> str:
+    """Версия промптов этапа — хэш исходного кода функций, которые их строят."""
+    digest = hashlib.sha256()
+    for func in prompt_functions:
+        digest.update(inspect.getsource(func).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def load_manifest(topic_path: str) -> dict:
+    path = Path(topic_path) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"Манифест {path} поврежден и будет пересоздан: {e}")
+        return {}
+
+
+def record_stage(topic_path: str, stage_name: str, entry: dict):
+    """Сохраняет запись этапа в манифест проекта (атомарно, через временный файл)."""
+    path = Path(topic_path) / MANIFEST_FILE
+    with _lock_for(topic_path):
+        manifest = load_manifest(topic_path)
+        manifest[stage_name] = {**entry, "completed_at": datetime.utcnow().isoformat()}
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    logger.info(f"Манифест {path}: этап {stage_name} записан")
+
+
+def fingerprint_hash(fingerprint: dict) -> str:
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
@@ -0,0 +1,262 @@
+"""
+Метрики процесса в текстовом формате Prometheus (отдаются на /metrics).
+
+Своя минимальная реализация счетчиков, gauge и гистограмм: метрики живут в памяти
+одного процесса uvicorn, как и очередь задач, поэтому внешний клиент не нужен.
+"""
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм (секунды): от быстрых запросов к БД до многоминутных задач
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+LLM_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+# Этап, от имени которого идут вызовы LLM (задача или этап пайплайна). В пулы потоков
+# внутри workflow переносится через contextvars.copy_context()
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("llm_stage", default="unknown")
+
+
+@contextmanager
+def stage(name: str):
+    token = current_stage.set(name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение. Либо выставляется через set/inc/dec, либо считается при каждом
+    опросе функцией collect() -> {(значения меток): число}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), collect: Callable[[], dict] | None = None):
+        self.collect = collect
+        super().__init__(name, documentation, labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> list[str]:
+        if self.collect is not None:
+            try:
+                values = {tuple(str(v) for v in key): value for key, value in self.collect().items()}
+            except Exception as e:
+                logger.warning(f"Не удалось собрать метрику {self.name}: {e}")
+                return []
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Гистограмма с накопительными корзинами (_bucket, _sum, _count), как у Prometheus."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = FAST_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with; метки можно дополнить внутри блока через словарь."""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_number(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+_registry_lock = threading.Lock()
+_registry: dict[str, _Metric] = {}
+
+
+def register(metric: _Metric):
+    with _registry_lock:
+        if metric.name in _registry:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        _registry[metric.name] = metric
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus 0.0.4."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# --- МЕТРИКИ ПРИЛОЖЕНИЯ ---
+# LLM
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "Длительность запроса к LLM (без ожидания лимитера)",
+    ("model", "stage", "mode", "outcome"), buckets=LLM_BUCKETS)
+LLM_LIMITER_WAIT_SECONDS = Histogram(
+    "llm_rate_limiter_wait_seconds", "Ожидание квоты в локальном лимитере перед запросом",
+    ("model", "stage"), buckets=LLM_BUCKETS)
+LLM_TOKENS = Counter("llm_tokens_total", "Токены по usage_metadata ответов", ("model", "stage", "kind"))
+LLM_RATE_LIMITED = Counter("llm_rate_limited_total", "Ответы 429 от LLM (каждый ведет к ретраю)", ("model", "stage"))
+LLM_RETRIES_EXHAUSTED = Counter("llm_retries_exhausted_total", "Запросы, для которых кончились ретраи 429")
+
+# Files API
+LLM_UPLOAD_SECONDS = Histogram(
+    "llm_upload_duration_seconds", "Длительность загрузки файла в Files API", ("mime_type",), buckets=LLM_BUCKETS)
+LLM_UPLOAD_BYTES = Counter("llm_upload_bytes_total", "Байты, загруженные в Files API", ("mime_type",))
+LLM_UPLOAD_CACHE = Counter("llm_upload_cache_total", "Обращения к кэшу загрузок", ("result",))
+
+# БД и HTTP
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Длительность SQL-запроса", ("operation",))
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Ожидание свободного соединения в пуле БД")
+DB_POOL_HOLD_SECONDS = Histogram("db_pool_hold_seconds", "Сколько соединение занято между checkout и checkin")
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Запросы соединения, не дождавшиеся свободного в пуле")
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Длительность обработки HTTP-запроса", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP-запросы в обработке")
+
+# Кэши аутентификации и прав доступа (доля попаданий: hit / (hit + miss))
+AUTH_CACHE = Counter("auth_cache_total", "Обращения к кэшам get_current_user и get_access_level",
+                     ("cache", "result"))
+
+# Фоновые задачи
+WORKFLOW_JOB_SECONDS = Histogram(
+    "workflow_job_duration_seconds", "Длительность фоновой задачи workflow", ("workflow", "status"),
+    buckets=JOB_BUCKETS)
+WORKFLOW_JOBS_RUNNING = Gauge("workflow_jobs_running", "Выполняющиеся задачи workflow", ("workflow",))
+WORKFLOW_STAGE_SECONDS = Histogram(
+    "workflow_stage_duration_seconds", "Длительность этапа пайплайна", ("stage", "status"), buckets=JOB_BUCKETS)
+
+
+def record_usage(model: str, usage):
+    """Токены ответа LLM (usage_metadata) в llm_tokens_total."""
+    if usage is None:
+        return
+    stage_name = current_stage.get()
+    for kind, value in (("prompt", usage.prompt_token_count), ("output", usage.candidates_token_count),
+                        ("cached", usage.cached_content_token_count)):
+        if value:
+            LLM_TOKENS.inc(value, model=model, stage=stage_name, kind=kind)
+
+
+# --- ИНСТРУМЕНТАЦИЯ SQLALCHEMY ---
+def instrument_engine(engine):
+    """Вешает на engine замер длительности каждого SQL-запроса."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        if operation not in ("select", "insert", "update", "delete"):
+            operation = "other"
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # Запрос упал — снимаем его отметку времени, чтобы стек не разъехался
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
@@ -0,0 +1,84 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkflowCancelled(Exception):
+    """Выполнение workflow остановлено по запросу пользователя."""
+
+
+class WorkflowProgress:
+    """
+    Прогресс выполнения workflow.
+    Копит потраченные токены и передает события (линза готова, глава готова и т.д.)
+    подписчику on_event. Без подписчика события просто игнорируются,
+    поэтому workflow можно вызывать и напрямую, без джобы.
+    """
+
+    def __init__(self, on_event: Optional[Callable[[dict], None]] = None, stage: Optional[str] = None):
+        self._on_event = on_event
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._parent: Optional["WorkflowProgress"] = None
+        self.stage = stage
+        self.tokens = 0
+        self._stage_tokens: dict[str, int] = {}
+
+    def for_stage(self, stage: str) -> "WorkflowProgress":
+        """
+        Прогресс одного этапа внутри пайплайна: свой счетчик токенов этапа,
+        но общий подписчик, общий флаг отмены и общий итог токенов у родителя.
+        """
+        child = WorkflowProgress(on_event=self._on_event, stage=stage)
+        child._cancel = self._cancel
+        child._parent = self
+        return child
+
+    def add_tokens(self, tokens: Optional[int], _stage: Optional[str] = None):
+        with self._lock:
+            self.tokens += tokens or 0
+            if _stage is not None:
+                self._stage_tokens[_stage] = self._stage_tokens.get(_stage, 0) + (tokens or 0)
+        if self._parent is not None:
+            self._parent.add_tokens(tokens, _stage=self.stage)
+
+    def tokens_by_stage(self) -> dict[str, int]:
+        """Токены задачи по этапам пайплайна; все, что потрачено не внутри этапа, — на self.stage."""
+        with self._lock:
+            by_stage = dict(self._stage_tokens)
+            rest = self.tokens - sum(by_stage.values())
+        if rest:
+            by_stage[self.stage or "workflow"] = by_stage.get(self.stage or "workflow", 0) + rest
+        return by_stage
+
+    @property
+    def total_tokens(self) -> int:
+        """Токены всей задачи (для этапа пайплайна — итог родителя)."""
+        return self._parent.total_tokens if self._parent is not None else self.tokens
+
+    def cancel(self):
+        """Просит workflow остановиться: он проверит флаг перед следующим вызовом LLM."""
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        """Поднимает WorkflowCancelled, если выполнение отменено. Вызывается между вызовами LLM."""
+        if self._cancel.is_set():
+            raise WorkflowCancelled(f"Выполнение {self.stage or 'workflow'} отменено")
+
+    def emit(self, event: str, **data):
+        """Отправляет событие подписчику. Ошибки подписчика не должны ронять workflow."""
+        if self._on_event is None:
+            return
+        payload = {"event": event, "stage": self.stage, "tokens": self.total_tokens, **data}
+        if self._parent is not None:
+            payload["stage_tokens"] = self.tokens
+        try:
+            self._on_event(payload)
+        except Exception as e:
+            logger.warning(f"Ошибка обработчика прогресса для события {event}: {e}")
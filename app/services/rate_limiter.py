@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Лимиты по умолчанию (requests per minute, input tokens per minute) для платного тарифа Gemini.
+# Переопределяются через GEMINI_RATE_LIMITS='{"gemini-2.5-pro": {"rpm": 150, "tpm": 2000000}}'
+DEFAULT_RATE_LIMITS = {
+    "gemini-2.5-flash": {"rpm": 1000, "tpm": 1_000_000},
+    "gemini-2.5-pro": {"rpm": 150, "tpm": 2_000_000},
+    "gemini-2.5-flash-lite": {"rpm": 4000, "tpm": 4_000_000},
+}
+FALLBACK_RATE_LIMIT = {
+    "rpm": int(os.environ.get("GEMINI_DEFAULT_RPM", 150)),
+    "tpm": int(os.environ.get("GEMINI_DEFAULT_TPM", 1_000_000)),
+}
+
+
+def _load_rate_limits() -> dict:
+    limits = {model: dict(limit) for model, limit in DEFAULT_RATE_LIMITS.items()}
+    raw = os.environ.get("GEMINI_RATE_LIMITS")
+    if raw:
+        try:
+            for model, limit in json.loads(raw).items():
+                limits.setdefault(model, dict(FALLBACK_RATE_LIMIT)).update(limit)
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Некорректный GEMINI_RATE_LIMITS, используются лимиты по умолчанию: {e}")
+    return limits
+
+
+class TokenBucket:
+    """Классическое ведро токенов: емкость capacity, пополняется равномерно за 60 секунд."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберется amount (0 — можно брать сейчас)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, delta: float):
+        """Возврат (delta > 0) или доплата (delta < 0) после сверки с реальным расходом."""
+        self._refill()
+        self.level = min(self.capacity, self.level + delta)
+
+
+class ModelRateLimiter:
+    """
+    Лимитер одной модели: ведра запросов и токенов в минуту плюс FIFO-очередь,
+    чтобы вызывающие потоки получали квоту по порядку прихода, а не наперегонки.
+    """
+
+    def __init__(self, model_name: str, rpm: int, tpm: int):
+        self.model_name = model_name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._queue = deque()
+
+    def acquire(self, estimated_tokens: int):
+        ticket = object()
+        started = time.monotonic()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    if self._queue[0] is ticket:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(estimated_tokens)
+                            break
+                    else:
+                        wait = None  # Ждем своей очереди — разбудит notify_all
+                    self._cond.wait(timeout=wait)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.info(f"Лимитер {self.model_name}: запрос ждал квоту {waited:.1f}с (~{estimated_tokens} токенов)")
+        return waited
+
+    def try_acquire(self, estimated_tokens: int) -> bool:
+        """Берет квоту без ожидания, если очередь пуста и в ведрах хватает места."""
+        with self._cond:
+            if self._queue or self.requests.wait_time(1) > 0 or self.tokens.wait_time(estimated_tokens) > 0:
+                return False
+            self.requests.take(1)
+            self.tokens.take(estimated_tokens)
+            return True
+
+    async def aacquire(self, estimated_tokens: int):
+        """
+        Асинхронный acquire для корутин. Пока квота есть, event loop не блокируется;
+        ждать квоту приходится в отдельном потоке, чтобы сохранить общую FIFO-очередь
+        с синхронными вызовами.
+        """
+        if self.try_acquire(estimated_tokens):
+            return 0.0
+        return await asyncio.to_thread(self.acquire, estimated_tokens)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int | None):
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+
+
+_limits = _load_rate_limits()
+_limiters: dict[str, ModelRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model_name: str) -> ModelRateLimiter:
+    with _limiters_lock:
+        if model_name not in _limiters:
+            limit = _limits.get(model_name, FALLBACK_RATE_LIMIT)
+            _limiters[model_name] = ModelRateLimiter(model_name, limit["rpm"], limit["tpm"])
+            logger.info(f"Лимитер для {model_name}: {limit['rpm']} RPM, {limit['tpm']} TPM")
+        return _limiters[model_name]
+
+
+def estimate_tokens(contents) -> int:
+    """
+    Грубая оценка входных токенов запроса до отправки: ~4 символа текста на токен,
+    для файлов — по размеру (PDF в Gemini заметно "дешевле" своего размера в байтах).
+    После ответа оценка сверяется с usage_metadata через reconcile().
+    """
+    total = 0
+    for item in contents or []:
+        if isinstance(item, str):
+            total += len(item) // 4
+            continue
+        mime_type = getattr(item, "mime_type", None)
+        size = getattr(item, "size_bytes", None)
+        inline = getattr(item, "inline_data", None)
+        if inline is not None and inline.data is not None:
+            mime_type, size = inline.mime_type, len(inline.data)
+        if size:
+            total += size // 4 if mime_type == "text/plain" else size // 100
+    return max(total, 1)
@@ -0,0 +1,217 @@
+"""
+Отложенная запись расхода токенов (write-behind).
+
+Списания копятся в памяти, сгруппированные по (user_id, день, модель, этап), и раз в
+USAGE_FLUSH_INTERVAL_SECONDS уходят в token_usage одним INSERT ... ON CONFLICT DO UPDATE.
+Каждое списание сначала дописывается в журнал на диске: если процесс упадет до записи
+в БД, журнал будет досписан при следующем запуске.
+
+Буфер и журнал — на процесс: при нескольких воркерах uvicorn каждый пишет свой журнал
+(в имени — pid) и сбрасывает только его. Журналы погибших процессов (и журналы без pid от
+прежних версий) забирает при старте тот воркер, который первым переименует их в свои —
+переименование атомарно, поэтому одну пачку не спишут дважды. Папка журналов — локальная
+папка одного хоста: живость владельца проверяется по pid.
+Журнал удаляется только после успешного commit. Падение ровно между commit и удалением
+файла приведет к повторному списанию этой пачки — пачка маленькая, а потерять расход хуже.
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from datetime import date
+from pathlib import Path
+
+from db.db import SessionLocal
+from db.crud_user import add_token_usage
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL_SECONDS", 5))
+# Журнал — в APP_CACHE_DIR (по умолчанию app/cache, как и кэш загрузок), а не относительно рабочей папки
+CACHE_DIR = Path(os.environ.get("APP_CACHE_DIR", Path(__file__).resolve().parent.parent / "cache"))
+USAGE_JOURNAL_FILE = Path(os.environ.get("USAGE_JOURNAL_FILE", CACHE_DIR / "token_usage_journal.jsonl"))
+
+_lock = threading.Lock()
+_pending: dict[tuple, int] = {}  # (user_id, day, model, stage) -> токены, еще не записанные в БД
+_flush_lock = threading.Lock()  # Один сброс за раз: фоновый поток и stop() не должны пересекаться
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def _journal_file() -> Path:
+    """Журнал этого процесса."""
+    return USAGE_JOURNAL_FILE.with_name(f"{USAGE_JOURNAL_FILE.name}.pid{os.getpid()}")
+
+
+def _journal_owner(path: Path) -> int | None:
+    """pid процесса, которому принадлежит журнал (текущий или переименованный к сбросу); 0 — журнал без pid."""
+    name = re.escape(USAGE_JOURNAL_FILE.name)
+    match = re.fullmatch(rf"{name}\.pid(\d+)(\.\d+)?", path.name)
+    if match:
+        return int(match.group(1))
+    return 0 if re.fullmatch(rf"{name}(\.\d+)?", path.name) else None
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Процесс есть, но чужой
+    return True
+
+
+def record(user_id: int, tokens: int, model: str = "unknown", stage: str = "unknown"):
+    """Списывает токены: в журнал на диске и в буфер. В БД попадут при ближайшем сбросе."""
+    if not tokens:
+        return
+    day = date.today().isoformat()
+    line = json.dumps({"user_id": user_id, "day": day, "model": model, "stage": stage, "tokens": tokens},
+                      ensure_ascii=False)
+    with _lock:
+        journal_file = _journal_file()
+        journal_file.parent.mkdir(parents=True, exist_ok=True)
+        journal = open(journal_file, "a", encoding="utf-8")
+        try:
+            journal.write(line + "\n")
+            journal.flush()
+        except BaseException:
+            journal.close()
+            raise
+        key = (user_id, day, model, stage)
+        _pending[key] = _pending.get(key, 0) + tokens
+    # fsync — вне лока, чтобы потоки с вызовами LLM не выстраивались в очередь за диском.
+    # Если flush() успел переименовать журнал, дескриптор указывает на тот же файл, строка уже в нем
+    try:
+        os.fsync(journal.fileno())
+    finally:
+        journal.close()
+    _ensure_started()
+
+
+def pending_usage(user_id: int) -> list[dict]:
+    """Еще не сброшенные в БД списания пользователя (чтобы отчеты о расходе не отставали)."""
+    with _lock:
+        return [{"day": day, "model": model, "stage": stage, "tokens": tokens}
+                for (uid, day, model, stage), tokens in _pending.items() if uid == user_id]
+
+
+def _read_journal(path: Path) -> dict[tuple, int]:
+    totals: dict[tuple, int] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Недописанная последняя строка после падения — пропускаем ее
+                logger.warning(f"Пропущена поврежденная строка {number} журнала {path}")
+                continue
+            key = (entry["user_id"], entry["day"], entry["model"], entry["stage"])
+            totals[key] = totals.get(key, 0) + entry["tokens"]
+    return totals
+
+
+def flush() -> int:
+    """
+    Записывает накопленное в БД одним запросом. Возвращает число записанных строк.
+    Журнал сначала переименовывается (новые списания идут в новый файл), затем
+    все переименованные журналы, включая оставшиеся от прошлых неудачных сбросов, суммируются.
+    """
+    with _flush_lock:
+        journal_file = _journal_file()
+        with _lock:
+            if journal_file.exists():
+                journal_file.rename(journal_file.with_name(f"{journal_file.name}.{time.time_ns()}"))
+            # Что покрывают переименованные журналы. Из буфера вычитается только после commit:
+            # пока запись в БД не прошла, pending_usage должен это показывать
+            flushing = dict(_pending)
+        # Только свои журналы: журналы соседних воркеров сбрасывают они сами
+        batches = sorted(journal_file.parent.glob(f"{journal_file.name}.*"))
+        if not batches:
+            return 0
+
+        totals: dict[tuple, int] = {}
+        for path in batches:
+            for key, tokens in _read_journal(path).items():
+                totals[key] = totals.get(key, 0) + tokens
+        rows = [{"user_id": user_id, "day": date.fromisoformat(day), "model": model, "stage": stage, "tokens": tokens}
+                for (user_id, day, model, stage), tokens in totals.items()]
+        try:
+            with SessionLocal() as db:
+                add_token_usage(db, rows)
+        except Exception as e:
+            # Журналы остаются на диске и войдут в следующий сброс
+            logger.error(f"Не удалось записать расход токенов ({len(rows)} строк), повтор при следующем сбросе: {e}")
+            return 0
+        with _lock:
+            for key, tokens in flushing.items():
+                left = _pending.get(key, 0) - tokens
+                if left > 0:
+                    _pending[key] = left
+                else:
+                    _pending.pop(key, None)
+        for path in batches:
+            path.unlink(missing_ok=True)
+        logger.info(f"Расход токенов записан в БД: {len(rows)} строк из {len(batches)} журналов")
+        return len(rows)
+
+
+def _flush_loop():
+    while not _stop.wait(USAGE_FLUSH_INTERVAL):
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Ошибка фонового сброса расхода токенов: {e}", exc_info=True)
+
+
+def _ensure_started():
+    global _thread
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_flush_loop, name="usage_flush", daemon=True)
+        _thread.start()
+
+
+def _claim_orphaned_journals() -> int:
+    """
+    Забирает себе журналы погибших процессов: переименовывает их в пачки своего журнала,
+    и они уходят в БД с ближайшим сбросом. Если журнал успел забрать соседний воркер,
+    переименование не найдет файла — пропускаем. Возвращает число забранных журналов.
+    """
+    if not USAGE_JOURNAL_FILE.parent.exists():
+        return 0
+    journal_file = _journal_file()
+    claimed = 0
+    for path in sorted(USAGE_JOURNAL_FILE.parent.glob(f"{USAGE_JOURNAL_FILE.name}*")):
+        owner = _journal_owner(path)
+        if owner is None or owner == os.getpid() or (owner and _process_alive(owner)):
+            continue
+        try:
+            path.rename(journal_file.with_name(f"{journal_file.name}.{time.time_ns()}"))
+        except FileNotFoundError:
+            continue
+        claimed += 1
+        logger.info(f"Журнал расхода {path.name} погибшего процесса будет досписан этим процессом")
+    return claimed
+
+
+def start():
+    """Запускает фоновый сброс и сразу досписывает журналы, оставшиеся от погибших процессов."""
+    _claim_orphaned_journals()
+    flush()
+    _ensure_started()
+
+
+def stop():
+    """Останавливает фоновый сброс и записывает остаток (вызывается при остановке сервера)."""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=USAGE_FLUSH_INTERVAL + 5)
+    flush()
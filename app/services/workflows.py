@@ -8,15 +8,33 @@ import re
 import os
 import shutil
 import glob
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from dataclasses import dataclass
+from contextlib import nullcontext
+from typing import Callable
 
 # Импорты из внешних модулей
-from services.gemini_api import upload_files, call_llm, upload_small_file, structured_call_llm
+from services.gemini_api import upload_files, upload_file, call_llm, upload_small_file, structured_call_llm, context_cache
+from services.gemini_api import aupload_files, aupload_file, acall_llm, astructured_call_llm, stream_call_llm
+from services.gemini_api import astream_call_llm, acontext_cache, run_async
 from services.preprompts import *
 from services.schemas import *
+from services.progress import WorkflowProgress, WorkflowCancelled
+from services import metrics
+from services.manifest import artifact_hash, prompt_version, load_manifest, record_stage, fingerprint_hash, file_sha256
 
 
 logger = logging.getLogger(__name__)
 
+# Сколько линз "слепых пятен" генерируется одновременно (линзы не зависят друг от друга)
+BLIND_SPOTS_CONCURRENCY = int(os.environ.get("BLIND_SPOTS_CONCURRENCY", 3))
+# Сколько серий пишется одновременно в режиме parallel_series
+SERIES_CONCURRENCY = int(os.environ.get("SERIES_CONCURRENCY", 3))
+# Сколько этапов пайплайна может выполняться одновременно (готовые по зависимостям этапы)
+PIPELINE_CONCURRENCY = int(os.environ.get("PIPELINE_CONCURRENCY", 2))
 
 
 # --- УТИЛИТЫ ---
@@ -37,9 +55,38 @@ def save_json(obj: dict | list, output_file: Path):
         json.dump(obj, f, ensure_ascii=False, indent=2)
     logger.info(f"JSON сохранен в {output_file}")
 
+def _stream_llm(progress: WorkflowProgress, event_fields: dict, **kwargs):
+    """
+    stream_call_llm, который рассылает дельты (text_delta) и обрывает генерацию при отмене.
+    Токены оборванного ответа (оценка) списываются сразу — их уже потратили.
+    """
+    def on_delta(delta):
+        progress.check_cancelled()
+        progress.emit("text_delta", delta=delta, **event_fields)
+    try:
+        return stream_call_llm(on_delta=on_delta, **kwargs)
+    except WorkflowCancelled as e:
+        progress.add_tokens(getattr(e, "partial_tokens", 0))
+        raise
+
+async def _astream_llm(progress: WorkflowProgress, event_fields: dict, **kwargs):
+    """
+    _stream_llm на astream_call_llm. text_delta только рассылается подписчикам (в БД не пишется),
+    поэтому его можно отправлять прямо из цикла событий.
+    """
+    def on_delta(delta):
+        progress.check_cancelled()
+        progress.emit("text_delta", delta=delta, **event_fields)
+    try:
+        return await astream_call_llm(on_delta=on_delta, **kwargs)
+    except WorkflowCancelled as e:
+        progress.add_tokens(getattr(e, "partial_tokens", 0))
+        raise
+
         
 # --- ПОИСК ДОП ФАКТОВ ---
-def expand_database(topic_path: str, llm_model_name: str) -> Path | None:
+def expand_database(topic_path: str, llm_model_name: str, progress: WorkflowProgress | None = None) -> Path | None:
+    progress = progress or WorkflowProgress()
     folder_path = Path(topic_path)
     folder_path_bd = ensure_directory(folder_path / "DB")
     if not os.listdir(folder_path_bd) or os.listdir(folder_path_bd) == "db_extension.txt":
@@ -50,6 +97,7 @@ def expand_database(topic_path: str, llm_model_name: str) -> Path | None:
     file_paths = [str(file.resolve()) for file in folder_path_bd.iterdir() if file.is_file() and file.stem != "db_extension"]
     uploaded_files = upload_files(file_paths)
     prompt = get_stage1_prompt()
+    progress.check_cancelled()
     status, response, total_tokens = call_llm(
         prompt, files=uploaded_files, 
         model_name=llm_model_name, 
@@ -60,14 +108,60 @@ def expand_database(topic_path: str, llm_model_name: str) -> Path | None:
         logger.error(f"Ошибка при расширении БД: {status}")
         return None, None
     save_text(response, output_file)
+    progress.add_tokens(total_tokens)
+    progress.emit("step_done", step=1, total=1)
+    return status, total_tokens
+
+async def aexpand_database(topic_path: str, llm_model_name: str, progress: WorkflowProgress | None = None):
+    """Асинхронный expand_database на acall_llm/aupload_files."""
+    progress = progress or WorkflowProgress()
+    folder_path = Path(topic_path)
+    folder_path_bd = ensure_directory(folder_path / "DB")
+    if not os.listdir(folder_path_bd) or os.listdir(folder_path_bd) == "db_extension.txt":
+        logger.error(f"Папка проекта {folder_path} пуста")
+        return "Нет загруженных файлов базы данных", None
+    output_file = folder_path_bd / "db_extension.txt"
+
+    file_paths = [str(file.resolve()) for file in folder_path_bd.iterdir() if file.is_file() and file.stem != "db_extension"]
+    uploaded_files = await aupload_files(file_paths)
+    prompt = get_stage1_prompt()
+    progress.check_cancelled()
+    status, response, total_tokens = await acall_llm(
+        prompt, files=uploaded_files,
+        model_name=llm_model_name,
+        temperature=0.2,
+        web_search=False
+    )
+    if status != "success":
+        logger.error(f"Ошибка при расширении БД: {status}")
+        return None, None
+    # Запись файла и событие прогресса (у задачи оно пишется в БД) — вне общего цикла событий
+    await asyncio.to_thread(save_text, response, output_file)
+    progress.add_tokens(total_tokens)
+    await asyncio.to_thread(progress.emit, "step_done", step=1, total=1)
     return status, total_tokens
 
 
 # --- ПОИСК НЕОЧЕВИДНЫХ СВЯЗЕЙ ---
+def _lens_number(file_name: str) -> int:
+    """Достает номер линзы из имени файла (lens_3_main.txt -> 3) для сортировки."""
+    match = re.search(r"(\d+)", file_name)
+    return int(match.group(1)) if match else 0
+
+def _collect_prompts(get_prompt) -> List[str]:
+    """Собирает промпты всех линз: get_prompt(lens_num) возвращает None после последней."""
+    prompts = []
+    while prompt := get_prompt(lens_num=len(prompts) + 1):
+        prompts.append(prompt)
+    return prompts
+
 def connect_lenses(lens_folder: Path, output_file: Path):
     """Объединяет файлы линз в один выходной файл и удаляет папку линз."""
     try:
-        txt_files = [lens_folder / f for f in os.listdir(lens_folder) if f.endswith('.txt')]
+        txt_files = sorted(
+            (lens_folder / f for f in os.listdir(lens_folder) if f.endswith('.txt')),
+            key=lambda p: _lens_number(p.name)
+        )
         
         if not txt_files:
             logger.warning(f"В папке '{lens_folder}' не найдено .txt файлов.")
@@ -90,7 +184,8 @@ def connect_lenses(lens_folder: Path, output_file: Path):
     except Exception as e:
         logger.error(f"Произошла непредвиденная ошибка: {e}")
 
-def find_connections_main(topic_path: str, llm_model_name: str) -> Path | None:
+def find_connections_main(topic_path: str, llm_model_name: str, progress: WorkflowProgress | None = None) -> Path | None:
+    progress = progress or WorkflowProgress()
     output_folder = ensure_directory(Path(topic_path) / "FACTS" / "ALG_MAIN" / "HYP")
     output_folder_lens = ensure_directory(output_folder / "LENS")
 
@@ -101,25 +196,27 @@ def find_connections_main(topic_path: str, llm_model_name: str) -> Path | None:
     file_paths = [str(file.resolve()) for file in folder.iterdir() if file.is_file()]
     uploaded_files = upload_files(file_paths)
 
-    lens = 0
+    prompts = _collect_prompts(get_stage2_prompt_main)
     tokens=0
-    while True:
-        lens += 1
-        prompt = get_stage2_prompt_main(lens_num=lens)
-        if not prompt:
-            break
-        status, response, total_tokens = call_llm(
-            prompt, files=uploaded_files, 
+    for lens, prompt in enumerate(prompts, 1):
+        progress.check_cancelled()
+        lens_file = output_folder_lens / f"lens_{lens}_main.txt"
+        # Линза пишется в файл и уходит подписчикам по мере генерации
+        status, response, total_tokens = _stream_llm(
+            progress, {"lens": lens},
+            prompt=prompt, files=uploaded_files, 
             model_name=llm_model_name, 
             temperature=1.5,
-            web_search=False
+            web_search=False,
+            output_file=lens_file
         )
         if status != "success":
             logger.error(f"Ошибка при генерации линзы {lens} (main): {status}")
             return status, tokens
         tokens+=total_tokens
-        lens_file = output_folder_lens / f"lens_{lens}_main.txt"
-        save_text(response, lens_file)
+        logger.info(f"Текст сохранен в {lens_file}")
+        progress.add_tokens(total_tokens)
+        progress.emit("lens_done", lens=lens, total=len(prompts), text=response)
         
         # Обновление файлов для следующей итерации
         db_ext = Path(topic_path) / "DB" / "db_extension.txt" 
@@ -133,8 +230,10 @@ def find_connections_main(topic_path: str, llm_model_name: str) -> Path | None:
     save_text(response, output_file)
     return status, tokens
 
-def find_connections_blind_spots(topic_path: str, llm_model_name: str) -> Path | None:
-    output_folder = ensure_directory(Path(topic_path) / "FACTS" / "ALG_BLIND" / "HYP")
+async def afind_connections_main(topic_path: str, llm_model_name: str, progress: WorkflowProgress | None = None):
+    """Асинхронный find_connections_main: линзы по-прежнему по очереди (каждая опирается на предыдущую)."""
+    progress = progress or WorkflowProgress()
+    output_folder = ensure_directory(Path(topic_path) / "FACTS" / "ALG_MAIN" / "HYP")
     output_folder_lens = ensure_directory(output_folder / "LENS")
 
     folder = Path(f"{topic_path}/DB")
@@ -142,33 +241,173 @@ def find_connections_blind_spots(topic_path: str, llm_model_name: str) -> Path |
         logger.error(f"Папка проекта {folder} пуста или не существует")
         return "Нет загруженных файлов базы данных", None
     file_paths = [str(file.resolve()) for file in folder.iterdir() if file.is_file()]
-    uploaded_files = upload_files(file_paths)
+    uploaded_files = await aupload_files(file_paths)
 
-    lens = 0
+    prompts = _collect_prompts(get_stage2_prompt_main)
     tokens = 0
-    while True:
-        lens += 1
-        prompt = get_stage2_prompt_blind_spots(lens_num=lens)
-        if not prompt:
-            break
-        status, response, total_tokens = call_llm(
-            prompt, files=uploaded_files, 
-            model_name=llm_model_name, 
+    for lens, prompt in enumerate(prompts, 1):
+        progress.check_cancelled()
+        lens_file = output_folder_lens / f"lens_{lens}_main.txt"
+        status, response, total_tokens = await _astream_llm(
+            progress, {"lens": lens},
+            prompt=prompt, files=uploaded_files,
+            model_name=llm_model_name,
             temperature=1.5,
-            web_search=False
+            web_search=False,
+            output_file=lens_file
         )
         if status != "success":
-            logger.error(f"Ошибка при генерации линзы {lens} (blind spots): {status}")
-            return status, total_tokens
+            logger.error(f"Ошибка при генерации линзы {lens} (main): {status}")
+            return status, tokens
         tokens += total_tokens
-        lens_file = output_folder_lens / f"lens_{lens}_blind_spots.txt"
-        save_text(response, lens_file)
-    
+        logger.info(f"Текст сохранен в {lens_file}")
+        progress.add_tokens(total_tokens)
+        await asyncio.to_thread(progress.emit, "lens_done", lens=lens, total=len(prompts), text=response)
+
+        db_ext = Path(topic_path) / "DB" / "db_extension.txt"
+        if lens == 1:
+            uploaded_files = await aupload_files([lens_file, db_ext])
+        else:
+            uploaded_files = await asyncio.to_thread(upload_small_file, lens_file)
+
+    output_file = output_folder / "db_facts.txt"
+    await asyncio.to_thread(save_text, response, output_file)
+    return status, tokens
+
+def find_connections_blind_spots(topic_path: str, llm_model_name: str, max_workers: int | None = None,
+                                 progress: WorkflowProgress | None = None) -> Path | None:
+    progress = progress or WorkflowProgress()
+    output_folder = ensure_directory(Path(topic_path) / "FACTS" / "ALG_BLIND" / "HYP")
+    output_folder_lens = ensure_directory(output_folder / "LENS")
+
+    folder = Path(f"{topic_path}/DB")
+    if not os.listdir(folder) or os.listdir(folder) == "db_extension.txt" or not os.path.isdir(folder):
+        logger.error(f"Папка проекта {folder} пуста или не существует")
+        return "Нет загруженных файлов базы данных", None
+    file_paths = [str(file.resolve()) for file in folder.iterdir() if file.is_file()]
+    uploaded_files = upload_files(file_paths)
+
+    prompts = _collect_prompts(get_stage2_prompt_blind_spots)
+
+    # Линзы независимы друг от друга: все опираются только на файлы DB,
+    # поэтому запускаем их параллельно в ограниченном пуле (ретраи 429 — внутри call_llm)
+    workers = max(1, min(max_workers or BLIND_SPOTS_CONCURRENCY, len(prompts)))
+    logger.info(f"Запуск {len(prompts)} линз (blind spots) с параллельностью {workers}")
+    tokens_before = progress.tokens
+    # Все линзы отправляют одни и те же файлы DB — кладем их в кэш контекста один раз
+    with context_cache(uploaded_files, llm_model_name) as context, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="blind_lens") as executor:
+        def run_lens(prompt):
+            progress.check_cancelled()
+            result = call_llm(
+                prompt, files=uploaded_files,
+                model_name=llm_model_name,
+                temperature=1.5,
+                web_search=False,
+                context=context
+            )
+            # Списываем сразу: при отмене уже выполненные запросы тоже оплачены
+            progress.add_tokens(result[2])
+            return result
+
+        # copy_context — чтобы вызовы LLM в потоках пула числились за текущим этапом в метриках
+        futures = [executor.submit(contextvars.copy_context().run, run_lens, prompt) for prompt in prompts]
+
+        # Результаты записываем строго в порядке линз
+        status = "success"
+        for lens, future in enumerate(futures, 1):
+            try:
+                status, response, total_tokens = future.result()
+            except WorkflowCancelled:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            if status != "success":
+                logger.error(f"Ошибка при генерации линзы {lens} (blind spots): {status}")
+                for pending in futures:
+                    pending.cancel()
+                break
+            lens_file = output_folder_lens / f"lens_{lens}_blind_spots.txt"
+            save_text(response, lens_file)
+            progress.emit("lens_done", lens=lens, total=len(prompts), text=response)
+
+    # Считаем по прогрессу и после выхода из пула: линзы, уже ушедшие в работу параллельно
+    # упавшей, тоже оплачены, даже если их результат не понадобился
+    tokens = progress.tokens - tokens_before
+    if status != "success":
+        return status, tokens
     # После цикла: объединение линз
     output_file = output_folder / "db_facts.txt"
     connect_lenses(output_folder_lens, output_file)
     return status, tokens
 
+async def afind_connections_blind_spots(topic_path: str, llm_model_name: str, max_workers: int | None = None,
+                                        progress: WorkflowProgress | None = None):
+    """
+    Асинхронный find_connections_blind_spots: линзы — корутины в одном event loop,
+    одновременно в полете не больше max_workers запросов (семафор вместо пула потоков).
+    """
+    progress = progress or WorkflowProgress()
+    output_folder = ensure_directory(Path(topic_path) / "FACTS" / "ALG_BLIND" / "HYP")
+    output_folder_lens = ensure_directory(output_folder / "LENS")
+
+    folder = Path(f"{topic_path}/DB")
+    if not os.listdir(folder) or os.listdir(folder) == "db_extension.txt" or not os.path.isdir(folder):
+        logger.error(f"Папка проекта {folder} пуста или не существует")
+        return "Нет загруженных файлов базы данных", None
+    file_paths = [str(file.resolve()) for file in folder.iterdir() if file.is_file()]
+    uploaded_files = await aupload_files(file_paths)
+
+    prompts = _collect_prompts(get_stage2_prompt_blind_spots)
+    workers = max(1, max_workers or BLIND_SPOTS_CONCURRENCY)
+    semaphore = asyncio.Semaphore(workers)
+    logger.info(f"Запуск {len(prompts)} линз (blind spots, async) с параллельностью {workers}")
+    tokens_before = progress.tokens
+
+    async with acontext_cache(uploaded_files, llm_model_name) as context:
+        async def run_lens(prompt):
+            async with semaphore:
+                progress.check_cancelled()
+                result = await acall_llm(
+                    prompt, files=uploaded_files,
+                    model_name=llm_model_name,
+                    temperature=1.5,
+                    web_search=False,
+                    context=context
+                )
+                progress.add_tokens(result[2])
+                return result
+
+        tasks = [asyncio.create_task(run_lens(prompt)) for prompt in prompts]
+
+        # Результаты записываем строго в порядке линз
+        status = "success"
+        for lens, task in enumerate(tasks, 1):
+            try:
+                status, response, total_tokens = await task
+            except WorkflowCancelled:
+                for pending in tasks:
+                    pending.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            if status != "success":
+                logger.error(f"Ошибка при генерации линзы {lens} (blind spots): {status}")
+                for pending in tasks:
+                    pending.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                break
+            lens_file = output_folder_lens / f"lens_{lens}_blind_spots.txt"
+            await asyncio.to_thread(save_text, response, lens_file)
+            await asyncio.to_thread(progress.emit, "lens_done", lens=lens, total=len(prompts), text=response)
+
+    # Как и в синхронном варианте — по прогрессу, вместе с завершившимися параллельно линзами
+    tokens = progress.tokens - tokens_before
+    if status != "success":
+        return status, tokens
+    output_file = output_folder / "db_facts.txt"
+    await asyncio.to_thread(connect_lenses, output_folder_lens, output_file)
+    return status, tokens
+
 
 # --- ПРОВЕРКА ГИПОТЕЗ ---
 def extract_blocks(text: str, start_tag: str, end_tag: str) -> List[str]:
@@ -205,7 +444,9 @@ def connect_check_hypothese_results(folder_lenses: Path, file_hypothesis: str, o
     shutil.rmtree(folder_lenses)
     return True
 
-def check_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["blind_spots", "main"]) -> Path | None:
+def check_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["blind_spots", "main"],
+                     progress: WorkflowProgress | None = None) -> Path | None:
+    progress = progress or WorkflowProgress()
     alg_folder = "ALG_MAIN" if facts_type == "main" else "ALG_BLIND"
     output_path = ensure_directory(Path(topic_path) / "FACTS" / alg_folder / "CHECK")  
     output_path_lens = ensure_directory(output_path / "LENS")
@@ -216,13 +457,10 @@ def check_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["
     file_paths = [f"{folder_hypothesis}/db_facts.txt"]
     uploaded_files = upload_files(file_paths)
     
+    prompts = _collect_prompts(get_stage3_prompt)
     tokens = 0
-    lens = 0
-    while True:
-        lens += 1
-        prompt = get_stage3_prompt(lens_num=lens)
-        if not prompt:
-            break
+    for lens, prompt in enumerate(prompts, 1):
+        progress.check_cancelled()
         status, response, total_tokens = call_llm(
             prompt, files=uploaded_files, 
             web_search=True, model_name=llm_model_name,
@@ -234,9 +472,19 @@ def check_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["
         tokens += total_tokens
         output_file = output_path_lens / f"db_facts_checked_{lens}.txt"
         save_text(response, output_file)
-        file_paths.append(output_file)
-        uploaded_files = upload_files(file_paths)
+        # Загружаем только результат нового раунда, ссылки на прежние файлы переиспользуем:
+        # раньше каждый раунд заново отправлял db_facts.txt и все предыдущие проверки
+        # (после последнего раунда файл уже никому не нужен)
+        round_bytes = 0
+        if lens < len(prompts):
+            round_file, round_bytes = upload_file(output_file)
+            logger.info(f"Раунд {lens}: отправлено {round_bytes} байт"
+                        f"{' (файл уже был в кэше загрузок)' if not round_bytes else ''}, "
+                        f"переиспользовано ранее загруженных файлов: {len(uploaded_files)}")
+            uploaded_files = uploaded_files + [round_file]
         logger.info(f"Проверенные гипотезы сохранены в {output_file}")
+        progress.add_tokens(total_tokens)
+        progress.emit("check_round_done", round=lens, total=len(prompts), text=response, bytes_sent=round_bytes)
     
     output_file = output_path / "db_facts_checked.txt"
     connect_check_hypothese_results(
@@ -246,13 +494,58 @@ def check_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["
     )
     return status, tokens
 
+async def acheck_hypotheses(topic_path: str, llm_model_name: str, facts_type: Literal["blind_spots", "main"],
+                            progress: WorkflowProgress | None = None):
+    """Асинхронный check_hypotheses: раунды по очереди, каждый догружает только свой результат."""
+    progress = progress or WorkflowProgress()
+    alg_folder = "ALG_MAIN" if facts_type == "main" else "ALG_BLIND"
+    output_path = ensure_directory(Path(topic_path) / "FACTS" / alg_folder / "CHECK")
+    output_path_lens = ensure_directory(output_path / "LENS")
+    folder_hypothesis = f"{topic_path}/FACTS/{alg_folder}/HYP"
+    if not os.listdir(folder_hypothesis) or not os.path.isdir(folder_hypothesis):
+        logger.error(f"Папка проекта {folder_hypothesis} пуста или не существует")
+        return "Нет загруженных файлов базы данных", None
+    uploaded_files = await aupload_files([f"{folder_hypothesis}/db_facts.txt"])
 
-# --- СОЗДАНИЕ СТРУКТУРЫ СЦЕНАРИЯ ---
-def build_script_structure(topic_path: str, num_series: int, llm_model_name: str):
-    output_dir = ensure_directory(Path(topic_path) / "STRUCTURE")
-    output_file_json = output_dir / "script_structure.json"
-    output_file_txt = output_dir / "script_structure.txt"
+    prompts = _collect_prompts(get_stage3_prompt)
+    tokens = 0
+    for lens, prompt in enumerate(prompts, 1):
+        progress.check_cancelled()
+        status, response, total_tokens = await acall_llm(
+            prompt, files=uploaded_files,
+            web_search=True, model_name=llm_model_name,
+            temperature=0.2
+        )
+        if status != "success":
+            logger.error(f"Ошибка при проверке линзы {lens}: {status}")
+            return status, tokens
+        tokens += total_tokens
+        output_file = output_path_lens / f"db_facts_checked_{lens}.txt"
+        await asyncio.to_thread(save_text, response, output_file)
+        round_bytes = 0
+        if lens < len(prompts):
+            round_file, round_bytes = await aupload_file(output_file)
+            logger.info(f"Раунд {lens}: отправлено {round_bytes} байт"
+                        f"{' (файл уже был в кэше загрузок)' if not round_bytes else ''}, "
+                        f"переиспользовано ранее загруженных файлов: {len(uploaded_files)}")
+            uploaded_files = uploaded_files + [round_file]
+        logger.info(f"Проверенные гипотезы сохранены в {output_file}")
+        progress.add_tokens(total_tokens)
+        await asyncio.to_thread(progress.emit, "check_round_done", round=lens, total=len(prompts), text=response,
+                                bytes_sent=round_bytes)
 
+    await asyncio.to_thread(
+        connect_check_hypothese_results,
+        folder_lenses=output_path_lens,
+        file_hypothesis=f"{folder_hypothesis}/db_facts.txt",
+        output_file=output_path / "db_facts_checked.txt"
+    )
+    return status, tokens
+
+
+# --- СОЗДАНИЕ СТРУКТУРЫ СЦЕНАРИЯ ---
+def _script_structure_inputs(topic_path: str) -> tuple[List[str] | None, bool]:
+    """Файлы для структуры сценария: DB, проверенные факты и, если есть, гипотезы blind spots."""
     folder = Path(f"{topic_path}/DB")
     file_paths = [str(file.resolve()) for file in folder.iterdir() if file.is_file()]
     #paths_facts = glob.glob(os.path.join(f"{topic_path}/FACTS", "ALG*/CHECK/db_facts_checked.txt"))
@@ -260,15 +553,25 @@ def build_script_structure(topic_path: str, num_series: int, llm_model_name: str
 
     if not os.path.exists(paths_facts):
         logger.error(f"Факты не проверены или не созданы {paths_facts} пуста или не существует")
-        return "Факты не проверены или не созданы", None
+        return None, False
     file_paths.extend([str(paths_facts)])
     blind_spots = False
     if os.path.exists(os.path.join(f"{topic_path}/FACTS", "ALG_BLIND/HYP/db_facts.txt")):
         blind_spots = True
         file_paths.extend([os.path.join(f"{topic_path}/FACTS", "ALG_BLIND/HYP/db_facts.txt")])
+    return file_paths, blind_spots
+
+def build_script_structure(topic_path: str, num_series: int, llm_model_name: str,
+                           progress: WorkflowProgress | None = None):
+    progress = progress or WorkflowProgress()
+    output_dir = ensure_directory(Path(topic_path) / "STRUCTURE")
+    file_paths, blind_spots = _script_structure_inputs(topic_path)
+    if file_paths is None:
+        return "Факты не проверены или не созданы", None
 
     uploaded_files = upload_files(file_paths)
     prompt = get_stage4_prompt(num_series, blind_spots=blind_spots)
+    progress.check_cancelled()
     status, response, total_tokens = structured_call_llm(prompt, files=uploaded_files, structure=list[ScriptStructure],
                                     max_output_tokens=65536,
                                     model_name=llm_model_name,
@@ -281,6 +584,44 @@ def build_script_structure(topic_path: str, num_series: int, llm_model_name: str
     except Exception as e:
         logger.error(f"Ошибка при парсинге ответа: {e}")
         return "error", total_tokens
+    _save_script_structure(scripts, output_dir)
+    progress.add_tokens(total_tokens)
+    progress.emit("step_done", step=1, total=1)
+    return status, total_tokens
+
+async def abuild_script_structure(topic_path: str, num_series: int, llm_model_name: str,
+                                  progress: WorkflowProgress | None = None):
+    """Асинхронный build_script_structure на astructured_call_llm."""
+    progress = progress or WorkflowProgress()
+    output_dir = ensure_directory(Path(topic_path) / "STRUCTURE")
+    file_paths, blind_spots = _script_structure_inputs(topic_path)
+    if file_paths is None:
+        return "Факты не проверены или не созданы", None
+
+    uploaded_files = await aupload_files(file_paths)
+    prompt = get_stage4_prompt(num_series, blind_spots=blind_spots)
+    progress.check_cancelled()
+    status, response, total_tokens = await astructured_call_llm(
+        prompt, files=uploaded_files, structure=list[ScriptStructure],
+        max_output_tokens=65536,
+        model_name=llm_model_name,
+        temperature=1)
+    if status != "success":
+        logger.error(f"Ошибка при создании структуры сценария: {status}")
+        return status, total_tokens
+    try:
+        scripts: list[ScriptStructure] = response.parsed
+    except Exception as e:
+        logger.error(f"Ошибка при парсинге ответа: {e}")
+        return "error", total_tokens
+    await asyncio.to_thread(_save_script_structure, scripts, output_dir)
+    progress.add_tokens(total_tokens)
+    await asyncio.to_thread(progress.emit, "step_done", step=1, total=1)
+    return status, total_tokens
+
+def _save_script_structure(scripts: list[ScriptStructure], output_dir: Path):
+    """Сохраняет структуру с присвоенными id в script_structure.json и ее текстовую копию .txt."""
+    output_file_json = output_dir / "script_structure.json"
     scripts_raw = [script.model_dump() for script in scripts]
     scripts_with_ids: List[ScriptStructureID] = [
     ScriptStructureID.model_validate(script) for script in scripts_raw]
@@ -291,19 +632,21 @@ def build_script_structure(topic_path: str, num_series: int, llm_model_name: str
         indent=2, 
         ensure_ascii=False
     )
-    save_text(json_string, output_file_txt)
+    save_text(json_string, output_dir / "script_structure.txt")
     print(f"Структура сценария сохранена в {output_file_json}")
-    return status, total_tokens
 
 
 # --- НАПИСАНИЕ ТЕКСТА СЦЕНАРИЯ ---
-def scenario_to_docx(output_dir: str):
+def scenario_to_docx(output_dir: str, serie_numbers: set[int] | None = None):
+    """Рендерит Серия_N.docx из scenario.json. serie_numbers — только эти серии (None — все)."""
     output_path = Path(output_dir)
     input_file = output_path / "scenario.json"
     with open(input_file, "r", encoding="utf-8") as f:
         data = json.load(f)
 
     for serie in data:
+        if serie_numbers is not None and serie["serie_number"] not in serie_numbers:
+            continue
         doc = Document()
         serie_title = f"{serie['serie_number']}. {serie['serie_name']}"
         doc.add_heading(serie_title, level=0)
@@ -383,15 +726,154 @@ def update_json_structure(topic_path: str) -> bool:
         logger.error(f"Ошибка записи в JSON файл: {e}")
         return False
 
-def write_script_text(topic_path: str, llm_model_name: str, temperature: float):
+def _chapter_checkpoint_path(checkpoint_dir: Path, serie_number: int, chapter_number: int) -> Path:
+    return checkpoint_dir / f"serie_{serie_number}_chapter_{chapter_number}.json"
+
+def _load_chapter_checkpoint(path: Path, structure_hash: str) -> str | None:
+    """Возвращает текст главы из чекпоинта, если он создан по той же структуре сценария."""
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"Поврежденный чекпоинт {path}: {e}")
+        return None
+    if checkpoint.get("structure_hash") != structure_hash:
+        logger.info(f"Чекпоинт {path} создан по другой структуре сценария, глава будет написана заново")
+        return None
+    return checkpoint.get("text")
+
+def _write_serie_text(serie: ScenarioStructure, previous_chapter_text: str, first_index: int, total_chapters: int,
+                      uploaded_files, llm_model_name: str, temperature: float, resume: bool,
+                      checkpoint_dir: Path, structure_hash: str, progress: WorkflowProgress,
+                      context=None, stop: threading.Event | None = None) -> tuple[str | None, int, str]:
+    """
+    Последовательно пишет главы одной серии (каждая глава опирается на текст предыдущей).
+    stop — остановиться перед следующей главой (соседняя серия упала в режиме parallel_series).
+    Возвращает (status, tokens, текст последней главы).
+    """
+    s = serie.serie_number
+    tokens = 0
+    for chapter_index, target_chapter in enumerate(serie.content, first_index):
+        ch = target_chapter.chapter_number
+        if stop is not None and stop.is_set():
+            logger.info(f"Серия {s} остановлена перед главой {ch}: другая серия завершилась ошибкой")
+            return None, tokens, previous_chapter_text
+        checkpoint_path = _chapter_checkpoint_path(checkpoint_dir, s, ch)
+
+        if resume:
+            saved_text = _load_chapter_checkpoint(checkpoint_path, structure_hash)
+            if saved_text is not None:
+                logger.info(f"Глава {ch} серии {s} взята из чекпоинта")
+                target_chapter.text = saved_text
+                previous_chapter_text = saved_text
+                progress.emit("chapter_done", serie=s, chapter=ch, index=chapter_index, total=total_chapters,
+                              text=saved_text, resumed=True)
+                continue
+
+        progress.check_cancelled()
+        prompt = get_stage5_prompt(ser=s, ch=ch, previous_chapter_text=previous_chapter_text)
+        # Текст главы стримится в SERIE_CHAPTER.txt рядом с чекпоинтом и подписчикам (text_delta)
+        status, response, total_tokens = _stream_llm(
+            progress, {"serie": s, "chapter": ch},
+            prompt=prompt, files=uploaded_files, 
+            model_name=llm_model_name, 
+            temperature=temperature,
+            context=context,
+            output_file=checkpoint_path.with_suffix(".txt")
+        )
+        if status != "success":
+            logger.error(f"Ошибка при написании главы {ch} серии {s}: {status}")
+            return None, tokens, previous_chapter_text
+        tokens += total_tokens
+        target_chapter.text = response
+        previous_chapter_text = response
+        save_json({
+            "structure_hash": structure_hash,
+            "serie_number": s,
+            "chapter_number": ch,
+            "text": response,
+            "tokens": total_tokens,
+        }, checkpoint_path)
+        progress.add_tokens(total_tokens)
+        progress.emit("chapter_done", serie=s, chapter=ch, index=chapter_index, total=total_chapters, text=response)
+    return "success", tokens, previous_chapter_text
+
+async def _awrite_serie_text(serie: ScenarioStructure, previous_chapter_text: str, first_index: int, total_chapters: int,
+                             uploaded_files, llm_model_name: str, temperature: float, resume: bool,
+                             checkpoint_dir: Path, structure_hash: str, progress: WorkflowProgress,
+                             context=None, stop: asyncio.Event | None = None) -> tuple[str | None, int, str]:
+    """Асинхронный _write_serie_text: главы серии по очереди, чекпоинты и события — вне цикла событий."""
+    s = serie.serie_number
+    tokens = 0
+    for chapter_index, target_chapter in enumerate(serie.content, first_index):
+        ch = target_chapter.chapter_number
+        if stop is not None and stop.is_set():
+            logger.info(f"Серия {s} остановлена перед главой {ch}: другая серия завершилась ошибкой")
+            return None, tokens, previous_chapter_text
+        checkpoint_path = _chapter_checkpoint_path(checkpoint_dir, s, ch)
+
+        if resume:
+            saved_text = await asyncio.to_thread(_load_chapter_checkpoint, checkpoint_path, structure_hash)
+            if saved_text is not None:
+                logger.info(f"Глава {ch} серии {s} взята из чекпоинта")
+                target_chapter.text = saved_text
+                previous_chapter_text = saved_text
+                await asyncio.to_thread(progress.emit, "chapter_done", serie=s, chapter=ch, index=chapter_index,
+                                        total=total_chapters, text=saved_text, resumed=True)
+                continue
+
+        progress.check_cancelled()
+        prompt = get_stage5_prompt(ser=s, ch=ch, previous_chapter_text=previous_chapter_text)
+        status, response, total_tokens = await _astream_llm(
+            progress, {"serie": s, "chapter": ch},
+            prompt=prompt, files=uploaded_files,
+            model_name=llm_model_name,
+            temperature=temperature,
+            context=context,
+            output_file=checkpoint_path.with_suffix(".txt")
+        )
+        if status != "success":
+            logger.error(f"Ошибка при написании главы {ch} серии {s}: {status}")
+            return None, tokens, previous_chapter_text
+        tokens += total_tokens
+        target_chapter.text = response
+        previous_chapter_text = response
+        await asyncio.to_thread(save_json, {
+            "structure_hash": structure_hash,
+            "serie_number": s,
+            "chapter_number": ch,
+            "text": response,
+            "tokens": total_tokens,
+        }, checkpoint_path)
+        progress.add_tokens(total_tokens)
+        await asyncio.to_thread(progress.emit, "chapter_done", serie=s, chapter=ch, index=chapter_index,
+                                total=total_chapters, text=response)
+    return "success", tokens, previous_chapter_text
+
+@dataclass
+class _ScenarioPlan:
+    """Что нужно для написания сценария: файлы для загрузки, серии по структуре и папка чекпоинтов."""
+    file_paths: List[str]
+    scenario_data: List[ScenarioStructure]
+    first_indexes: List[int]
+    total_chapters: int
+    checkpoint_dir: Path
+    structure_hash: str
+
+
+def _prepare_scenario(topic_path: str, resume: bool) -> _ScenarioPlan | None:
+    """Пересобирает json структуры, готовит папку SCENARIO (без resume — с нуля) и план глав."""
     if not update_json_structure(topic_path=topic_path):
-        return None, 0
+        return None
     
     folder = Path(topic_path) / "SCENARIO"
-    if folder.exists():
+    if folder.exists() and not resume:
         shutil.rmtree(folder)
     output_dir = ensure_directory(folder)
-    output_file_json = output_dir / "scenario.json"
+    checkpoint_dir = ensure_directory(output_dir / "CHAPTERS")
+    structure_hash = file_sha256(f"{topic_path}/STRUCTURE/script_structure.json")
     
     folder_db = Path(topic_path) / "DB"
     file_paths = [str(file.resolve()) for file in folder_db.iterdir() if file.is_file()]
@@ -399,40 +881,529 @@ def write_script_text(topic_path: str, llm_model_name: str, temperature: float):
     paths_facts = os.path.join(f"{topic_path}/FACTS", "ALG_MAIN/CHECK/db_facts_checked.txt")
     file_paths.extend([paths_facts])
     file_paths.append(f"{topic_path}/STRUCTURE/script_structure.txt")
-    uploaded_files = upload_files(file_paths)
 
     chapters_per_serie, scenario_data = get_chapters_per_serie_from_file(f"{topic_path}/STRUCTURE/script_structure.json")
 
-    previous_chapter_text = ""
-    tokens = 0
-    for s in chapters_per_serie:
-        for ch in range(1, chapters_per_serie[s] + 1):
-            prompt = get_stage5_prompt(ser=s, ch=ch, previous_chapter_text=previous_chapter_text)
-            status, response, total_tokens = call_llm(
-                prompt, files=uploaded_files, 
-                model_name=llm_model_name, 
-                temperature=temperature
-            )
-            if status != "success":
-                logger.error(f"Ошибка при написании главы {ch} серии {s}: {status}")
-                return None, tokens
-            tokens += total_tokens
-            for serie in scenario_data:
-                if serie.serie_number == s:
-                    target_serie = serie
-                    break
-            for chapter in target_serie.content:
-                if chapter.chapter_number == ch:
-                    target_chapter = chapter
-                    break
-            target_chapter.text = response
-            previous_chapter_text = response
-    
+    # Сквозной номер первой главы каждой серии (для прогресса "глава N из M")
+    first_indexes, offset = [], 1
+    for serie in scenario_data:
+        first_indexes.append(offset)
+        offset += len(serie.content)
+    return _ScenarioPlan(file_paths=file_paths, scenario_data=scenario_data, first_indexes=first_indexes,
+                         total_chapters=sum(chapters_per_serie.values()), checkpoint_dir=checkpoint_dir,
+                         structure_hash=structure_hash)
+
+
+def _serie_seeds(scenario_data: List[ScenarioStructure]) -> List[str]:
+    """
+    Начальный "предыдущий текст" каждой серии в режиме parallel_series. Каждая серия — независимая
+    цепочка глав: мост между сериями строим по описанию последней главы предыдущей серии
+    из структуры, поэтому ждать ее текст не нужно.
+    """
+    seeds = [""]
+    for prev_serie in scenario_data[:-1]:
+        last_chapter = prev_serie.content[-1] if prev_serie.content else None
+        seeds.append(f"(Краткое содержание предыдущей главы: {last_chapter.chapter_description})" if last_chapter else "")
+    return seeds
+
+
+def _save_scenario(topic_path: str, scenario_data: List[ScenarioStructure]) -> str | None:
+    """Сохраняет scenario.json и рендерит docx. Возвращает статус для результата workflow."""
     try:
         scripts = [sd.model_dump() for sd in scenario_data]
-        save_json(scripts, output_file_json)
+        save_json(scripts, Path(topic_path) / "SCENARIO" / "scenario.json")
         scenario_to_docx(f"{topic_path}/SCENARIO")
-        return status, tokens
+        return "success"
     except Exception as e:
         logger.error(f"Критическая ошибка при обработке или сохранении: {e}")
+        return None
+
+
+def write_script_text(topic_path: str, llm_model_name: str, temperature: float, resume: bool = False,
+                      parallel_series: bool = False, max_workers: int | None = None,
+                      progress: WorkflowProgress | None = None):
+    """
+    Пишет текст всех глав всех серий. Каждая глава сразу сохраняется в чекпоинт
+    SCENARIO/CHAPTERS/ вместе с хэшем структуры, по которой она написана.
+    resume=True: главы с чекпоинтом от текущей структуры не генерируются заново.
+    parallel_series=True: серии пишутся параллельно (не больше max_workers одновременно),
+    первая глава серии опирается на описание последней главы предыдущей серии, а не на ее текст.
+    """
+    progress = progress or WorkflowProgress()
+    plan = _prepare_scenario(topic_path, resume)
+    if plan is None:
+        return None, 0
+    uploaded_files = upload_files(plan.file_paths)
+    scenario_data, first_indexes = plan.scenario_data, plan.first_indexes
+    common = dict(total_chapters=plan.total_chapters, uploaded_files=uploaded_files, llm_model_name=llm_model_name,
+                  temperature=temperature, resume=resume, checkpoint_dir=plan.checkpoint_dir,
+                  structure_hash=plan.structure_hash, progress=progress)
+
+    # Файлы DB, факты и структура одинаковы для всех глав — кладем их в кэш контекста один раз
+    with context_cache(uploaded_files, llm_model_name) as context:
+        common["context"] = context
+        tokens = 0
+        if parallel_series:
+            seeds = _serie_seeds(scenario_data)
+            workers = max(1, min(max_workers or SERIES_CONCURRENCY, len(scenario_data)))
+            logger.info(f"Параллельное написание {len(scenario_data)} серий, параллельность {workers}")
+            # Токены берем из прогресса: упавшая серия не вернет свой счетчик, а ее главы уже оплачены
+            tokens_before = progress.tokens
+            stop, failure = threading.Event(), None
+
+            def write_serie(*args):
+                # Флаг ставим еще в потоке серии: освободившийся поток не должен успеть начать следующую
+                try:
+                    result = _write_serie_text(*args, stop=stop, **common)
+                except BaseException:
+                    stop.set()
+                    raise
+                if result[0] != "success":
+                    stop.set()
+                return result
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="serie") as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, write_serie, serie, seed, first_index)
+                    for serie, seed, first_index in zip(scenario_data, seeds, first_indexes)
+                ]
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failure = failure or e
+                    if stop.is_set():
+                        # После первой ошибки не начатые серии снимаем, идущие остановятся перед следующей главой
+                        for pending in futures:
+                            pending.cancel()
+            tokens = progress.tokens - tokens_before
+            if failure is not None:
+                raise failure
+            if stop.is_set():
+                return None, tokens
+        else:
+            previous_chapter_text = ""
+            for serie, first_index in zip(scenario_data, first_indexes):
+                serie_status, serie_tokens, previous_chapter_text = _write_serie_text(
+                    serie, previous_chapter_text, first_index, **common)
+                tokens += serie_tokens
+                if serie_status != "success":
+                    return None, tokens
+    return _save_scenario(topic_path, scenario_data), tokens
+
+async def awrite_script_text(topic_path: str, llm_model_name: str, temperature: float, resume: bool = False,
+                             parallel_series: bool = False, max_workers: int | None = None,
+                             progress: WorkflowProgress | None = None):
+    """
+    Асинхронный write_script_text: те же чекпоинты и resume. В режиме parallel_series серии —
+    корутины в одном цикле событий (не больше max_workers одновременно) вместо пула потоков.
+    """
+    progress = progress or WorkflowProgress()
+    plan = await asyncio.to_thread(_prepare_scenario, topic_path, resume)
+    if plan is None:
+        return None, 0
+    uploaded_files = await aupload_files(plan.file_paths)
+    scenario_data, first_indexes = plan.scenario_data, plan.first_indexes
+    common = dict(total_chapters=plan.total_chapters, uploaded_files=uploaded_files, llm_model_name=llm_model_name,
+                  temperature=temperature, resume=resume, checkpoint_dir=plan.checkpoint_dir,
+                  structure_hash=plan.structure_hash, progress=progress)
+
+    async with acontext_cache(uploaded_files, llm_model_name) as context:
+        common["context"] = context
+        tokens = 0
+        if parallel_series:
+            seeds = _serie_seeds(scenario_data)
+            workers = max(1, min(max_workers or SERIES_CONCURRENCY, len(scenario_data)))
+            logger.info(f"Параллельное написание {len(scenario_data)} серий (async), параллельность {workers}")
+            tokens_before = progress.tokens
+            semaphore, stop = asyncio.Semaphore(workers), asyncio.Event()
+
+            async def write_serie(*args):
+                async with semaphore:
+                    try:
+                        result = await _awrite_serie_text(*args, stop=stop, **common)
+                    except BaseException:
+                        stop.set()
+                        raise
+                    if result[0] != "success":
+                        stop.set()
+                    return result
+
+            # Серии, ждущие семафор после ошибки, остановятся перед первой главой
+            results = await asyncio.gather(
+                *(write_serie(serie, seed, first_index)
+                  for serie, seed, first_index in zip(scenario_data, seeds, first_indexes)),
+                return_exceptions=True)
+            tokens = progress.tokens - tokens_before
+            failure = next((result for result in results if isinstance(result, BaseException)), None)
+            if failure is not None:
+                raise failure
+            if stop.is_set():
+                return None, tokens
+        else:
+            previous_chapter_text = ""
+            for serie, first_index in zip(scenario_data, first_indexes):
+                serie_status, serie_tokens, previous_chapter_text = await _awrite_serie_text(
+                    serie, previous_chapter_text, first_index, **common)
+                tokens += serie_tokens
+                if serie_status != "success":
+                    return None, tokens
+    return await asyncio.to_thread(_save_scenario, topic_path, scenario_data), tokens
+
+
+# --- ПЕРЕГЕНЕРАЦИЯ ОДНОЙ ГЛАВЫ ИЛИ СЕРИИ ---
+def _find_in_structure(topic_path: str, chapter_id: str | None, serie_id: str | None) -> tuple[int, list[int]] | None:
+    """По chapter_id/serie_id из script_structure.json возвращает (номер серии, номера глав)."""
+    with open(f"{topic_path}/STRUCTURE/script_structure.json", 'r', encoding='utf-8') as f:
+        structure = [ScriptStructureID.model_validate(item) for item in json.load(f)]
+    for serie in structure:
+        if serie_id is not None and serie.serie_id == serie_id:
+            return serie.serie_number, [chapter.chapter_number for chapter in serie.content]
+        for chapter in serie.content:
+            if chapter_id is not None and chapter.chapter_id == chapter_id:
+                return serie.serie_number, [chapter.chapter_number]
+    return None
+
+@dataclass
+class _RegenerationPlan:
+    """Переписываемая часть сценария: план глав из структуры, мост к ней и куда вписать результат."""
+    part: ScenarioStructure
+    scenario_data: List[ScenarioStructure]
+    scenario_serie: ScenarioStructure
+    previous_chapter_text: str
+    first_index: int
+    total_chapters: int
+    file_paths: List[str]
+    checkpoint_dir: Path
+    structure_hash: str
+
+
+def _prepare_regeneration(topic_path: str, chapter_id: str | None,
+                          serie_id: str | None) -> tuple[_RegenerationPlan | None, str | None]:
+    """Возвращает (план, None) или (None, статус для результата workflow), если переписывать нечего."""
+    output_dir = Path(topic_path) / "SCENARIO"
+    output_file_json = output_dir / "scenario.json"
+    if not output_file_json.exists():
+        logger.error(f"Сценарий {output_file_json} еще не написан")
+        return None, "Сценарий еще не написан: сначала сгенерируйте его целиком"
+    if not update_json_structure(topic_path=topic_path):
+        return None, None
+    target = _find_in_structure(topic_path, chapter_id, serie_id)
+    if target is None:
+        logger.error(f"В структуре {topic_path} нет главы {chapter_id} / серии {serie_id}")
+        return None, "Глава или серия не найдена в структуре сценария"
+    serie_number, chapter_numbers = target
+
+    _, scenario_data = get_chapters_per_serie_from_file(str(output_file_json))
+    _, structure_data = get_chapters_per_serie_from_file(f"{topic_path}/STRUCTURE/script_structure.json")
+    scenario_serie = next((serie for serie in scenario_data if serie.serie_number == serie_number), None)
+    plan = next(serie for serie in structure_data if serie.serie_number == serie_number)
+    existing = {chapter.chapter_number for chapter in scenario_serie.content} if scenario_serie else set()
+    if not set(chapter_numbers) <= existing:
+        logger.error(f"Структура серии {serie_number} разошлась со сценарием: главы {chapter_numbers}, в сценарии {existing}")
+        return None, "Структура изменилась с момента написания сценария: перепишите сценарий целиком"
+
+    # Текст главы, предшествующей первой переписываемой (в этой же серии или последняя глава предыдущей)
+    ordered = [(serie, chapter) for serie in scenario_data for chapter in serie.content]
+    first_position = next(i for i, (serie, chapter) in enumerate(ordered)
+                          if serie.serie_number == serie_number and chapter.chapter_number == chapter_numbers[0])
+    previous_chapter_text = ordered[first_position - 1][1].text if first_position > 0 else ""
+
+    # Пишем по плану из текущей структуры (название и описание главы могли быть отредактированы)
+    part = ScenarioStructure(serie_number=serie_number, serie_name=plan.serie_name,
+                             content=[chapter for chapter in plan.content if chapter.chapter_number in chapter_numbers])
+
+    folder_db = Path(topic_path) / "DB"
+    file_paths = [str(file.resolve()) for file in folder_db.iterdir() if file.is_file()]
+    file_paths.append(os.path.join(f"{topic_path}/FACTS", "ALG_MAIN/CHECK/db_facts_checked.txt"))
+    file_paths.append(f"{topic_path}/STRUCTURE/script_structure.txt")
+    logger.info(f"Перегенерация серии {serie_number}, главы {chapter_numbers} в {topic_path}")
+    return _RegenerationPlan(
+        part=part, scenario_data=scenario_data, scenario_serie=scenario_serie,
+        previous_chapter_text=previous_chapter_text, first_index=first_position + 1, total_chapters=len(ordered),
+        file_paths=file_paths, checkpoint_dir=ensure_directory(output_dir / "CHAPTERS"),
+        structure_hash=file_sha256(f"{topic_path}/STRUCTURE/script_structure.json"),
+    ), None
+
+
+def _save_regenerated_part(topic_path: str, plan: _RegenerationPlan) -> str | None:
+    """Вписывает новые главы на место старых, остальной сценарий не трогает."""
+    output_dir = Path(topic_path) / "SCENARIO"
+    part, scenario_serie = plan.part, plan.scenario_serie
+    new_chapters = {chapter.chapter_number: chapter for chapter in part.content}
+    scenario_serie.serie_name = part.serie_name
+    scenario_serie.content = [new_chapters.get(chapter.chapter_number, chapter) for chapter in scenario_serie.content]
+    try:
+        save_json([serie.model_dump() for serie in plan.scenario_data], output_dir / "scenario.json")
+        scenario_to_docx(str(output_dir), serie_numbers={part.serie_number})
+        return "success"
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении перегенерированной серии {part.serie_number}: {e}")
+        return None
+
+
+def regenerate_scenario_part(topic_path: str, llm_model_name: str, temperature: float,
+                             chapter_id: str | None = None, serie_id: str | None = None,
+                             progress: WorkflowProgress | None = None):
+    """
+    Переписывает одну главу (chapter_id) или все главы одной серии (serie_id), не трогая остальное.
+    Мост к предыдущей главе строится по ее уже готовому тексту из scenario.json; результат
+    вписывается в scenario.json на место старого, перерисовывается только Серия_N.docx.
+    """
+    progress = progress or WorkflowProgress()
+    plan, error = _prepare_regeneration(topic_path, chapter_id, serie_id)
+    if plan is None:
+        return error, 0
+    uploaded_files = upload_files(plan.file_paths)
+
+    # Кэш контекста окупается только на нескольких главах подряд
+    with context_cache(uploaded_files, llm_model_name) if len(plan.part.content) > 1 else nullcontext() as context:
+        status, tokens, _ = _write_serie_text(
+            plan.part, plan.previous_chapter_text, plan.first_index, plan.total_chapters,
+            uploaded_files=uploaded_files, llm_model_name=llm_model_name, temperature=temperature,
+            resume=False, checkpoint_dir=plan.checkpoint_dir, structure_hash=plan.structure_hash,
+            progress=progress, context=context)
+    if status != "success":
         return None, tokens
+    return _save_regenerated_part(topic_path, plan), tokens
+
+
+async def aregenerate_scenario_part(topic_path: str, llm_model_name: str, temperature: float,
+                                    chapter_id: str | None = None, serie_id: str | None = None,
+                                    progress: WorkflowProgress | None = None):
+    """Асинхронный regenerate_scenario_part: те же проверки и тот же результат."""
+    progress = progress or WorkflowProgress()
+    plan, error = await asyncio.to_thread(_prepare_regeneration, topic_path, chapter_id, serie_id)
+    if plan is None:
+        return error, 0
+    uploaded_files = await aupload_files(plan.file_paths)
+
+    async with acontext_cache(uploaded_files, llm_model_name) if len(plan.part.content) > 1 else nullcontext() as context:
+        status, tokens, _ = await _awrite_serie_text(
+            plan.part, plan.previous_chapter_text, plan.first_index, plan.total_chapters,
+            uploaded_files=uploaded_files, llm_model_name=llm_model_name, temperature=temperature,
+            resume=False, checkpoint_dir=plan.checkpoint_dir, structure_hash=plan.structure_hash,
+            progress=progress, context=context)
+    if status != "success":
+        return None, tokens
+    return await asyncio.to_thread(_save_regenerated_part, topic_path, plan), tokens
+
+
+# --- ГРАФ ЭТАПОВ ПАЙПЛАЙНА ---
+@dataclass(frozen=True)
+class PipelineStage:
+    """
+    Этап пайплайна. inputs/outputs — артефакты (пути относительно папки проекта);
+    этап зависит от тех этапов, которые производят его inputs.
+    prompts и params (ключи параметров запуска) вместе с inputs составляют отпечаток этапа в манифесте.
+    run(topic_path, params, progress) возвращает (status, tokens), как и сами workflow.
+    """
+    name: str
+    inputs: tuple[str, ...]
+    outputs: tuple[str, ...]
+    run: Callable[[str, dict, WorkflowProgress], tuple]
+    prompts: tuple[Callable, ...] = ()
+    params: tuple[str, ...] = ("llm_model",)
+
+
+PIPELINE_STAGES: tuple[PipelineStage, ...] = (
+    PipelineStage(
+        name="expand",
+        inputs=("DB",),
+        outputs=("DB/db_extension.txt",),
+        run=lambda topic, p, progress: run_async(aexpand_database(topic, p["llm_model"], progress=progress)),
+        prompts=(get_stage1_prompt,),
+    ),
+    PipelineStage(
+        name="search_main",
+        inputs=("DB", "DB/db_extension.txt"),
+        outputs=("FACTS/ALG_MAIN/HYP/db_facts.txt",),
+        run=lambda topic, p, progress: run_async(afind_connections_main(topic, p["llm_model"], progress=progress)),
+        prompts=(get_stage2_prompt_main,),
+    ),
+    PipelineStage(
+        name="search_blind",
+        inputs=("DB", "DB/db_extension.txt"),
+        outputs=("FACTS/ALG_BLIND/HYP/db_facts.txt",),
+        run=lambda topic, p, progress: run_async(afind_connections_blind_spots(
+            topic, p["llm_model"], max_workers=p.get("max_workers"), progress=progress)),
+        prompts=(get_stage2_prompt_blind_spots,),
+    ),
+    PipelineStage(
+        name="check_main",
+        inputs=("FACTS/ALG_MAIN/HYP/db_facts.txt",),
+        outputs=("FACTS/ALG_MAIN/CHECK/db_facts_checked.txt",),
+        run=lambda topic, p, progress: run_async(acheck_hypotheses(topic, p["llm_model"], "main", progress=progress)),
+        prompts=(get_stage3_prompt,),
+    ),
+    PipelineStage(
+        name="structure",
+        inputs=("DB", "FACTS/ALG_MAIN/CHECK/db_facts_checked.txt", "FACTS/ALG_BLIND/HYP/db_facts.txt"),
+        outputs=("STRUCTURE/script_structure.json", "STRUCTURE/script_structure.txt"),
+        run=lambda topic, p, progress: run_async(abuild_script_structure(
+            topic_path=topic, num_series=p["num_series"], llm_model_name=p["llm_model"], progress=progress)),
+        prompts=(get_stage4_prompt,),
+        params=("llm_model", "num_series"),
+    ),
+    PipelineStage(
+        name="scenario",
+        # Сценарий пишется по script_structure.txt (его правит пользователь, json пересобирается из него)
+        inputs=("DB", "FACTS/ALG_MAIN/CHECK/db_facts_checked.txt", "STRUCTURE/script_structure.txt"),
+        outputs=("SCENARIO/scenario.json",),
+        run=lambda topic, p, progress: run_async(awrite_script_text(
+            topic_path=topic, llm_model_name=p["llm_model"], temperature=p["temperature"],
+            resume=p.get("resume", False), parallel_series=p.get("parallel_series", False),
+            max_workers=p.get("max_workers"), progress=progress)),
+        prompts=(get_stage5_prompt,),
+        params=("llm_model", "temperature", "parallel_series"),
+    ),
+)
+STAGES_BY_NAME = {stage.name: stage for stage in PIPELINE_STAGES}
+
+
+def _stage_input_hashes(topic_path: str, stage: PipelineStage) -> dict:
+    # Папки (DB) хэшируем без артефактов, которые производят этапы: они учитываются отдельно
+    produced = {output for other in PIPELINE_STAGES for output in other.outputs}
+    return {artifact: artifact_hash(topic_path, artifact, exclude=produced) for artifact in stage.inputs}
+
+
+def _stage_fingerprint(topic_path: str, stage: PipelineStage, params: dict) -> dict:
+    return {
+        "inputs": _stage_input_hashes(topic_path, stage),
+        "prompt_version": prompt_version(stage.prompts),
+        "params": {key: params.get(key) for key in stage.params},
+    }
+
+
+def run_stage(name: str, topic_path: str, params: dict, progress: WorkflowProgress | None = None,
+              force: bool = False):
+    """
+    Запускает этап с учетом манифеста: если входы, версия промптов и параметры не менялись
+    с прошлого успешного запуска и выходы на месте, этап не выполняется (no-op, 0 токенов).
+    force=True — запустить в любом случае.
+    """
+    progress = progress or WorkflowProgress()
+    stage = STAGES_BY_NAME[name]
+    fingerprint = _stage_fingerprint(topic_path, stage, params)
+    current = fingerprint_hash(fingerprint)
+    recorded = load_manifest(topic_path).get(name)
+    outputs_exist = all((Path(topic_path) / output).exists() for output in stage.outputs)
+    if not force and recorded and recorded.get("fingerprint_hash") == current and outputs_exist:
+        logger.info(f"Этап {name} для {topic_path} пропущен: входы не изменились с {recorded.get('completed_at')}")
+        progress.emit("stage_skipped", pipeline_stage=name)
+        return "success", 0
+
+    with metrics.stage(name), metrics.WORKFLOW_STAGE_SECONDS.time(stage=name, status="error") as labels:
+        status, tokens = stage.run(topic_path, params, progress)
+        labels["status"] = "success" if status == "success" else "error"
+    if status == "success":
+        record_stage(topic_path, name, {
+            "fingerprint_hash": current,
+            **fingerprint,
+            "outputs": {output: artifact_hash(topic_path, output) for output in stage.outputs},
+            "tokens": tokens,
+        })
+    return status, tokens
+
+
+def stage_statuses(topic_path: str) -> List[dict]:
+    """
+    Состояние этапов проекта по манифесту: fresh — входы и промпты те же, что при последнем запуске;
+    stale — что-то выше по графу реально изменилось (changed — что именно); never_run — запусков не было.
+    """
+    manifest = load_manifest(topic_path)
+    statuses = []
+    for stage in PIPELINE_STAGES:
+        recorded = manifest.get(stage.name)
+        if not recorded:
+            statuses.append({"stage": stage.name, "status": "never_run", "changed": []})
+            continue
+        current_inputs = _stage_input_hashes(topic_path, stage)
+        changed = [artifact for artifact, digest in current_inputs.items()
+                   if recorded.get("inputs", {}).get(artifact) != digest]
+        if recorded.get("prompt_version") != prompt_version(stage.prompts):
+            changed.append("prompt")
+        if not all((Path(topic_path) / output).exists() for output in stage.outputs):
+            changed.append("outputs_missing")
+        statuses.append({
+            "stage": stage.name,
+            "status": "stale" if changed else "fresh",
+            "changed": changed,
+            "params": recorded.get("params", {}),
+            "completed_at": recorded.get("completed_at"),
+        })
+    return statuses
+
+
+def stage_dependencies(stages=PIPELINE_STAGES) -> Dict[str, set[str]]:
+    """Для каждого этапа — имена этапов, производящих его входные артефакты."""
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {
+        stage.name: {producers[artifact] for artifact in stage.inputs if artifact in producers} - {stage.name}
+        for stage in stages
+    }
+
+
+def run_pipeline(topic_path: str, params: dict, max_workers: int | None = None,
+                 progress: WorkflowProgress | None = None):
+    """
+    Прогоняет граф этапов от загруженных отчетов до .docx. Все этапы, чьи зависимости
+    выполнены, запускаются одновременно (например, поиск main и blind spots),
+    но не больше max_workers сразу. После первой ошибки новые этапы не запускаются.
+    Этапы с неизменившимися входами пропускаются по манифесту (params["force"] — не пропускать).
+    Возвращает (status, tokens) как обычный workflow.
+    """
+    progress = progress or WorkflowProgress()
+    stages = PIPELINE_STAGES
+    by_name = STAGES_BY_NAME
+    dependencies = stage_dependencies(stages)
+    # Внешние входы (например, папка DB) должны существовать до старта
+    produced = {output for stage in stages for output in stage.outputs}
+    missing = [artifact for stage in stages for artifact in stage.inputs
+               if artifact not in produced and not (Path(topic_path) / artifact).exists()]
+    if missing or not os.listdir(Path(topic_path) / "DB"):
+        logger.error(f"Нет исходных данных для пайплайна в {topic_path}: {missing or ['DB']}")
+        return "Нет загруженных файлов базы данных", 0
+
+    workers = max(1, max_workers or PIPELINE_CONCURRENCY)
+    done, running = set(), {}
+    status, cancelled = "success", None
+    logger.info(f"Запуск пайплайна {topic_path}: {len(stages)} этапов, параллельность {workers}")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pipeline_stage") as executor:
+        while True:
+            if status == "success" and cancelled is None:
+                ready = [name for name in by_name
+                         if name not in done and name not in running.values() and dependencies[name] <= done]
+                for name in ready[:workers - len(running)]:
+                    progress.emit("stage_started", pipeline_stage=name, done=len(done), total=len(stages))
+                    stage_progress = progress.for_stage(name)
+                    running[executor.submit(run_stage, name, topic_path, params, stage_progress,
+                                             params.get("force", False))] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    stage_status, _ = future.result()
+                except WorkflowCancelled as e:
+                    cancelled = e
+                    continue
+                except Exception as e:
+                    logger.error(f"Этап {name} упал: {e}", exc_info=True)
+                    stage_status = f"error: {e}"
+                if stage_status == "success":
+                    done.add(name)
+                    progress.emit("stage_done", pipeline_stage=name, done=len(done), total=len(stages))
+                else:
+                    logger.error(f"Этап {name} завершился с ошибкой: {stage_status}")
+                    progress.emit("stage_failed", pipeline_stage=name, error=str(stage_status))
+                    if status == "success":
+                        status = stage_status
+                # Этапы, запущенные до ошибки, доводим до конца — их артефакты останутся целыми
+
+    if cancelled is not None:
+        raise cancelled
+    return status, progress.tokens
@@ -0,0 +1,42 @@
+from db.crud_project import add_project_access, delete_project_data, get_access_level
+
+
+def _access_queries(statements: list[str]) -> int:
+    return len([statement for statement in statements if "FROM projects" in statement])
+
+
+def test_access_is_resolved_in_one_query(pg_project, make_user, pg_db, sql_statements):
+    reader, stranger = make_user("reader"), make_user("stranger")
+    add_project_access(pg_db, pg_project.project_id, reader.user_id, "READ")
+    project_id, owner_id = pg_project.project_id, pg_project.owner_id
+    reader_id, stranger_id = reader.user_id, stranger.user_id
+    sql_statements.clear()
+
+    assert get_access_level(pg_db, project_id, owner_id) == "ADMIN"
+    assert get_access_level(pg_db, project_id, reader_id) == "READ"
+    assert get_access_level(pg_db, project_id, stranger_id) is None
+    assert get_access_level(pg_db, project_id + 1, owner_id) is None
+    assert _access_queries(sql_statements) == 4
+
+    # Повторные проверки, в том числе отказ, — из кэша
+    for user_id in (owner_id, reader_id, stranger_id):
+        get_access_level(pg_db, project_id, user_id)
+    assert _access_queries(sql_statements) == 4
+
+
+def test_granting_and_deleting_invalidate_the_cache(pg_project, make_user, pg_db, sql_statements):
+    user = make_user("user")
+    project_id, owner_id, user_id = pg_project.project_id, pg_project.owner_id, user.user_id
+    assert get_access_level(pg_db, project_id, user_id) is None
+
+    add_project_access(pg_db, project_id, user_id, "READ")
+    assert get_access_level(pg_db, project_id, user_id) == "READ"
+    add_project_access(pg_db, project_id, user_id, "WRITE")
+    assert get_access_level(pg_db, project_id, user_id) == "WRITE"
+
+    get_access_level(pg_db, project_id, owner_id)
+    delete_project_data(pg_db, project_id)
+    sql_statements.clear()
+    assert get_access_level(pg_db, project_id, owner_id) is None
+    assert get_access_level(pg_db, project_id, user_id) is None
+    assert _access_queries(sql_statements) == 2
@@ -0,0 +1,99 @@
+import pytest
+
+from services.admission import AdmissionController, Ticket, WorkflowQuotaExceeded
+
+
+class ManualExecutor:
+    """Исполнитель, который ничего не запускает сам: задачи завершает тест через finish."""
+
+    def __init__(self):
+        self.started: dict[str, tuple] = {}
+
+    def submit(self, fn, ticket):
+        self.started[ticket.job_id] = (fn, ticket)
+
+    def finish(self, job_id: str):
+        fn, ticket = self.started.pop(job_id)
+        fn(ticket)
+
+
+@pytest.fixture
+def executor():
+    return ManualExecutor()
+
+
+def _submit(admission: AdmissionController, job_id: str, user_id: int = 1, project_id: int = 1) -> int:
+    admission.check(user_id)
+    return admission.submit(Ticket(job_id, user_id, project_id, run=lambda: None))
+
+
+def test_users_take_turns_for_free_slots(executor):
+    admission = AdmissionController(executor, max_running=1, per_user=1, per_project=10)
+    assert _submit(admission, "a1", user_id=1) == 0
+    assert [_submit(admission, job, user_id=1) for job in ("a2", "a3")] == [1, 2]
+    # Единственная задача второго пользователя встает вперед хвоста очереди первого
+    assert _submit(admission, "b1", user_id=2) == 2
+    assert admission.position("a3") == 3
+
+    order = []
+    while executor.started:
+        job_id = next(iter(executor.started))
+        order.append(job_id)
+        executor.finish(job_id)
+    assert order == ["a1", "a2", "b1", "a3"]
+    assert admission.stats() == {"running": 0, "queued": 0, "running_by_user": {}, "queued_by_user": {}}
+
+
+def test_per_user_and_per_project_limits(executor):
+    admission = AdmissionController(executor, max_running=10, per_user=2, per_project=2)
+    for job in ("u1", "u2", "u3"):
+        _submit(admission, job, user_id=1, project_id=100 + int(job[1]))
+    assert set(executor.started) == {"u1", "u2"}
+
+    # Проект 1 занят двумя задачами разных пользователей, задача третьего ждет, хотя у него лимит свободен
+    _submit(admission, "p1", user_id=2, project_id=1)
+    _submit(admission, "p2", user_id=3, project_id=1)
+    assert _submit(admission, "p3", user_id=4, project_id=1) == 2
+    # Задача того же пользователя в свободный проект запускается в обход
+    assert _submit(admission, "free", user_id=4, project_id=2) == 0
+
+    executor.finish("p1")
+    assert "p3" in executor.started and admission.stats()["queued_by_user"] == {1: 1}
+
+
+def test_overflowing_queues_are_rejected(executor):
+    admission = AdmissionController(executor, max_running=1, per_user=1, per_project=10,
+                                    max_queued_per_user=2, max_queued=3)
+    for job in ("a1", "a2", "a3"):
+        _submit(admission, job, user_id=1)
+    with pytest.raises(WorkflowQuotaExceeded, match="лимит 2"):
+        _submit(admission, "a4", user_id=1)
+
+    _submit(admission, "b1", user_id=2)
+    with pytest.raises(WorkflowQuotaExceeded, match="переполнена"):
+        _submit(admission, "c1", user_id=3)
+
+
+def test_removed_ticket_never_starts(executor):
+    admission = AdmissionController(executor, max_running=1, per_user=1, per_project=10)
+    for job in ("a1", "a2", "a3"):
+        _submit(admission, job)
+    assert admission.remove("a2").job_id == "a2"
+    assert admission.remove("a2") is None and admission.remove("a1") is None
+    assert admission.position("a3") == 1
+
+    executor.finish("a1")
+    assert set(executor.started) == {"a3"}
+
+
+def test_failed_run_frees_its_slot(executor):
+    admission = AdmissionController(executor, max_running=1, per_user=1, per_project=1)
+
+    def broken():
+        raise RuntimeError("boom")
+
+    admission.submit(Ticket("bad", 1, 1, run=broken))
+    _submit(admission, "next")
+    with pytest.raises(RuntimeError):
+        executor.finish("bad")
+    assert set(executor.started) == {"next"}
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import re
+import threading
+from pathlib import Path
+
+import pytest
+
+from services import gemini_api
+from services import metrics
+from services import workflows as wrk
+from services.progress import WorkflowProgress
+from services.workflows import STAGES_BY_NAME
+from conftest import PARAMS
+
+MODEL = PARAMS["llm_model"]
+
+
+def test_coroutines_share_one_long_lived_loop():
+    async def current():
+        return asyncio.get_running_loop(), threading.current_thread().name
+
+    first, thread = gemini_api.run_async(current())
+    second, _ = gemini_api.run_async(current())
+    assert first is second and not first.is_closed()
+    assert thread == "llm_event_loop"
+    assert [t.name for t in threading.enumerate()].count("llm_event_loop") == 1
+
+
+def test_caller_context_reaches_the_coroutine():
+    async def stage_name():
+        return metrics.current_stage.get()
+
+    with metrics.stage("search_blind"):
+        assert gemini_api.run_async(stage_name()) == "search_blind"
+    assert gemini_api.run_async(stage_name()) == "unknown"
+
+
+def test_async_call_matches_sync_call(project, fake_llm):
+    files = gemini_api.upload_files(sorted((Path(project) / "DB").iterdir()))
+    sync_result = gemini_api.call_llm("Расширь базу", files=files, model_name=MODEL)
+    async_result = gemini_api.run_async(gemini_api.acall_llm("Расширь базу", files=files, model_name=MODEL))
+    assert async_result == sync_result and async_result[0] == "success"
+
+
+def test_async_blind_spots_produce_the_same_facts(project, fake_llm):
+    facts = Path(project) / "FACTS" / "ALG_BLIND" / "HYP" / "db_facts.txt"
+    status, sync_tokens = wrk.find_connections_blind_spots(project, MODEL)
+    sync_facts = facts.read_text(encoding="utf-8")
+    facts.unlink()
+
+    events = []
+    progress = WorkflowProgress(on_event=events.append)
+    status, tokens = gemini_api.run_async(wrk.afind_connections_blind_spots(project, MODEL, progress=progress))
+    assert status == "success"
+    assert tokens == sync_tokens == progress.tokens
+    assert facts.read_text(encoding="utf-8") == sync_facts
+    lenses = [e["lens"] for e in events if e["event"] == "lens_done"]
+    assert lenses == list(range(1, len(lenses) + 1)) and lenses
+    assert fake_llm.caches._caches == {}
+
+
+def test_async_expand_writes_the_extension(project, fake_llm):
+    status, tokens = gemini_api.run_async(wrk.aexpand_database(project, MODEL))
+    assert status == "success" and tokens > 0
+    assert (Path(project) / "DB" / "db_extension.txt").read_text(encoding="utf-8")
+
+
+def _outputs(project: str, stage: str) -> dict[str, str]:
+    # id серий и глав в структуре — случайные uuid
+    return {output: re.sub(r'"(serie|chapter)_id": "[^"]+"', "", (Path(project) / output).read_text(encoding="utf-8"))
+            for output in STAGES_BY_NAME[stage].outputs}
+
+
+@pytest.mark.parametrize("stage, sync_workflow, async_workflow", [
+    ("search_main", lambda p: wrk.find_connections_main(p, MODEL),
+     lambda p, progress: wrk.afind_connections_main(p, MODEL, progress=progress)),
+    ("check_main", lambda p: wrk.check_hypotheses(p, MODEL, "main"),
+     lambda p, progress: wrk.acheck_hypotheses(p, MODEL, "main", progress=progress)),
+    ("structure", lambda p: wrk.build_script_structure(p, 2, MODEL),
+     lambda p, progress: wrk.abuild_script_structure(p, 2, MODEL, progress=progress)),
+    ("scenario", lambda p: wrk.write_script_text(p, MODEL, 0.7),
+     lambda p, progress: wrk.awrite_script_text(p, MODEL, 0.7, progress=progress)),
+    ("scenario", lambda p: wrk.write_script_text(p, MODEL, 0.7, parallel_series=True),
+     lambda p, progress: wrk.awrite_script_text(p, MODEL, 0.7, parallel_series=True, progress=progress)),
+])
+def test_async_workflows_produce_the_same_artifacts(project, fake_llm, stage, sync_workflow, async_workflow):
+    for previous in wrk.PIPELINE_STAGES[:[s.name for s in wrk.PIPELINE_STAGES].index(stage)]:
+        assert wrk.run_stage(previous.name, project, PARAMS)[0] == "success", previous.name
+    status, sync_tokens = sync_workflow(project)
+    assert status == "success"
+    sync_outputs = _outputs(project, stage)
+    for output in sync_outputs:
+        (Path(project) / output).unlink()
+
+    progress = WorkflowProgress()
+    status, tokens = gemini_api.run_async(async_workflow(project, progress))
+    assert status == "success"
+    assert tokens == sync_tokens == progress.tokens
+    assert _outputs(project, stage) == sync_outputs
+
+
+def test_async_failed_serie_stops_the_others(project, fake_llm, monkeypatch):
+    for stage in ("expand", "search_main", "check_main"):
+        wrk.run_stage(stage, project, PARAMS)
+    wrk.run_stage("structure", project, {**PARAMS, "num_series": 3})
+    astream_call_llm = wrk.astream_call_llm
+    calls = []
+
+    async def recording_astream_call_llm(**kwargs):
+        chapter = kwargs["output_file"].stem
+        calls.append(chapter)
+        if chapter == "serie_2_chapter_1":
+            return "error: quota", None, None
+        await asyncio.sleep(0.05)
+        return await astream_call_llm(**kwargs)
+
+    monkeypatch.setattr(wrk, "astream_call_llm", recording_astream_call_llm)
+    progress = WorkflowProgress()
+    status, tokens = gemini_api.run_async(wrk.awrite_script_text(project, MODEL, 0.7, parallel_series=True,
+                                                                 max_workers=2, progress=progress))
+    assert status is None and tokens == progress.tokens
+    assert "serie_2_chapter_1" in calls and set(calls) <= {"serie_1_chapter_1", "serie_2_chapter_1"}
+    assert not (Path(project) / "SCENARIO" / "scenario.json").exists()
+
+
+def test_async_regenerate_matches_sync(project, fake_llm):
+    for stage in ("expand", "search_main", "check_main", "structure", "scenario"):
+        wrk.run_stage(stage, project, PARAMS)
+    scenario_json = Path(project) / "SCENARIO" / "scenario.json"
+    structure = json.loads((Path(project) / "STRUCTURE" / "script_structure.json").read_text(encoding="utf-8"))
+    serie_id = structure[1]["serie_id"]
+
+    status, sync_tokens = wrk.regenerate_scenario_part(project, MODEL, 0.7, serie_id=serie_id)
+    assert status == "success"
+    regenerated = scenario_json.read_text(encoding="utf-8")
+    status, tokens = gemini_api.run_async(wrk.aregenerate_scenario_part(project, MODEL, 0.7, serie_id=serie_id))
+    assert status == "success" and tokens == sync_tokens
+    assert scenario_json.read_text(encoding="utf-8") == regenerated
+
+    status, tokens = gemini_api.run_async(wrk.aregenerate_scenario_part(project, MODEL, 0.7, chapter_id="missing"))
+    assert status == "Глава или серия не найдена в структуре сценария" and tokens == 0
@@ -0,0 +1,64 @@
+import pytest
+from fastapi import HTTPException
+
+from db import auth_security, cache
+from db.auth_security import create_access_token, get_current_user
+from db.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires_and_evicts_least_recent(clock):
+    ttl_cache = TTLCache(maxsize=2, ttl=10)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+    assert (ttl_cache.get("a"), ttl_cache.get("b"), ttl_cache.get("c")) == (1, None, 3)
+
+    # Своё время жизни записи не может превышать ttl кэша, неположительное — запись не кладется
+    ttl_cache.set("short", 1, ttl=2)
+    ttl_cache.set("long", 1, ttl=100)
+    ttl_cache.set("expired", 1, ttl=0)
+    assert ttl_cache.get("expired", "missing") == "missing"
+    clock[0] += 5
+    assert ttl_cache.get("short") is None and ttl_cache.get("long") == 1
+    clock[0] += 5
+    assert ttl_cache.get("long") is None and len(ttl_cache) == 0
+
+
+def test_ttl_cache_discard_where():
+    ttl_cache = TTLCache(maxsize=10, ttl=10)
+    for key in ((1, 1), (1, 2), (2, 1)):
+        ttl_cache.set(key, "READ")
+    ttl_cache.discard_where(lambda key: key[0] == 1)
+    assert len(ttl_cache) == 1 and ttl_cache.get((2, 1)) == "READ"
+
+
+def _authenticate(db, user) -> str:
+    token = create_access_token({"sub": str(user.user_id)})
+    return get_current_user(token=token, db=db).username
+
+
+def test_user_is_loaded_once(pg_db, make_user, sql_statements):
+    user_id = make_user("alice").user_id
+    token = create_access_token({"sub": str(user_id)})
+    sql_statements.clear()
+    assert [get_current_user(token=token, db=pg_db).username for _ in range(3)] == ["alice"] * 3
+    assert len([statement for statement in sql_statements if "FROM users" in statement]) == 1
+    assert auth_security._token_cache.get(token) == str(user_id)
+
+
+def test_bad_tokens_are_rejected(pg_db, make_user):
+    user = make_user("alice")
+    for token in ("not-a-jwt", create_access_token({"name": "alice"}), create_access_token({"sub": "999"})):
+        with pytest.raises(HTTPException) as error:
+            get_current_user(token=token, db=pg_db)
+        assert error.value.status_code == 401
+    assert len(auth_security._user_cache) == 0
+    assert _authenticate(pg_db, user) == "alice"
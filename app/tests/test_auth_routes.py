@@ -0,0 +1,50 @@
+import pytest
+
+# Форма логина требует python-multipart (зависимость приложения); без него маршруты /users не собрать
+pytest.importorskip("multipart")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from passlib.context import CryptContext  # noqa: E402
+
+from api import auth_routes  # noqa: E402
+from db import auth_security  # noqa: E402
+
+
+@pytest.fixture
+def client(pg_db, monkeypatch):
+    """HTTP-клиент к маршрутам /users с настоящими get_db и get_current_user (хэши паролей — быстрой схемой)."""
+    monkeypatch.setattr(auth_security, "pwd_context", CryptContext(schemes=["pbkdf2_sha256"]))
+    app = FastAPI()
+    app.include_router(auth_routes.router_auth)
+    with TestClient(app) as client:
+        yield client
+
+
+def _login(client, password: str):
+    return client.post("/users/token", data={"username": "alice", "password": password})
+
+
+def test_password_change_is_seen_by_cached_authentication(client):
+    assert client.post("/users/register", json={"username": "alice", "password": "old"}).status_code == 201
+    headers = {"Authorization": f"Bearer {_login(client, 'old').json()['access_token']}"}
+
+    change = {"current_password": "old", "new_password": "new"}
+    assert client.post("/users/me/password", json=change, headers=headers).status_code == 200
+    assert _login(client, "old").status_code == 401
+    assert _login(client, "new").status_code == 200
+    # Пользователь в кэше аутентификации сброшен: текущий пароль сверяется уже с новым хэшем
+    change = {"current_password": "new", "new_password": "newer"}
+    assert client.post("/users/me/password", json=change, headers=headers).status_code == 200
+
+
+def test_deactivated_account_is_rejected_at_once(client):
+    client.post("/users/register", json={"username": "alice", "password": "secret"})
+    headers = {"Authorization": f"Bearer {_login(client, 'secret').json()['access_token']}"}
+    change = {"current_password": "wrong", "new_password": "x"}
+    # Запрос проходит аутентификацию (пользователь попадает в кэш) и отклоняется уже по паролю
+    assert client.post("/users/me/password", json=change, headers=headers).status_code == 400
+
+    assert client.delete("/users/me", headers=headers).status_code == 200
+    assert client.post("/users/me/password", json=change, headers=headers).status_code == 401
+    assert _login(client, "secret").status_code == 401
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from benchmarks import pipeline as bench
+
+STAGES = ["expand", "search_main", "search_blind", "check_main", "structure", "scenario"]
+
+
+def test_synthetic_project_has_requested_sources(tmp_path):
+    root = bench.create_synthetic_project(tmp_path, pdfs=2, pdf_pages=3, txts=1, txt_kb=2, seed=1)
+    files = sorted(path.name for path in (root / "DB").iterdir())
+    assert files == ["notes_1.txt", "source_1.pdf", "source_2.pdf"]
+    pdf = (root / "DB" / "source_1.pdf").read_bytes()
+    assert pdf.startswith(b"%PDF-1.4") and pdf.rstrip().endswith(b"%%EOF") and b"/Count 3" in pdf
+    assert len((root / "DB" / "notes_1.txt").read_text(encoding="utf-8").encode("utf-8")) >= 2 * 1024
+
+    again = bench.create_synthetic_project(tmp_path / "again", pdfs=2, pdf_pages=3, txts=1, txt_kb=2, seed=1)
+    assert (again / "DB" / "source_2.pdf").read_bytes() == (root / "DB" / "source_2.pdf").read_bytes()
+
+
+@pytest.mark.parametrize("flags", [[], ["--async", "--parallel-series"]])
+def test_benchmark_reports_every_stage(tmp_path, fake_llm, upload_cache, flags):
+    output = tmp_path / "bench.json"
+    code = bench.main(["--pdfs", "1", "--pdf-pages", "2", "--txts", "1", "--txt-kb", "2", "--series", "2",
+                       "--chapters", "2", "--workdir", str(tmp_path / "project"), "--output", str(output), *flags])
+    report = json.loads(output.read_text(encoding="utf-8"))
+
+    assert code == 0 and report["total"]["status"] == "success"
+    assert [stage["stage"] for stage in report["stages"]] == STAGES
+    assert all(stage["llm_calls"] > 0 and stage["tokens"] > 0 for stage in report["stages"])
+    assert report["total"]["llm_calls"] == sum(stage["llm_calls"] for stage in report["stages"])
+    assert report["config"]["db_bytes"] > 0
+
+
+def test_failed_stage_is_reported(tmp_path, fake_llm, upload_cache, monkeypatch):
+    monkeypatch.setattr(bench.wrk, "expand_database", lambda topic_path, model: (None, 0))
+    output = tmp_path / "bench.json"
+    code = bench.main(["--pdfs", "1", "--pdf-pages", "1", "--txts", "0", "--workdir", str(tmp_path / "project"),
+                       "--output", str(output)])
+    report = json.loads(output.read_text(encoding="utf-8"))
+
+    assert code == 1 and report["total"]["status"] == "error"
+    assert [(stage["stage"], stage["status"]) for stage in report["stages"]] == [("expand", "None")]
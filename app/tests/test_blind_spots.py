@@ -0,0 +1,59 @@
+import threading
+import time
+from pathlib import Path
+
+from services import workflows as wrk
+from services.progress import WorkflowProgress
+from services.preprompts import get_stage2_prompt_blind_spots
+
+
+def _lens_count() -> int:
+    return len(wrk._collect_prompts(get_stage2_prompt_blind_spots))
+
+
+def test_lenses_run_concurrently_and_are_merged_in_order(project, monkeypatch):
+    call_llm = wrk.call_llm
+    lock, in_flight, peak = threading.Lock(), [0], [0]
+
+    def slow_call_llm(prompt, **kwargs):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.05)
+        try:
+            return call_llm(prompt, **kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    monkeypatch.setattr(wrk, "call_llm", slow_call_llm)
+    events = []
+    progress = WorkflowProgress(on_event=events.append)
+    status, tokens = wrk.find_connections_blind_spots(project, "gemini-2.5-flash", max_workers=3, progress=progress)
+
+    assert status == "success"
+    assert peak[0] == min(3, _lens_count())
+    assert tokens == progress.tokens > 0
+    assert [e["lens"] for e in events if e["event"] == "lens_done"] == list(range(1, _lens_count() + 1))
+    merged = Path(project) / "FACTS" / "ALG_BLIND" / "HYP" / "db_facts.txt"
+    assert merged.read_text(encoding="utf-8").strip()
+    assert not (merged.parent / "LENS").exists()
+
+
+def test_failed_lens_returns_tokens_of_all_finished_lenses(project, monkeypatch):
+    call_llm = wrk.call_llm
+    failing_prompt = wrk._collect_prompts(get_stage2_prompt_blind_spots)[1]
+
+    def flaky_call_llm(prompt, **kwargs):
+        if prompt == failing_prompt:
+            return "error: quota", None, 7
+        return call_llm(prompt, **kwargs)
+
+    monkeypatch.setattr(wrk, "call_llm", flaky_call_llm)
+    progress = WorkflowProgress()
+    status, tokens = wrk.find_connections_blind_spots(project, "gemini-2.5-flash", max_workers=3, progress=progress)
+
+    assert status == "error: quota"
+    # Линзы, ушедшие в работу параллельно упавшей, тоже оплачены
+    assert tokens == progress.tokens
+    assert not (Path(project) / "FACTS" / "ALG_BLIND" / "HYP" / "db_facts.txt").exists()
@@ -0,0 +1,89 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from api import llm_routes
+from db.db import SessionLocal
+from db.crud_job import create_job
+from db.crud_project import add_project_access
+from services import jobs
+from services import workflows as wrk
+from services.admission import AdmissionController
+from services.progress import WorkflowProgress, WorkflowCancelled
+from conftest import PARAMS, wait_for_job
+
+
+def test_cancel_is_shared_by_pipeline_stages():
+    progress = WorkflowProgress(stage="pipeline")
+    stage = progress.for_stage("scenario")
+    stage.check_cancelled()
+    progress.cancel()
+    assert stage.cancelled
+    with pytest.raises(WorkflowCancelled, match="scenario"):
+        stage.check_cancelled()
+
+
+def test_cancelled_pipeline_does_not_start_next_stages(project):
+    progress = WorkflowProgress(on_event=lambda event: event["event"] == "stage_done" and progress.cancel())
+    with pytest.raises(WorkflowCancelled):
+        wrk.run_pipeline(project, PARAMS, max_workers=1, progress=progress)
+    assert list(wrk.load_manifest(project)) == ["expand"]
+
+
+@pytest.fixture
+def single_slot(monkeypatch):
+    """Одна задача за раз: остальные ждут в очереди допуска."""
+    monkeypatch.setattr(jobs, "_admission", AdmissionController(jobs._executor, max_running=1))
+
+
+def test_running_and_queued_jobs_can_be_cancelled(pg_project, recorded_usage, single_slot, monkeypatch):
+    started = threading.Event()
+
+    def workflow(params, progress):
+        started.set()
+        while True:
+            progress.check_cancelled()
+            progress.add_tokens(1)
+            time.sleep(0.01)
+
+    monkeypatch.setitem(jobs.WORKFLOWS, "test", workflow)
+    with SessionLocal() as db:
+        running = jobs.submit_job(db, pg_project.project_id, pg_project.owner_id, "test", {"n": 1}).job_id
+        queued = jobs.submit_job(db, pg_project.project_id, pg_project.owner_id, "test", {"n": 2}).job_id
+    assert started.wait(5)
+    assert jobs.job_queue_position(queued) == 1
+
+    # Из очереди задача снимается сразу, не дожидаясь слота
+    assert jobs.cancel_job(queued)
+    result = wait_for_job(queued, timeout=1)
+    assert result["status"] == "cancelled" and result["tokens"] == 0
+    assert jobs.cancel_job(running)
+    result = wait_for_job(running)
+    assert result["status"] == "cancelled" and result["tokens"] > 0
+    assert recorded_usage == [(pg_project.owner_id, result["tokens"], "test")]
+    assert not jobs.cancel_job(running)
+
+
+def test_only_writers_cancel_jobs_of_others(pg_project, make_user, pg_db):
+    reader, writer = make_user("reader"), make_user("writer")
+    add_project_access(pg_db, pg_project.project_id, reader.user_id, "READ")
+    add_project_access(pg_db, pg_project.project_id, writer.user_id, "WRITE")
+    owners_job = create_job(pg_db, pg_project.project_id, pg_project.owner_id, "expand", {}).job_id
+    readers_job = create_job(pg_db, pg_project.project_id, reader.user_id, "expand", {}).job_id
+
+    def cancel(job_id, user):
+        with pytest.raises(HTTPException) as error:
+            llm_routes.cancel_workflow_job(job_id, current_user=SimpleNamespace(user_id=user.user_id), db=pg_db)
+        return error.value.status_code
+
+    # 409 — права есть, но задача не выполняется в этом процессе
+    assert cancel(owners_job, reader) == 403
+    assert cancel(readers_job, reader) == 409
+    assert cancel(owners_job, writer) == 409
+    with pytest.raises(HTTPException) as error:
+        llm_routes.cancel_project_workflows(pg_project.project_id, current_user=SimpleNamespace(user_id=reader.user_id),
+                                            db=pg_db)
+    assert error.value.status_code == 403
@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import pytest
+
+from services import workflows as wrk
+from services.progress import WorkflowProgress
+from services.preprompts import get_stage3_prompt
+from conftest import PARAMS
+
+MODEL = PARAMS["llm_model"]
+
+
+@pytest.fixture
+def hypotheses_project(project):
+    for stage in ("expand", "search_main"):
+        status, _ = wrk.run_stage(stage, project, PARAMS)
+        assert status == "success", stage
+    return project
+
+
+def _check(project: str) -> list[dict]:
+    events = []
+    status, tokens = wrk.check_hypotheses(project, MODEL, "main", progress=WorkflowProgress(on_event=events.append))
+    assert status == "success" and tokens > 0
+    return [event for event in events if event["event"] == "check_round_done"]
+
+
+def test_each_round_uploads_only_its_own_output(hypotheses_project, fake_llm):
+    rounds = len(wrk._collect_prompts(get_stage3_prompt))
+    uploads = fake_llm.stats["uploads"]
+    events = _check(hypotheses_project)
+
+    # db_facts.txt и результат каждого раунда, кроме последнего, — по одному разу
+    assert fake_llm.stats["uploads"] - uploads == 1 + (rounds - 1)
+    assert [event["round"] for event in events] == list(range(1, rounds + 1))
+    assert all(event["bytes_sent"] > 0 for event in events[:-1])
+    assert events[-1]["bytes_sent"] == 0
+    checked = Path(hypotheses_project) / "FACTS" / "ALG_MAIN" / "CHECK" / "db_facts_checked.txt"
+    assert "[НАЧАЛО ПРОВЕРКИ ГИПОТЕЗЫ]" in checked.read_text(encoding="utf-8")
+
+
+def test_rerun_with_the_same_results_sends_nothing(hypotheses_project, fake_llm):
+    _check(hypotheses_project)
+    uploads = fake_llm.stats["uploads"]
+    events = _check(hypotheses_project)
+    assert fake_llm.stats["uploads"] == uploads
+    assert all(event["bytes_sent"] == 0 for event in events)
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from services import gemini_api
+from services import workflows as wrk
+from conftest import PARAMS
+
+MODEL = PARAMS["llm_model"]
+
+
+def _uploaded(project: str):
+    return gemini_api.upload_files(sorted((Path(project) / "DB").iterdir()))
+
+
+def test_requests_reference_the_cache_instead_of_files(project, fake_llm):
+    files = _uploaded(project)
+    with gemini_api.context_cache(files, MODEL) as context:
+        assert context.name in fake_llm.caches._caches
+        content, config = gemini_api._llm_request("вопрос", files, False, True, 1, 100, context)
+        assert content == ["вопрос"] and config.cached_content == context.name
+
+        status, _, tokens = gemini_api.call_llm("вопрос", files=files, model_name=MODEL, context=context)
+        assert status == "success" and tokens
+
+        # Веб-поиск нельзя совмещать с кэшем: файлы уходят в запросе
+        content, config = gemini_api._llm_request("вопрос", files, True, True, 1, 100, context)
+        assert content == ["вопрос", *files] and config.cached_content is None
+    assert fake_llm.caches._caches == {}
+
+
+def test_failed_cache_creation_falls_back_to_sending_files(project, fake_llm, monkeypatch):
+    def unavailable(model, config):
+        raise RuntimeError("cached content is too small")
+
+    monkeypatch.setattr(fake_llm.caches, "create", unavailable)
+    files = _uploaded(project)
+    with gemini_api.context_cache(files, MODEL) as context:
+        assert context.name is None
+        content, config = gemini_api._llm_request("вопрос", files, False, True, 1, 100, context)
+    assert content == ["вопрос", *files] and config.cached_content is None
+
+
+def test_cache_ttl_is_extended_when_half_of_it_is_left(project, fake_llm):
+    with gemini_api.context_cache(_uploaded(project), MODEL, ttl_seconds=600) as context:
+        context._expire_time = datetime.now(timezone.utc) + timedelta(seconds=60)
+        assert context.name is not None
+        assert context._expire_time > datetime.now(timezone.utc) + timedelta(seconds=500)
+
+
+def test_blind_spots_lenses_share_one_cache(project, fake_llm):
+    status, _ = wrk.find_connections_blind_spots(project, MODEL)
+    assert status == "success"
+    assert fake_llm.stats["caches"] == 1
+    assert fake_llm.caches._caches == {}
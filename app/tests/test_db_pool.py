@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+from db import db as app_db
+from services import metrics
+
+
+def _count(histogram) -> int:
+    counts = histogram._values.get(())
+    return sum(counts[0]) if counts else 0
+
+
+def test_pool_status_follows_checkouts():
+    before = app_db.pool_status()
+    assert before["pool_size"] == app_db.DB_POOL_SIZE and before["max_overflow"] == app_db.DB_MAX_OVERFLOW
+
+    with app_db.engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        during = app_db.pool_status()
+        assert during["checked_out"] == before["checked_out"] + 1
+        assert during["utilization"] == round(during["checked_out"] / (app_db.DB_POOL_SIZE + app_db.DB_MAX_OVERFLOW), 3)
+    assert app_db.pool_status()["checked_out"] == before["checked_out"]
+    assert 'db_pool_connections{state="checked_out"}' in metrics.render()
+
+
+def test_pool_wait_hold_and_timeouts_are_measured(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=app_db.TimedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.05)
+    app_db._instrument_pool(engine)
+    waits, holds = _count(metrics.DB_POOL_WAIT_SECONDS), _count(metrics.DB_POOL_HOLD_SECONDS)
+    timeouts = metrics.DB_POOL_TIMEOUTS._values.get((), 0)
+
+    with engine.connect():
+        # Единственное соединение занято — второй запрос не дождется свободного
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+    assert metrics.DB_POOL_TIMEOUTS._values.get(()) == timeouts + 1
+    assert _count(metrics.DB_POOL_WAIT_SECONDS) - waits == 2
+    assert _count(metrics.DB_POOL_HOLD_SECONDS) - holds == 1
+    engine.dispose()
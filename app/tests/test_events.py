@@ -0,0 +1,97 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from api import llm_routes
+from db.auth_security import create_access_token
+from db.crud_project import add_project_access
+from services import events
+
+
+def test_events_published_from_threads_reach_subscriber():
+    async def scenario():
+        queue = events.subscribe(1)
+        try:
+            threads = [threading.Thread(target=events.publish, args=(1, {"event": "lens_done", "lens": i}))
+                       for i in range(3)]
+            for thread in threads:
+                thread.start()
+            received = [await asyncio.wait_for(queue.get(), timeout=1) for _ in threads]
+            events.publish(2, {"event": "other_project"})
+            await asyncio.sleep(0.01)
+            assert queue.empty()
+            return received
+        finally:
+            events.unsubscribe(1, queue)
+
+    received = asyncio.run(scenario())
+    assert sorted(event["lens"] for event in received) == [0, 1, 2]
+    assert 1 not in events._subscribers
+
+
+def test_slow_subscriber_loses_oldest_events(monkeypatch):
+    monkeypatch.setattr(events, "SUBSCRIBER_QUEUE_SIZE", 2)
+
+    async def scenario():
+        queue = events.subscribe(1)
+        try:
+            for i in range(4):
+                events.publish(1, {"event": "chapter_done", "chapter": i})
+            await asyncio.sleep(0.01)
+            return [queue.get_nowait()["chapter"] for _ in range(queue.qsize())]
+        finally:
+            events.unsubscribe(1, queue)
+
+    assert asyncio.run(scenario()) == [2, 3]
+
+
+class _Request:
+    """Запрос SSE, который отключается, когда тест дочитал нужное."""
+
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def test_event_stream_formats_events_and_unsubscribes(monkeypatch):
+    monkeypatch.setattr(llm_routes, "SSE_KEEPALIVE_SECONDS", 0.05)
+
+    async def scenario():
+        request = _Request()
+        response = await llm_routes.stream_project_events(7, request, current_user=SimpleNamespace(user_id=1))
+        # Пока ответ не начали отдавать, подписки нет: отключившийся до этого клиент ничего не держит
+        assert 7 not in events._subscribers
+        stream = response.body_iterator
+        chunks = [await stream.__anext__()]
+        events.publish(7, {"event": "job_done", "job_id": "j", "text": "Глава"})
+        chunks.append(await stream.__anext__())
+        chunks.append(await stream.__anext__())  # Событий больше нет — keepalive
+        request.disconnected = True
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+        return chunks
+
+    connected, event, keepalive = asyncio.run(scenario())
+    assert connected == ": connected\n\n"
+    header, data = event.strip().split("\n")
+    assert header == "event: job_done"
+    assert json.loads(data.removeprefix("data: "))["text"] == "Глава"
+    assert keepalive == ": keepalive\n\n"
+    assert 7 not in events._subscribers
+
+
+def test_event_stream_requires_project_access(pg_project, make_user, pg_db):
+    stranger, reader = make_user("stranger"), make_user("reader")
+    add_project_access(pg_db, pg_project.project_id, reader.user_id, "READ")
+
+    with pytest.raises(HTTPException) as denied:
+        llm_routes._authorize_project_events(pg_project.project_id, create_access_token({"sub": str(stranger.user_id)}))
+    assert denied.value.status_code == 403
+    user = llm_routes._authorize_project_events(pg_project.project_id, create_access_token({"sub": str(reader.user_id)}))
+    assert user.user_id == reader.user_id
@@ -0,0 +1,59 @@
+import pytest
+from google.genai import types
+
+from services import gemini_api
+from services import workflows as wrk
+from services.fake_gemini import FakeGeminiBackend
+from services.preprompts import get_stage3_prompt, get_stage4_prompt
+from services.schemas import ScriptStructure
+
+MODEL = "gemini-2.5-flash"
+
+
+def _text_of(backend, prompt: str, temperature: float = 1.0) -> str:
+    config = types.GenerateContentConfig(temperature=temperature)
+    return backend.models.generate_content(model=MODEL, contents=[prompt], config=config).text
+
+
+def test_same_prompt_gives_the_same_answer():
+    first, second = FakeGeminiBackend(latency=0, jitter=0), FakeGeminiBackend(latency=0, jitter=0, seed=7)
+    assert _text_of(first, "Глава 1") == _text_of(second, "Глава 1")
+    assert _text_of(first, "Глава 1") != _text_of(first, "Глава 2")
+    assert _text_of(first, "Глава 1", temperature=0.2) != _text_of(first, "Глава 1", temperature=1.0)
+
+
+def test_answers_follow_the_block_format_of_the_prompt():
+    backend = FakeGeminiBackend(latency=0, jitter=0, blocks=3)
+    text = _text_of(backend, get_stage3_prompt(lens_num=1))
+    assert len(wrk.extract_blocks(text, "НАЧАЛО ПРОВЕРКИ", "КОНЕЦ ПРОВЕРКИ")) == 3
+
+
+def test_structured_answer_has_the_requested_number_of_series():
+    backend = FakeGeminiBackend(latency=0, jitter=0, chapters=3)
+    config = types.GenerateContentConfig(response_schema=list[ScriptStructure], response_mime_type="application/json")
+    response = backend.models.generate_content(model=MODEL, contents=[get_stage4_prompt(4)], config=config)
+    assert [serie.serie_number for serie in response.parsed] == [1, 2, 3, 4]
+    assert all(len(serie.content) == 3 for serie in response.parsed)
+
+
+def test_stream_splits_the_same_answer_and_reports_usage_once():
+    backend = FakeGeminiBackend(latency=0, jitter=0)
+    full = backend.models.generate_content(model=MODEL, contents=["Глава"])
+    chunks = list(backend.models.generate_content_stream(model=MODEL, contents=["Глава"]))
+    assert "".join(chunk.text for chunk in chunks) == full.text
+    assert [chunk.usage_metadata is not None for chunk in chunks] == [False] * (len(chunks) - 1) + [True]
+
+
+def test_injected_429_looks_like_the_real_one():
+    backend = FakeGeminiBackend(latency=0, jitter=0, rate_limit_rate=1.0)
+    with pytest.raises(Exception) as error:
+        backend.models.generate_content(model=MODEL, contents=["Глава"])
+    assert gemini_api._is_rate_limit_error(error.value)
+    assert 1 <= gemini_api._rate_limit_delay(error.value, retries=5) < 2  # retryDelay из ответа, а не 5 * 2^4
+    assert backend.stats["rate_limited"] == 1
+
+
+def test_backend_is_chosen_by_name():
+    assert isinstance(gemini_api.create_backend("fake"), FakeGeminiBackend)
+    with pytest.raises(ValueError):
+        gemini_api.create_backend("openai")
@@ -0,0 +1,72 @@
+import pytest
+
+from db.db import SessionLocal
+from services import jobs
+from conftest import wait_for_job
+
+
+def test_derived_key_depends_only_on_the_request():
+    key, window = jobs._idempotency_key(1, 7, "expand", {"a": 1, "b": 2}, None)
+    assert window == jobs.IDEMPOTENCY_DERIVED_WINDOW
+    # Порядок параметров и автор запроса не важны, проект, workflow и значения — важны
+    assert jobs._idempotency_key(1, 8, "expand", {"b": 2, "a": 1}, None)[0] == key
+    assert jobs._idempotency_key(2, 7, "expand", {"a": 1, "b": 2}, None)[0] != key
+    assert jobs._idempotency_key(1, 7, "search", {"a": 1, "b": 2}, None)[0] != key
+    assert jobs._idempotency_key(1, 7, "expand", {"a": 1, "b": 3}, None)[0] != key
+
+
+def test_client_keys_of_different_users_do_not_collide():
+    key, window = jobs._idempotency_key(1, 7, "expand", {}, "click-1")
+    assert window == jobs.IDEMPOTENCY_CLIENT_WINDOW
+    assert jobs._idempotency_key(1, 7, "scenario", {"x": 1}, "click-1")[0] == key
+    assert jobs._idempotency_key(1, 8, "expand", {}, "click-1")[0] != key
+
+
+@pytest.fixture
+def counted_workflow(monkeypatch, recorded_usage):
+    """Workflow test, который считает свои запуски и падает, пока fail=True."""
+    state = {"runs": 0, "fail": False}
+
+    def workflow(params, progress):
+        state["runs"] += 1
+        if state["fail"]:
+            raise RuntimeError("boom")
+        return "success", 0
+
+    monkeypatch.setitem(jobs.WORKFLOWS, "test", workflow)
+    monkeypatch.setitem(jobs.WORKFLOW_MESSAGES, "test", "Test done")
+    return state
+
+
+def _submit(pg_project, params: dict, key: str | None = None) -> str:
+    with SessionLocal() as db:
+        job_id = jobs.submit_job(db, pg_project.project_id, pg_project.owner_id, "test", params,
+                                 idempotency_key=key).job_id
+    wait_for_job(job_id)
+    return job_id
+
+
+def test_repeated_request_returns_the_finished_job(pg_project, counted_workflow, monkeypatch):
+    first = _submit(pg_project, {"n": 1})
+    assert _submit(pg_project, {"n": 1}) == first
+    assert _submit(pg_project, {"n": 2}) != first
+    assert counted_workflow["runs"] == 2
+
+    # За пределами окна тот же запрос запускается заново
+    monkeypatch.setattr(jobs, "IDEMPOTENCY_DERIVED_WINDOW", 0)
+    assert _submit(pg_project, {"n": 1}) != first
+    assert counted_workflow["runs"] == 3
+
+
+def test_client_key_replays_regardless_of_params(pg_project, counted_workflow):
+    first = _submit(pg_project, {"n": 1}, key="click-1")
+    assert _submit(pg_project, {"n": 2}, key="click-1") == first
+    assert counted_workflow["runs"] == 1
+
+
+def test_failed_job_is_not_replayed(pg_project, counted_workflow):
+    counted_workflow["fail"] = True
+    failed = _submit(pg_project, {"n": 1})
+    counted_workflow["fail"] = False
+    retried = _submit(pg_project, {"n": 1})
+    assert retried != failed and wait_for_job(retried)["status"] == "done"
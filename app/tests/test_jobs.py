@@ -0,0 +1,110 @@
+import threading
+
+from db.db import SessionLocal
+from db.crud_job import create_job, get_job, update_job
+from services import jobs
+from services import events
+from conftest import wait_for_job
+
+
+def test_progress_writes_are_throttled(monkeypatch):
+    writes, published = [], []
+    monkeypatch.setattr(jobs, "update_job", lambda db, job_id, **fields: writes.append(fields))
+    monkeypatch.setattr(events, "publish", lambda project_id, event: published.append(event))
+    monkeypatch.setattr(jobs, "JOB_PROGRESS_WRITE_INTERVAL", 60)
+
+    for lens in range(1, 6):
+        jobs._on_progress("job-1", 1, {"event": "lens_done", "lens": lens, "tokens": lens * 10, "text": "..."})
+    jobs._on_progress("job-1", 1, {"event": "text_delta", "delta": "a"})
+
+    # Подписчикам — каждое событие, в БД — только первое, последнее отложено до итоговой записи
+    assert len(published) == 6
+    assert [w["progress"]["lens"] for w in writes] == [1]
+    assert "text" not in writes[0]["progress"]
+    final = jobs._unwritten_progress("job-1")
+    assert final["progress"]["lens"] == 5 and "tokens" not in final
+    assert jobs._unwritten_progress("job-1") == {}
+
+
+def test_job_runs_in_background_and_records_tokens(pg_project, recorded_usage, monkeypatch):
+    def workflow(params, progress):
+        progress.add_tokens(42)
+        progress.emit("step_done", step=1, total=1)
+        return "success", 42
+
+    monkeypatch.setitem(jobs.WORKFLOWS, "test", workflow)
+    monkeypatch.setitem(jobs.WORKFLOW_MESSAGES, "test", "Test done")
+    with SessionLocal() as db:
+        job = jobs.submit_job(db, pg_project.project_id, pg_project.owner_id, "test", {"llm_model": "m"})
+        job_id = job.job_id
+
+    result = wait_for_job(job_id)
+    assert result["status"] == "done"
+    assert result["tokens"] == 42
+    assert result["result"] == {"status": "ok", "message": "Test done"}
+    assert recorded_usage == [(pg_project.owner_id, 42, "test")]
+
+
+def test_failed_job_still_charges_spent_tokens(pg_project, recorded_usage, monkeypatch):
+    def workflow(params, progress):
+        progress.add_tokens(5)
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(jobs.WORKFLOWS, "test", workflow)
+    with SessionLocal() as db:
+        job_id = jobs.submit_job(db, pg_project.project_id, pg_project.owner_id, "test", {}).job_id
+
+    result = wait_for_job(job_id)
+    assert result["status"] == "failed" and "boom" in result["error"]
+    assert result["tokens"] == 5
+    assert recorded_usage == [(pg_project.owner_id, 5, "test")]
+
+
+def test_concurrent_identical_requests_create_one_job(pg_project, recorded_usage, monkeypatch):
+    release = threading.Event()
+
+    def workflow(params, progress):
+        release.wait(5)
+        return "success", 0
+
+    monkeypatch.setitem(jobs.WORKFLOWS, "test", workflow)
+    monkeypatch.setitem(jobs.WORKFLOW_MESSAGES, "test", "Test done")
+    project_id, user_id = pg_project.project_id, pg_project.owner_id
+    job_ids = []
+
+    def submit():
+        with SessionLocal() as db:
+            job_ids.append(jobs.submit_job(db, project_id, user_id, "test", {"n": 1}).job_id)
+
+    threads = [threading.Thread(target=submit) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+
+    assert len(set(job_ids)) == 1
+    assert wait_for_job(job_ids[0])["status"] == "done"
+
+
+def test_orphaned_jobs_are_marked_only_by_the_only_server_process(pg_project):
+    with SessionLocal() as db:
+        stale = create_job(db, pg_project.project_id, pg_project.owner_id, "expand", {}).job_id
+        update_job(db, stale, status="running")
+
+    connections = []
+    try:
+        assert jobs.recover_orphaned_jobs() == 1
+        connections.append(jobs._workers_lock_connection)
+        with SessionLocal() as db:
+            assert get_job(db, stale).status == "orphaned"
+            running = create_job(db, pg_project.project_id, pg_project.owner_id, "expand", {}).job_id
+
+        # Второй воркер, пока первый жив: задачи соседа не трогает
+        assert jobs.recover_orphaned_jobs() == 0
+        connections.append(jobs._workers_lock_connection)
+        with SessionLocal() as db:
+            assert get_job(db, running).status == "queued"
+    finally:
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,89 @@
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from services import workflows as wrk
+from services.manifest import artifact_hash, load_manifest, MANIFEST_FILE
+from services.progress import WorkflowProgress
+from conftest import PARAMS
+
+
+@pytest.fixture
+def finished_project(project):
+    """Проект, по которому пайплайн уже прошел целиком."""
+    status, _ = wrk.run_pipeline(project, PARAMS, max_workers=2)
+    assert status == "success"
+    return project
+
+
+def _statuses(project: str) -> dict[str, tuple[str, list]]:
+    return {s["stage"]: (s["status"], s["changed"]) for s in wrk.stage_statuses(project)}
+
+
+def test_artifact_hash_follows_content(tmp_path):
+    (tmp_path / "DB").mkdir()
+    (tmp_path / "DB" / "a.txt").write_text("a", encoding="utf-8")
+    before = artifact_hash(str(tmp_path), "DB")
+
+    (tmp_path / "DB" / "produced.txt").write_text("b", encoding="utf-8")
+    assert artifact_hash(str(tmp_path), "DB", exclude={"DB/produced.txt"}) == before
+    assert artifact_hash(str(tmp_path), "DB") != before
+    assert artifact_hash(str(tmp_path), "DB/a.txt") != before
+    assert artifact_hash(str(tmp_path), "missing") is None
+
+
+def test_unchanged_stage_is_a_no_op(finished_project, fake_llm):
+    requests = fake_llm.stats["requests"]
+    events = []
+    status, tokens = wrk.run_stage("structure", finished_project, PARAMS,
+                                   progress=WorkflowProgress(on_event=events.append))
+
+    assert (status, tokens) == ("success", 0)
+    assert fake_llm.stats["requests"] == requests
+    assert [e["event"] for e in events] == ["stage_skipped"]
+    assert {status for status, _ in _statuses(finished_project).values()} == {"fresh"}
+
+
+def test_edited_structure_makes_only_scenario_stale(finished_project, fake_llm):
+    structure_txt = Path(finished_project) / "STRUCTURE" / "script_structure.txt"
+    structure_txt.write_text(structure_txt.read_text(encoding="utf-8") + "\n", encoding="utf-8")
+
+    statuses = _statuses(finished_project)
+    assert statuses.pop("scenario") == ("stale", ["STRUCTURE/script_structure.txt"])
+    assert {status for status, _ in statuses.values()} == {"fresh"}
+
+    requests = fake_llm.stats["requests"]
+    status, _ = wrk.run_pipeline(finished_project, PARAMS, max_workers=2)
+    # Перегенерированы только главы сценария (2 серии по 2 главы)
+    assert status == "success" and fake_llm.stats["requests"] - requests == 4
+    assert _statuses(finished_project)["scenario"] == ("fresh", [])
+
+
+def test_changed_params_prompts_or_outputs_rerun_stage(finished_project, fake_llm, monkeypatch):
+    requests = fake_llm.stats["requests"]
+    assert wrk.run_stage("expand", finished_project, {**PARAMS, "llm_model": "gemini-2.5-pro"})[1] > 0
+    assert fake_llm.stats["requests"] > requests
+
+    (Path(finished_project) / "FACTS" / "ALG_MAIN" / "CHECK" / "db_facts_checked.txt").unlink()
+    assert _statuses(finished_project)["check_main"] == ("stale", ["outputs_missing"])
+    assert wrk.run_stage("check_main", finished_project, PARAMS)[1] > 0
+
+    assert wrk.run_stage("check_main", finished_project, PARAMS, force=True)[1] > 0
+
+    monkeypatch.setattr(wrk, "prompt_version", lambda prompts: "new-version")
+    assert _statuses(finished_project)["check_main"] == ("stale", ["prompt"])
+    assert wrk.run_stage("check_main", finished_project, PARAMS)[1] > 0
+
+
+def test_failed_stage_is_not_recorded(project, fake_llm, monkeypatch):
+    failing = dataclasses.replace(wrk.STAGES_BY_NAME["expand"], run=lambda topic, params, progress: ("error: 503", 0))
+    monkeypatch.setitem(wrk.STAGES_BY_NAME, "expand", failing)
+    assert wrk.run_stage("expand", project, PARAMS) == ("error: 503", 0)
+    assert "expand" not in load_manifest(project)
+
+
+def test_corrupted_manifest_is_treated_as_empty(finished_project):
+    (Path(finished_project) / MANIFEST_FILE).write_text("{oops", encoding="utf-8")
+    assert load_manifest(finished_project) == {}
+    assert {status for status, _ in _statuses(finished_project).values()} == {"never_run"}
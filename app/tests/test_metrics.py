@@ -0,0 +1,96 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from services import gemini_api, metrics
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    """Метрики, созданные тестом, убираются из реестра процесса."""
+    before = set(metrics._registry)
+    yield
+    for name in set(metrics._registry) - before:
+        metrics._registry.pop(name)
+
+
+def test_counter_renders_labels_with_escaping():
+    counter = metrics.Counter("test_events_total", "События", ("kind",))
+    counter.inc(kind='a"b\\c\nd')
+    counter.inc(2, kind="plain")
+
+    assert counter.render().splitlines() == [
+        "# HELP test_events_total События",
+        "# TYPE test_events_total counter",
+        'test_events_total{kind="a\\"b\\\\c\\nd"} 1',
+        'test_events_total{kind="plain"} 2',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Длительность", ("route",), buckets=(1, 0.1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, route="/x")
+
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{route="/x",le="0.1"} 1',
+        'test_seconds_bucket{route="/x",le="1.0"} 3',
+        'test_seconds_bucket{route="/x",le="+Inf"} 4',
+        'test_seconds_sum{route="/x"} 4.25',
+        'test_seconds_count{route="/x"} 4',
+    ]
+
+
+def test_histogram_timer_labels_can_change_inside_the_block():
+    histogram = metrics.Histogram("test_job_seconds", "Задачи", ("status",))
+    with pytest.raises(RuntimeError):
+        with histogram.time(status="ok") as labels:
+            labels["status"] = "error"
+            raise RuntimeError("boom")
+    assert 'test_job_seconds_count{status="error"} 1' in histogram.render()
+
+
+def test_gauge_collect_and_broken_collector():
+    gauge = metrics.Gauge("test_queued", "Очередь", ("user",), collect=lambda: {(1,): 3})
+    assert gauge.render().splitlines()[-1] == 'test_queued{user="1"} 3'
+
+    broken = metrics.Gauge("test_broken", "Сломанный", collect=lambda: 1 / 0)
+    assert broken.render().splitlines() == ["# HELP test_broken Сломанный", "# TYPE test_broken gauge"]
+
+
+def test_duplicate_metric_is_rejected():
+    metrics.Counter("test_duplicate_total", "Первый")
+    with pytest.raises(ValueError):
+        metrics.Counter("test_duplicate_total", "Второй")
+    assert metrics.render().count("# TYPE test_duplicate_total") == 1
+
+
+def test_llm_calls_are_measured_per_stage(fake_llm):
+    with metrics.stage("test_metrics"):
+        status, _, _ = gemini_api.call_llm("Привет", model_name="gemini-2.5-flash")
+    assert status == "success"
+
+    rendered = metrics.render()
+    assert ('llm_request_duration_seconds_count{model="gemini-2.5-flash",stage="test_metrics",mode="sync",'
+            'outcome="ok"} 1') in rendered
+    assert 'llm_tokens_total{model="gemini-2.5-flash",stage="test_metrics",kind="output"}' in rendered
+    assert metrics.current_stage.get() == "unknown"
+
+
+def _select_count() -> int:
+    counts = metrics.DB_QUERY_SECONDS._values.get(("select",))
+    return sum(counts[0]) if counts else 0
+
+
+def test_engine_queries_are_measured():
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    before = _select_count()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing"))
+        # Упавший запрос не сбивает замер следующих
+        connection.execute(text("SELECT 2"))
+        assert connection.info["query_started"] == []
+    assert _select_count() - before == 2
@@ -0,0 +1,77 @@
+import dataclasses
+import threading
+from pathlib import Path
+
+from services import workflows as wrk
+from services.progress import WorkflowProgress
+from conftest import PARAMS
+
+
+def _pipeline(project: str, max_workers: int = 2) -> tuple[tuple, list[dict]]:
+    events = []
+    result = wrk.run_pipeline(project, PARAMS, max_workers=max_workers,
+                              progress=WorkflowProgress(on_event=events.append))
+    return result, events
+
+
+def _stages(events: list[dict], event: str) -> list[str]:
+    return [e["pipeline_stage"] for e in events if e["event"] == event]
+
+
+def _replace_run(monkeypatch, name: str, run):
+    monkeypatch.setitem(wrk.STAGES_BY_NAME, name, dataclasses.replace(wrk.STAGES_BY_NAME[name], run=run))
+
+
+def test_dependencies_follow_artifacts():
+    assert wrk.stage_dependencies() == {
+        "expand": set(),
+        "search_main": {"expand"},
+        "search_blind": {"expand"},
+        "check_main": {"search_main"},
+        "structure": {"check_main", "search_blind"},
+        "scenario": {"check_main", "structure"},
+    }
+
+
+def test_pipeline_runs_every_stage_after_its_dependencies(project, fake_llm):
+    (status, tokens), events = _pipeline(project)
+
+    assert status == "success" and tokens > 0
+    done = _stages(events, "stage_done")
+    assert sorted(done) == sorted(wrk.STAGES_BY_NAME)
+    for stage, dependencies in wrk.stage_dependencies().items():
+        assert all(done.index(dependency) < done.index(stage) for dependency in dependencies), stage
+    assert list(Path(project, "SCENARIO").glob("*.docx"))
+
+
+def test_independent_searches_run_concurrently(project, fake_llm, monkeypatch):
+    # Оба поиска должны дойти до барьера одновременно, иначе он упадет по таймауту
+    barrier = threading.Barrier(2, timeout=5)
+    for name in ("search_main", "search_blind"):
+        original = wrk.STAGES_BY_NAME[name].run
+
+        def run(topic, params, progress, original=original):
+            barrier.wait()
+            return original(topic, params, progress)
+        _replace_run(monkeypatch, name, run)
+
+    (status, _), _ = _pipeline(project)
+    assert status == "success"
+
+
+def test_failed_stage_stops_its_dependents(project, fake_llm, monkeypatch):
+    _replace_run(monkeypatch, "check_main", lambda topic, params, progress: ("error: проверка", 0))
+    (status, _), events = _pipeline(project)
+
+    assert status == "error: проверка"
+    assert _stages(events, "stage_failed") == ["check_main"]
+    assert not {"structure", "scenario"} & set(_stages(events, "stage_started"))
+    # Уже запущенный независимый этап доводится до конца
+    assert {"expand", "search_main", "search_blind"} == set(_stages(events, "stage_done"))
+
+
+def test_pipeline_needs_uploaded_sources(tmp_path, fake_llm):
+    (tmp_path / "DB").mkdir()
+    (status, tokens), events = _pipeline(str(tmp_path))
+    assert status == "Нет загруженных файлов базы данных" and tokens == 0
+    assert not events
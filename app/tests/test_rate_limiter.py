@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from google.genai import types
+
+from services import rate_limiter
+from services.rate_limiter import TokenBucket, ModelRateLimiter, estimate_tokens
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время для ведер: clock[0] — текущее значение time.monotonic()."""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_refills_evenly_over_a_minute(clock):
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock[0] += 30
+    assert bucket.wait_time(30) == 0
+    assert bucket.wait_time(31) == pytest.approx(1.0)
+    clock[0] += 3600
+    assert bucket.level == 30 and bucket.wait_time(60) == 0
+    assert bucket.level == 60  # Не больше емкости
+
+
+def test_request_larger_than_capacity_waits_for_a_full_bucket(clock):
+    bucket = TokenBucket(per_minute=100)
+    assert bucket.wait_time(500) == 0
+    bucket.take(500)
+    assert bucket.level == 0
+
+
+def test_adjust_refunds_and_charges(clock):
+    bucket = TokenBucket(per_minute=100)
+    bucket.take(80)
+    bucket.adjust(50)
+    assert bucket.level == 70
+    bucket.adjust(-90)
+    assert bucket.level == -20
+    bucket.adjust(1000)
+    assert bucket.level == 100
+
+
+def test_try_acquire_does_not_wait(clock):
+    limiter = ModelRateLimiter("m", rpm=2, tpm=1000)
+    assert limiter.try_acquire(400) and limiter.try_acquire(400)
+    assert not limiter.try_acquire(1)  # Кончились запросы
+    clock[0] += 30
+    assert not limiter.try_acquire(900)  # Запрос есть, токенов только 700
+    limiter.reconcile(400, 100)  # Запрос обошелся дешевле оценки — разница возвращается
+    assert limiter.try_acquire(900)
+
+
+def test_acquire_waits_for_quota():
+    limiter = ModelRateLimiter("m", rpm=600, tpm=1_000_000)  # 10 запросов в секунду
+    limiter.requests.level = 0
+    started = time.monotonic()
+    waited = limiter.acquire(10)
+    assert 0.05 < time.monotonic() - started < 1
+    assert waited == pytest.approx(time.monotonic() - started, abs=0.05)
+
+
+def test_waiting_callers_get_quota_in_arrival_order():
+    limiter = ModelRateLimiter("m", rpm=1200, tpm=1_000_000)  # Запрос раз в 50 мс
+    limiter.requests.level = 0
+    order = []
+
+    def call(number):
+        limiter.acquire(1)
+        order.append(number)
+
+    threads = []
+    for number in range(5):
+        threads.append(threading.Thread(target=call, args=(number,)))
+        threads[-1].start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+    assert order == list(range(5))
+
+
+def test_async_acquire_does_not_leave_the_loop_when_quota_is_free():
+    limiter = ModelRateLimiter("m", rpm=10, tpm=1000)
+    assert asyncio.run(limiter.aacquire(10)) == 0.0
+
+
+def test_rate_limits_can_be_overridden_from_env(monkeypatch):
+    monkeypatch.setenv("GEMINI_RATE_LIMITS", '{"gemini-2.5-pro": {"rpm": 5}, "custom": {"tpm": 10}}')
+    limits = rate_limiter._load_rate_limits()
+    assert limits["gemini-2.5-pro"] == {"rpm": 5, "tpm": 2_000_000}
+    assert limits["custom"] == {"rpm": rate_limiter.FALLBACK_RATE_LIMIT["rpm"], "tpm": 10}
+
+    monkeypatch.setenv("GEMINI_RATE_LIMITS", "{broken")
+    assert rate_limiter._load_rate_limits() == rate_limiter.DEFAULT_RATE_LIMITS
+
+
+def test_estimate_tokens_counts_text_and_files():
+    pdf = types.File(name="files/a", mime_type="application/pdf", size_bytes=100_000)
+    txt = types.File(name="files/b", mime_type="text/plain", size_bytes=4_000)
+    inline = types.Part.from_bytes(data=b"x" * 400, mime_type="text/plain")
+    assert estimate_tokens(["a" * 400, pdf, txt, inline]) == 100 + 1000 + 1000 + 100
+    assert estimate_tokens([]) == 1
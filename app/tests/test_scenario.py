@@ -0,0 +1,228 @@
+import json
+import time
+from pathlib import Path
+
+import pytest
+
+from services import workflows as wrk
+from services.progress import WorkflowProgress, WorkflowCancelled
+from conftest import PARAMS
+
+MODEL = PARAMS["llm_model"]
+
+
+@pytest.fixture
+def structured_project(project):
+    """Проект, доведенный до структуры сценария: 2 серии по 2 главы."""
+    for stage in ("expand", "search_main", "check_main", "structure"):
+        status, _ = wrk.run_stage(stage, project, PARAMS)
+        assert status == "success", stage
+    return project
+
+
+def _checkpoints(project: str) -> list[Path]:
+    return sorted((Path(project) / "SCENARIO" / "CHAPTERS").glob("*.json"))
+
+
+def test_resume_reuses_checkpointed_chapters(structured_project, fake_llm):
+    status, tokens = wrk.write_script_text(structured_project, MODEL, 0.7)
+    assert status == "success" and tokens > 0
+    assert len(_checkpoints(structured_project)) == 4
+    scenario = (Path(structured_project) / "SCENARIO" / "scenario.json").read_text(encoding="utf-8")
+
+    _checkpoints(structured_project)[-1].unlink()
+    requests = fake_llm.stats["requests"]
+    events = []
+    status, tokens = wrk.write_script_text(structured_project, MODEL, 0.7, resume=True,
+                                           progress=WorkflowProgress(on_event=events.append))
+
+    assert status == "success"
+    assert fake_llm.stats["requests"] - requests == 1
+    assert [e.get("resumed", False) for e in events if e["event"] == "chapter_done"] == [True, True, True, False]
+    # Заглушка детерминирована: перегенерированная глава та же, сценарий совпадает
+    assert (Path(structured_project) / "SCENARIO" / "scenario.json").read_text(encoding="utf-8") == scenario
+
+
+def test_checkpoints_of_another_structure_are_ignored(structured_project, fake_llm):
+    wrk.write_script_text(structured_project, MODEL, 0.7)
+    structure_txt = Path(structured_project) / "STRUCTURE" / "script_structure.txt"
+    structure = json.loads(structure_txt.read_text(encoding="utf-8"))
+    structure[0]["serie_name"] = "Новое название"
+    structure_txt.write_text(json.dumps(structure, ensure_ascii=False), encoding="utf-8")
+
+    requests = fake_llm.stats["requests"]
+    status, _ = wrk.write_script_text(structured_project, MODEL, 0.7, resume=True)
+    assert status == "success"
+    assert fake_llm.stats["requests"] - requests == 4
+
+
+def test_without_resume_scenario_is_written_from_scratch(structured_project, fake_llm):
+    wrk.write_script_text(structured_project, MODEL, 0.7)
+    requests = fake_llm.stats["requests"]
+    wrk.write_script_text(structured_project, MODEL, 0.7)
+    assert fake_llm.stats["requests"] - requests == 4
+
+
+@pytest.fixture
+def three_series_project(structured_project):
+    status, _ = wrk.run_stage("structure", structured_project, {**PARAMS, "num_series": 3})
+    assert status == "success"
+    return structured_project
+
+
+def _chapter_calls(monkeypatch, fail_on: str | None = None, error: Exception | None = None) -> list[str]:
+    """
+    Подменяет потоковый вызов LLM: записывает, какие главы писались, и роняет главу fail_on.
+    Остальные главы пишутся с задержкой, чтобы ошибка гарантированно случилась, пока соседи в работе.
+    """
+    stream_call_llm = wrk.stream_call_llm
+    calls = []
+
+    def recording_stream_call_llm(**kwargs):
+        chapter = kwargs["output_file"].stem
+        calls.append(chapter)
+        if chapter == fail_on:
+            if error is not None:
+                raise error
+            return "error: quota", None, None
+        time.sleep(0.05)
+        return stream_call_llm(**kwargs)
+
+    monkeypatch.setattr(wrk, "stream_call_llm", recording_stream_call_llm)
+    return calls
+
+
+def _stopped_after_failure(calls: list[str]) -> bool:
+    return "serie_2_chapter_1" in calls and set(calls) <= {"serie_1_chapter_1", "serie_2_chapter_1"}
+
+
+def test_parallel_series_write_every_chapter(three_series_project, monkeypatch):
+    calls = _chapter_calls(monkeypatch)
+    progress = WorkflowProgress()
+    status, tokens = wrk.write_script_text(three_series_project, MODEL, 0.7, parallel_series=True,
+                                           max_workers=3, progress=progress)
+
+    assert status == "success" and tokens == progress.tokens > 0
+    assert sorted(calls) == [f"serie_{s}_chapter_{c}" for s in (1, 2, 3) for c in (1, 2)]
+    scenario = json.loads((Path(three_series_project) / "SCENARIO" / "scenario.json").read_text(encoding="utf-8"))
+    assert all(chapter["text"] for serie in scenario for chapter in serie["content"])
+
+
+def test_failed_serie_stops_the_others_and_charges_spent_tokens(three_series_project, monkeypatch):
+    calls = _chapter_calls(monkeypatch, fail_on="serie_2_chapter_1")
+    progress = WorkflowProgress()
+    status, tokens = wrk.write_script_text(three_series_project, MODEL, 0.7, parallel_series=True,
+                                           max_workers=2, progress=progress)
+
+    assert status is None
+    assert tokens == progress.tokens
+    # Третья серия не начиналась, первая остановилась перед следующей главой
+    assert _stopped_after_failure(calls)
+    assert not (Path(three_series_project) / "SCENARIO" / "scenario.json").exists()
+
+
+def test_exception_in_serie_is_raised(three_series_project, monkeypatch):
+    calls = _chapter_calls(monkeypatch, fail_on="serie_2_chapter_1", error=RuntimeError("boom"))
+    with pytest.raises(RuntimeError, match="boom"):
+        wrk.write_script_text(three_series_project, MODEL, 0.7, parallel_series=True, max_workers=2)
+    assert _stopped_after_failure(calls)
+
+
+def test_chapter_text_is_streamed_to_subscribers(structured_project):
+    events = []
+    status, _ = wrk.write_script_text(structured_project, MODEL, 0.7, progress=WorkflowProgress(on_event=events.append))
+    assert status == "success"
+
+    scenario = json.loads((Path(structured_project) / "SCENARIO" / "scenario.json").read_text(encoding="utf-8"))
+    first_chapter = scenario[0]["content"][0]
+    deltas = [e["delta"] for e in events if e["event"] == "text_delta" and (e["serie"], e["chapter"]) == (1, 1)]
+    assert len(deltas) > 1 and "".join(deltas) == first_chapter["text"]
+
+
+def test_cancel_during_streaming_stops_the_chapter(structured_project):
+    progress = WorkflowProgress(on_event=lambda event: event["event"] == "text_delta" and progress.cancel())
+    with pytest.raises(WorkflowCancelled):
+        wrk.write_script_text(structured_project, MODEL, 0.7, progress=progress)
+
+    # Оборванная глава не сохранена, но ее токены списаны
+    assert progress.tokens > 0
+    chapters = Path(structured_project) / "SCENARIO" / "CHAPTERS"
+    assert not list(chapters.glob("*.json")) and not list(chapters.glob("*.txt*"))
+
+
+@pytest.fixture
+def written_project(structured_project):
+    """Сценарий написан, тексты глав заменены метками "old серия.глава"."""
+    status, _ = wrk.write_script_text(structured_project, MODEL, 0.7)
+    assert status == "success"
+    scenario_json = Path(structured_project) / "SCENARIO" / "scenario.json"
+    scenario = json.loads(scenario_json.read_text(encoding="utf-8"))
+    for serie in scenario:
+        for chapter in serie["content"]:
+            chapter["text"] = f"old {serie['serie_number']}.{chapter['chapter_number']}"
+    scenario_json.write_text(json.dumps(scenario, ensure_ascii=False), encoding="utf-8")
+    for docx in (Path(structured_project) / "SCENARIO").glob("*.docx"):
+        docx.unlink()
+    return structured_project
+
+
+def _bridges(monkeypatch) -> list[str]:
+    """Записывает previous_chapter_text каждого промпта главы."""
+    get_stage5_prompt = wrk.get_stage5_prompt
+    bridges = []
+
+    def recording_prompt(ser, ch, previous_chapter_text):
+        bridges.append(previous_chapter_text)
+        return get_stage5_prompt(ser=ser, ch=ch, previous_chapter_text=previous_chapter_text)
+
+    monkeypatch.setattr(wrk, "get_stage5_prompt", recording_prompt)
+    return bridges
+
+
+def _structure_ids(project: str) -> list[dict]:
+    return json.loads((Path(project) / "STRUCTURE" / "script_structure.json").read_text(encoding="utf-8"))
+
+
+def _texts(project: str) -> dict[tuple[int, int], str]:
+    scenario = json.loads((Path(project) / "SCENARIO" / "scenario.json").read_text(encoding="utf-8"))
+    return {(serie["serie_number"], chapter["chapter_number"]): chapter["text"]
+            for serie in scenario for chapter in serie["content"]}
+
+
+def test_regenerate_chapter_patches_only_it(written_project, fake_llm, monkeypatch):
+    bridges = _bridges(monkeypatch)
+    chapter_id = _structure_ids(written_project)[1]["content"][0]["chapter_id"]
+    requests = fake_llm.stats["requests"]
+    status, tokens = wrk.regenerate_scenario_part(written_project, MODEL, 0.7, chapter_id=chapter_id)
+
+    assert status == "success" and tokens > 0
+    assert fake_llm.stats["requests"] - requests == 1
+    # Мост — готовый текст последней главы предыдущей серии
+    assert bridges == ["old 1.2"]
+    texts = _texts(written_project)
+    assert not texts.pop((2, 1)).startswith("old")
+    assert texts == {(1, 1): "old 1.1", (1, 2): "old 1.2", (2, 2): "old 2.2"}
+    assert [p.name for p in (Path(written_project) / "SCENARIO").glob("*.docx")] == ["Серия_2.docx"]
+
+
+def test_regenerate_serie_rewrites_all_its_chapters(written_project, fake_llm, monkeypatch):
+    bridges = _bridges(monkeypatch)
+    serie_id = _structure_ids(written_project)[0]["serie_id"]
+    status, _ = wrk.regenerate_scenario_part(written_project, MODEL, 0.7, serie_id=serie_id)
+
+    assert status == "success"
+    texts = _texts(written_project)
+    assert bridges == ["", texts[(1, 1)]]
+    assert {key: text for key, text in texts.items() if key[0] == 2} == {(2, 1): "old 2.1", (2, 2): "old 2.2"}
+    assert [p.name for p in (Path(written_project) / "SCENARIO").glob("*.docx")] == ["Серия_1.docx"]
+
+
+def test_regenerate_unknown_part_or_unwritten_scenario(structured_project, fake_llm):
+    status, tokens = wrk.regenerate_scenario_part(structured_project, MODEL, 0.7, chapter_id="missing")
+    assert status.startswith("Сценарий еще не написан") and tokens == 0
+
+    wrk.write_script_text(structured_project, MODEL, 0.7)
+    requests = fake_llm.stats["requests"]
+    status, tokens = wrk.regenerate_scenario_part(structured_project, MODEL, 0.7, chapter_id="missing")
+    assert status == "Глава или серия не найдена в структуре сценария" and tokens == 0
+    assert fake_llm.stats["requests"] == requests
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import gemini_api
+from services.progress import WorkflowCancelled
+
+MODEL = "gemini-2.5-flash"
+
+
+def test_deltas_add_up_to_the_answer_and_the_file(tmp_path, fake_llm):
+    deltas = []
+    output_file = tmp_path / "chapter.txt"
+    status, text, tokens = gemini_api.stream_call_llm("Глава 1", model_name=MODEL, on_delta=deltas.append,
+                                                      output_file=output_file)
+
+    assert status == "success" and len(deltas) > 1
+    assert "".join(deltas) == text == output_file.read_text(encoding="utf-8")
+    assert not (tmp_path / "chapter.txt.part").exists()
+    assert tokens == gemini_api.call_llm("Глава 1", model_name=MODEL)[2]
+
+
+def test_stopped_stream_leaves_no_file_and_estimates_spent_tokens(tmp_path, fake_llm):
+    def cancel(delta):
+        raise WorkflowCancelled("отменено")
+
+    output_file = tmp_path / "chapter.txt"
+    with pytest.raises(WorkflowCancelled) as cancelled:
+        gemini_api.stream_call_llm("Глава 1", model_name=MODEL, on_delta=cancel, output_file=output_file)
+
+    assert cancelled.value.partial_tokens > 0
+    assert not output_file.exists() and not (tmp_path / "chapter.txt.part").exists()
+
+
+def test_stream_error_is_returned_as_status(tmp_path, fake_llm, monkeypatch):
+    def broken_stream(model, contents, config=None):
+        yield from ()
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(fake_llm.models, "generate_content_stream", broken_stream)
+    status, text, tokens = gemini_api.stream_call_llm("Глава 1", model_name=MODEL, output_file=tmp_path / "c.txt")
+    assert status.startswith("error") and text is None and tokens is None
+    assert not (tmp_path / "c.txt").exists() and not (tmp_path / "c.txt.part").exists()
+
+
+def _stream_with_429(fake_llm, monkeypatch, fail_after: int) -> list:
+    """Поток, который отдает fail_after фрагментов и падает с 429 (только при первом вызове)."""
+    calls = []
+
+    def stream(model, contents, config=None):
+        calls.append(model)
+        for i in range(3):
+            if i == fail_after and len(calls) == 1:
+                raise RuntimeError("429 RESOURCE_EXHAUSTED")
+            yield SimpleNamespace(text=f"часть {i}. ", usage_metadata=None)
+
+    monkeypatch.setattr(fake_llm.models, "generate_content_stream", stream)
+    monkeypatch.setattr(gemini_api, "_rate_limit_delay", lambda e, retries: 0)
+    return calls
+
+
+def test_rate_limit_before_first_delta_is_retried(tmp_path, fake_llm, monkeypatch):
+    calls = _stream_with_429(fake_llm, monkeypatch, fail_after=0)
+    deltas = []
+    status, text, _ = gemini_api.stream_call_llm("Глава 1", model_name=MODEL, on_delta=deltas.append,
+                                                 output_file=tmp_path / "c.txt")
+    assert status == "success" and len(calls) == 2
+    assert "".join(deltas) == text == "часть 0. часть 1. часть 2. "
+
+
+def test_rate_limit_after_deltas_is_not_retried(tmp_path, fake_llm, monkeypatch):
+    calls = _stream_with_429(fake_llm, monkeypatch, fail_after=2)
+    deltas = []
+    status, text, _ = gemini_api.stream_call_llm("Глава 1", model_name=MODEL, on_delta=deltas.append,
+                                                 output_file=tmp_path / "c.txt")
+    # Повтор отправил бы подписчикам начало главы второй раз
+    assert status.startswith("error") and text is None and len(calls) == 1
+    assert deltas == ["часть 0. ", "часть 1. "]
+    assert not (tmp_path / "c.txt").exists() and not (tmp_path / "c.txt.part").exists()
+
+
+def test_async_retry_passes_cancellation_through():
+    calls = []
+
+    async def cancelled():
+        calls.append(1)
+        raise WorkflowCancelled("отменено")
+
+    with pytest.raises(WorkflowCancelled):
+        asyncio.run(gemini_api.aretry_on_rate_limit(cancelled))
+    assert calls == [1]
+
+
+def test_async_stream_matches_sync_stream(tmp_path, fake_llm):
+    sync_result = gemini_api.stream_call_llm("Глава 1", model_name=MODEL, output_file=tmp_path / "sync.txt")
+    deltas = []
+    async_result = gemini_api.run_async(gemini_api.astream_call_llm(
+        "Глава 1", model_name=MODEL, on_delta=deltas.append, output_file=tmp_path / "async.txt"))
+
+    assert async_result == sync_result and len(deltas) > 1
+    assert "".join(deltas) == (tmp_path / "async.txt").read_text(encoding="utf-8") == async_result[1]
+    assert not (tmp_path / "async.txt.part").exists()
+
+
+def test_async_rate_limit_after_deltas_is_not_retried(tmp_path, fake_llm, monkeypatch):
+    calls = []
+
+    async def stream(model, contents, config=None):
+        calls.append(model)
+
+        async def chunks():
+            for i in range(3):
+                if i == 2 and len(calls) == 1:
+                    raise RuntimeError("429 RESOURCE_EXHAUSTED")
+                yield SimpleNamespace(text=f"часть {i}. ", usage_metadata=None)
+        return chunks()
+
+    monkeypatch.setattr(fake_llm.aio.models, "generate_content_stream", stream)
+    monkeypatch.setattr(gemini_api, "_rate_limit_delay", lambda e, retries: 0)
+    deltas = []
+    status, text, _ = gemini_api.run_async(gemini_api.astream_call_llm(
+        "Глава 1", model_name=MODEL, on_delta=deltas.append, output_file=tmp_path / "c.txt"))
+    assert status.startswith("error") and text is None and len(calls) == 1
+    assert deltas == ["часть 0. ", "часть 1. "]
+    assert not (tmp_path / "c.txt").exists() and not (tmp_path / "c.txt.part").exists()
@@ -0,0 +1,52 @@
+import threading
+from datetime import date
+
+from db.db import SessionLocal
+from db.crud_user import (add_token_usage, backfill_legacy_token_usage, get_user_monthly_token_usage,
+                          get_user_token_usage_breakdown, LEGACY_USAGE_LABEL)
+
+DAY = date(2026, 3, 15)
+
+
+def _row(user_id: int, tokens: int, day: date = DAY, model: str = "gemini-2.5-flash", stage: str = "expand") -> dict:
+    return {"user_id": user_id, "day": day, "model": model, "stage": stage, "tokens": tokens}
+
+
+def test_usage_is_accumulated_per_day_model_and_stage(pg_db, make_user):
+    user_id = make_user("alice").user_id
+    add_token_usage(pg_db, [_row(user_id, 10), _row(user_id, 5, stage="scenario")])
+    add_token_usage(pg_db, [_row(user_id, 7), _row(user_id, 3, day=date(2026, 4, 1))])
+    add_token_usage(pg_db, [])
+
+    assert get_user_monthly_token_usage(pg_db, user_id) == {"2026-03": 22, "2026-04": 3}
+    assert get_user_token_usage_breakdown(pg_db, user_id, "2026-03") == [
+        {"model": "gemini-2.5-flash", "stage": "expand", "tokens": 17},
+        {"model": "gemini-2.5-flash", "stage": "scenario", "tokens": 5},
+    ]
+
+
+def test_concurrent_increments_are_not_lost(pg_db, make_user):
+    user_id = make_user("alice").user_id
+
+    def charge():
+        with SessionLocal() as db:
+            for _ in range(10):
+                add_token_usage(db, [_row(user_id, 1)])
+
+    threads = [threading.Thread(target=charge) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert get_user_monthly_token_usage(pg_db, user_id) == {"2026-03": 40}
+
+
+def test_legacy_backfill_is_idempotent(pg_db, make_user):
+    user_id = make_user("alice", token_usage={"2026-02-01": 100, "2026-02-02": 50, "broken": 1}).user_id
+    make_user("bob", token_usage=None)
+
+    assert backfill_legacy_token_usage(pg_db) == 2
+    assert backfill_legacy_token_usage(pg_db) == 0
+    assert get_user_monthly_token_usage(pg_db, user_id) == {"2026-02": 150}
+    assert get_user_token_usage_breakdown(pg_db, user_id, "2026-02") == [
+        {"model": LEGACY_USAGE_LABEL, "stage": LEGACY_USAGE_LABEL, "tokens": 150}]
@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from services import gemini_api
+
+
+def _db_files(project: str) -> list[str]:
+    return sorted(str(path) for path in (Path(project) / "DB").iterdir())
+
+
+def test_repeated_upload_is_served_from_cache(project, fake_llm):
+    first = gemini_api.upload_files(_db_files(project))
+    second = gemini_api.upload_files(_db_files(project))
+
+    assert [f.name for f in second] == [f.name for f in first]
+    assert fake_llm.stats["uploads"] == 2
+    stats = gemini_api.get_upload_cache_stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2
+
+
+def test_cache_survives_process_restart(project, fake_llm, upload_cache, monkeypatch):
+    gemini_api.upload_files(_db_files(project))
+    assert json.loads(upload_cache.read_text(encoding="utf-8"))
+
+    # Новый процесс: кэш в памяти пуст и читается с диска
+    monkeypatch.setattr(gemini_api, "_upload_cache", None)
+    gemini_api.upload_files(_db_files(project))
+    assert fake_llm.stats["uploads"] == 2
+
+
+def test_changed_content_is_uploaded_again(project, fake_llm):
+    txt = next(path for path in _db_files(project) if path.endswith(".txt"))
+    _, sent = gemini_api.upload_file(txt)
+    assert sent == Path(txt).stat().st_size
+
+    Path(txt).write_text("другой текст", encoding="utf-8")
+    file, sent = gemini_api.upload_file(txt)
+    assert sent == len("другой текст".encode("utf-8"))
+    assert fake_llm.stats["uploads"] == 2
+    assert gemini_api.upload_file(txt) == (file, 0)
+
+
+def test_file_close_to_expiration_is_uploaded_again(project, fake_llm, monkeypatch):
+    txt = next(path for path in _db_files(project) if path.endswith(".txt"))
+    gemini_api.upload_file(txt)
+
+    soon = datetime.now(timezone.utc) + gemini_api.UPLOAD_CACHE_MARGIN / 2
+    for entry in gemini_api._upload_cache.values():
+        entry["expires_at"] = soon.isoformat()
+    gemini_api.upload_file(txt)
+
+    assert fake_llm.stats["uploads"] == 2
+    assert gemini_api.get_upload_cache_stats()["expired"] == 1
+    expires_at = datetime.fromisoformat(next(iter(gemini_api._upload_cache.values()))["expires_at"])
+    assert expires_at > datetime.now(timezone.utc) + timedelta(hours=47)
+
+
+def test_corrupted_cache_file_is_ignored(project, fake_llm, upload_cache):
+    upload_cache.write_text("{не json", encoding="utf-8")
+    files = gemini_api.upload_files(_db_files(project))
+    assert len(files) == 2 and fake_llm.stats["uploads"] == 2
+
@@ -0,0 +1,121 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+from services import usage_buffer
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустой буфер с журналом во временной папке; вместо БД — список записанных пачек (fail — БД недоступна)."""
+    db = SimpleNamespace(batches=[], fail=False)
+
+    def add_token_usage(session, rows):
+        if db.fail:
+            raise RuntimeError("БД недоступна")
+        db.batches.append(sorted(rows, key=lambda row: (row["user_id"], row["stage"])))
+
+    monkeypatch.setattr(usage_buffer, "USAGE_JOURNAL_FILE", tmp_path / "journal.jsonl")
+    monkeypatch.setattr(usage_buffer, "_pending", {})
+    monkeypatch.setattr(usage_buffer, "_ensure_started", lambda: None)
+    monkeypatch.setattr(usage_buffer, "add_token_usage", add_token_usage)
+    return db
+
+
+def _row(user_id: int, stage: str, tokens: int) -> dict:
+    return {"user_id": user_id, "day": date.today(), "model": "m", "stage": stage, "tokens": tokens}
+
+
+def _journals(tmp_path) -> list:
+    return sorted(tmp_path.glob("journal.jsonl*"))
+
+
+def test_charges_are_aggregated_into_one_batch(db, tmp_path):
+    for tokens in (10, 5):
+        usage_buffer.record(1, tokens, model="m", stage="expand")
+    usage_buffer.record(1, 3, model="m", stage="scenario")
+    usage_buffer.record(2, 0, model="m", stage="expand")
+
+    assert sorted(usage_buffer.pending_usage(1), key=lambda row: row["stage"]) == [
+        {"day": date.today().isoformat(), "model": "m", "stage": "expand", "tokens": 15},
+        {"day": date.today().isoformat(), "model": "m", "stage": "scenario", "tokens": 3},
+    ]
+    assert len(usage_buffer._journal_file().read_text(encoding="utf-8").splitlines()) == 3
+
+    assert usage_buffer.flush() == 2
+    assert db.batches == [[_row(1, "expand", 15), _row(1, "scenario", 3)]]
+    assert usage_buffer.pending_usage(1) == [] and _journals(tmp_path) == []
+    assert usage_buffer.flush() == 0
+
+
+def test_failed_flush_keeps_usage_for_the_next_one(db, tmp_path):
+    usage_buffer.record(1, 10, model="m", stage="expand")
+    db.fail = True
+    assert usage_buffer.flush() == 0
+    assert usage_buffer.pending_usage(1)[0]["tokens"] == 10
+    assert len(_journals(tmp_path)) == 1
+
+    usage_buffer.record(1, 5, model="m", stage="expand")
+    db.fail = False
+    assert usage_buffer.flush() == 1
+    assert db.batches == [[_row(1, "expand", 15)]]
+    assert usage_buffer.pending_usage(1) == [] and _journals(tmp_path) == []
+
+
+def test_journal_of_a_crashed_process_is_replayed_on_start(db, tmp_path):
+    lines = [json.dumps({"user_id": 1, "day": date.today().isoformat(), "model": "m", "stage": "expand", "tokens": t})
+             for t in (4, 6)]
+    # Последняя строка недописана: процесс упал посреди записи
+    (tmp_path / "journal.jsonl").write_text("\n".join(lines) + '\n{"user_id": 1, "da', encoding="utf-8")
+
+    usage_buffer.start()
+    assert db.batches == [[_row(1, "expand", 10)]]
+    assert _journals(tmp_path) == []
+
+
+def _journal_line(tokens: int) -> str:
+    return json.dumps({"user_id": 1, "day": date.today().isoformat(), "model": "m", "stage": "expand",
+                       "tokens": tokens}) + "\n"
+
+
+def test_journals_of_other_processes(db, tmp_path):
+    # Родитель pytest жив — его журнал сбрасывает он сам; завершившийся процесс — уже нет
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    alive = tmp_path / f"journal.jsonl.pid{os.getppid()}"
+    alive.write_text(_journal_line(100), encoding="utf-8")
+    dead = tmp_path / f"journal.jsonl.pid{finished.pid}.123"
+    dead.write_text(_journal_line(7), encoding="utf-8")
+
+    usage_buffer.record(1, 1, model="m", stage="expand")
+    assert usage_buffer.flush() == 1
+    assert db.batches == [[_row(1, "expand", 1)]]
+    assert alive.exists() and dead.exists()
+
+    usage_buffer.start()
+    assert db.batches[-1] == [_row(1, "expand", 7)]
+    assert _journals(tmp_path) == [alive]
+
+
+def test_failed_journal_write_closes_the_file(db, monkeypatch):
+    opened = []
+
+    class FullDisk:
+        closed = False
+
+        def write(self, line):
+            raise OSError("No space left on device")
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(usage_buffer, "open", lambda *args, **kwargs: opened.append(FullDisk()) or opened[-1],
+                        raising=False)
+    with pytest.raises(OSError):
+        usage_buffer.record(1, 10, model="m", stage="expand")
+    assert opened[0].closed and usage_buffer.pending_usage(1) == []
@@ -1,7 +1,9 @@
 import streamlit as st
 import requests
 import os
-from typing import Optional, List, Dict
+import time
+import json
+from typing import Optional, List, Dict, Callable, Iterator
 
 FASTAPI_BASE_URL = os.environ.get('FASTAPI_SERVICE_URL')
 
@@ -88,30 +90,118 @@ def share_project_access(jwt_token: str, project_id: int, target_username: str,
     return _make_request("POST", f"{FASTAPI_BASE_URL}/data/projects/share", jwt_token, payload)
 
 # --- 4. WORKFLOWS (LLM) ---
-def expand_db(jwt_token: str, folder_path: str, project_id: int, llm_model: str) -> Dict:
+# Workflow-эндпоинты возвращают job_id сразу, а сама генерация идет в фоне.
+JOB_POLL_INTERVAL = 3  # секунд между опросами статуса задачи
+
+def get_job_status(jwt_token: str, job_id: str) -> Dict:
+    """Возвращает текущее состояние фоновой задачи."""
+    return _make_request("GET", f"{FASTAPI_BASE_URL}/workflow/jobs/{job_id}", jwt_token)
+
+def wait_for_job(jwt_token: str, job: Dict) -> Dict:
+    """Опрашивает задачу до завершения. Возвращает задачу или поднимает APIError при ошибке."""
+    job_id = job["job_id"]
+    while True:
+        job = get_job_status(jwt_token, job_id)
+        if job["status"] == "done":
+            return job
+        if job["status"] in ("failed", "orphaned"):
+            raise APIError(500, job.get("error") or f"Задача {job_id} завершилась с ошибкой", job)
+        if job["status"] == "cancelled":
+            raise APIError(409, job.get("error") or f"Задача {job_id} отменена", job)
+        time.sleep(JOB_POLL_INTERVAL)
+
+def cancel_job(jwt_token: str, job_id: str) -> Dict:
+    """Останавливает фоновую задачу (списываются только уже потраченные токены)."""
+    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/jobs/{job_id}/cancel", jwt_token)
+
+def stream_job_events(jwt_token: str, project_id: int, start_job: Callable[[], Dict]) -> Iterator[Dict]:
+    """
+    Подключается к SSE-потоку проекта, запускает задачу через start_job()
+    и отдает события этой задачи (lens_done, check_round_done, chapter_done, ...)
+    до job_done. При job_failed и job_cancelled поднимает APIError.
+    """
+    headers = {k: v for k, v in get_protected_headers(jwt_token).items() if k != "Content-Type"}
+    try:
+        response = requests.get(f"{FASTAPI_BASE_URL}/workflow/{project_id}/events",
+                                headers=headers, stream=True, timeout=(10, 60))
+    except requests.exceptions.ConnectionError:
+        raise ConnectionError("Не удалось подключиться к серверу API.")
+    with response:
+        if response.status_code >= 400:
+            _handle_response(response, "events")
+        job = start_job()
+        job_id = job["job_id"]
+        if job.get("job_status") == "done":
+            # Сервер вернул уже готовый результат такого же запроса — событий не будет
+            yield {"event": "job_done", **wait_for_job(jwt_token, job)}
+            return
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue  # Пустые строки-разделители, keepalive-комментарии и строки event:
+            event = json.loads(line[len("data: "):])
+            if event.get("job_id") != job_id:
+                continue
+            if event["event"] == "job_failed":
+                raise APIError(500, event.get("error") or f"Задача {job_id} завершилась с ошибкой", event)
+            if event["event"] == "job_cancelled":
+                raise APIError(409, f"Задача {job_id} отменена (потрачено токенов: {event.get('tokens', 0)})", event)
+            yield event
+            if event["event"] == "job_done":
+                return
+    # Поток оборвался раньше завершения задачи — дожидаемся результата опросом
+    yield {"event": "job_done", **wait_for_job(jwt_token, job)}
+
+def expand_db(jwt_token: str, folder_path: str, project_id: int, llm_model: str, wait: bool = True) -> Dict:
     """Расширяет базу данных."""
     payload = {"folder_path": folder_path, "llm_model": llm_model}
-    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/expand", jwt_token, payload)
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/expand", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
 
-def find_facts(jwt_token: str, folder_path: str, project_id: int, llm_model: str, facts_type:str) -> Dict:
+def find_facts(jwt_token: str, folder_path: str, project_id: int, llm_model: str, facts_type:str, wait: bool = True) -> Dict:
     """Ищет факты и связи."""
     payload = {"folder_path": folder_path, "llm_model": llm_model, "search_type": facts_type}
-    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/search", jwt_token, payload)
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/search", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
 
-def check_hypothesis(jwt_token: str, folder_path: str, project_id: int, llm_model: str, facts_type: str = "main") -> Dict:
+def check_hypothesis(jwt_token: str, folder_path: str, project_id: int, llm_model: str, facts_type: str = "main", wait: bool = True) -> Dict:
     """Проверяет гипотезы."""
     payload = {"folder_path": folder_path, "llm_model": llm_model, "search_type": facts_type}
-    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/check", jwt_token, payload) 
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/facts/check", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
 
-def create_scenario_structure(jwt_token: str, folder_path: str, project_id: int, num_series: int, llm_model: str) -> Dict:
+def create_scenario_structure(jwt_token: str, folder_path: str, project_id: int, num_series: int, llm_model: str, wait: bool = True) -> Dict:
     """Создает структуру сценария."""
     payload = {"folder_path": folder_path, "llm_model": llm_model, "num_series": num_series}
-    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/scenario/structure", jwt_token, payload)
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/scenario/structure", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
+
+def create_scenario(jwt_token: str, folder_path: str, project_id: int, llm_model: str, temperature: float,
+                    resume: bool = False, parallel_series: bool = False, wait: bool = True) -> Dict:
+    """Создает текст сценария. resume=True — продолжить с первой ненаписанной главы."""
+    payload = {"folder_path": folder_path, "llm_model": llm_model, "temperature": temperature,
+               "resume": resume, "parallel_series": parallel_series}
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/scenario", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
 
-def create_scenario(jwt_token: str, folder_path: str, project_id: int, llm_model: str, temperature: float) -> Dict:
-    """Создает текст сценария."""
+def run_pipeline(jwt_token: str, folder_path: str, project_id: int, llm_model: str, num_series: int,
+                 temperature: float, parallel_series: bool = False, force: bool = False, wait: bool = True) -> Dict:
+    """Прогоняет все этапы (от отчетов до .docx) одной задачей. force — не пропускать неизменившиеся этапы."""
+    payload = {"folder_path": folder_path, "llm_model": llm_model, "num_series": num_series,
+               "temperature": temperature, "parallel_series": parallel_series, "force": force}
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/pipeline", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
+
+def regenerate_scenario_part(jwt_token: str, folder_path: str, project_id: int, llm_model: str, temperature: float,
+                             chapter_id: Optional[str] = None, serie_id: Optional[str] = None, wait: bool = True) -> Dict:
+    """Переписывает одну главу (chapter_id) или одну серию (serie_id) готового сценария."""
     payload = {"folder_path": folder_path, "llm_model": llm_model, "temperature": temperature}
-    return _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/scenario", jwt_token, payload)
+    target = f"chapters/{chapter_id}" if chapter_id is not None else f"series/{serie_id}"
+    job = _make_request("POST", f"{FASTAPI_BASE_URL}/workflow/{project_id}/scenario/{target}", jwt_token, payload)
+    return wait_for_job(jwt_token, job) if wait else job
+
+def get_pipeline_stages(jwt_token: str, project_id: int) -> List[Dict]:
+    """Состояние этапов проекта: fresh / stale / never_run."""
+    return _make_request("GET", f"{FASTAPI_BASE_URL}/workflow/{project_id}/stages", jwt_token)
 
 
 
@@ -1,6 +1,6 @@
 import streamlit as st
-from streamlit_modules.api_calls import expand_db, fetch_file, upload_reports_to_api, APIError
-from streamlit_modules.utils import show_default_text_editor  
+from streamlit_modules.api_calls import expand_db, fetch_file, upload_reports_to_api, stream_job_events, APIError
+from streamlit_modules.utils import show_default_text_editor, show_job_events
 from streamlit_modules.auth import handle_jwt_token_expired
 
 def show_expand_db_ui():
@@ -30,9 +30,11 @@ def show_expand_db_ui():
     selected_llm = st.selectbox("Модель LLM:", options=st.session_state.GEMINI_MODELS, key="expand_model")
     if st.button(" Расширить БД"):
         try:
-            with st.spinner("Расширение БД..."):
-                result = expand_db(st.session_state.jwt_token, st.session_state.active_project_folder,
-                                   st.session_state.active_project_id, selected_llm)
+            result = show_job_events(stream_job_events(
+                st.session_state.jwt_token, st.session_state.active_project_id,
+                lambda: expand_db(st.session_state.jwt_token, st.session_state.active_project_folder,
+                                  st.session_state.active_project_id, selected_llm, wait=False)
+            ), "Расширение БД")
             st.success("✅ БД расширена.")
             st.json(result)
         except APIError as e:
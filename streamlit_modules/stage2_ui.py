@@ -1,8 +1,8 @@
 import streamlit as st
 from streamlit_modules.api_calls import (
-    find_facts, check_hypothesis, download_lens_zip, fetch_file, APIError
+    find_facts, check_hypothesis, download_lens_zip, fetch_file, stream_job_events, APIError
 )
-from streamlit_modules.utils import show_default_text_editor  # Импорт общей функции редактора
+from streamlit_modules.utils import show_default_text_editor, show_job_events  # Импорт общей функции редактора
 from streamlit_modules.auth import handle_jwt_token_expired
 
 def show_facts_ui():
@@ -30,11 +30,13 @@ def show_facts_ui():
         with col1:
             if st.button(f" Запустить Поиск ({selected_algorithm})"):
                 try:
-                    with st.spinner(f"Поиск связей с {selected_algorithm}..."):
-                        # facts_type на основе алгоритма (ALG_MAIN -> "main", ALG_BLIND -> "blind_spots")
-                        facts_type = "main" if "MAIN" in selected_algorithm else "blind_spots"
-                        result = find_facts(st.session_state.jwt_token, st.session_state.active_project_folder,
-                                            st.session_state.active_project_id, selected_llm, facts_type)
+                    # facts_type на основе алгоритма (ALG_MAIN -> "main", ALG_BLIND -> "blind_spots")
+                    facts_type = "main" if "MAIN" in selected_algorithm else "blind_spots"
+                    result = show_job_events(stream_job_events(
+                        st.session_state.jwt_token, st.session_state.active_project_id,
+                        lambda: find_facts(st.session_state.jwt_token, st.session_state.active_project_folder,
+                                           st.session_state.active_project_id, selected_llm, facts_type, wait=False)
+                    ), f"Поиск связей с {selected_algorithm}")
                     st.success("✅ Факты найдены.")
                     st.json(result)
                     if facts_type == "main":
@@ -48,9 +50,11 @@ def show_facts_ui():
                 if selected_algorithm == "MAIN":
                     try:
                         facts_type = "main" if "MAIN" in st.session_state.selected_algorithm else "blind_spots"
-                        with st.spinner("Проверка фактов..."):
-                            result = check_hypothesis(st.session_state.jwt_token, st.session_state.active_project_folder,
-                                                    st.session_state.active_project_id, selected_llm, facts_type) 
+                        result = show_job_events(stream_job_events(
+                            st.session_state.jwt_token, st.session_state.active_project_id,
+                            lambda: check_hypothesis(st.session_state.jwt_token, st.session_state.active_project_folder,
+                                                     st.session_state.active_project_id, selected_llm, facts_type, wait=False)
+                        ), "Проверка фактов")
                         st.success("✅ Факты проверены.")
                         st.json(result)
                     except APIError as e:
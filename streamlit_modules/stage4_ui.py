@@ -1,5 +1,8 @@
 import streamlit as st
-from streamlit_modules.api_calls import create_scenario, download_scenario_docx, APIError
+from streamlit_modules.api_calls import (
+    create_scenario, run_pipeline, get_pipeline_stages, download_scenario_docx, stream_job_events, APIError
+)
+from streamlit_modules.utils import show_job_events
 from streamlit_modules.auth import handle_jwt_token_expired
 
 def show_scenario_ui():  # Переименовал в stage5, так как это написание сценария (Stage 5)
@@ -11,12 +14,19 @@ def show_scenario_ui():  # Переименовал в stage5, так как э
     selected_llm = st.selectbox("Модель LLM:", options=st.session_state.GEMINI_MODELS, key="scenario_model")
     temperature = st.slider("Температура (креативность):", min_value=0.6, max_value=1.5, value=1.0, step=0.1, 
                             help="Низкая — более предсказуемо, высокая — креативнее.")
+    resume = st.checkbox("Продолжить с последней готовой главы", value=False,
+                         help="Уже написанные по текущей структуре главы не будут сгенерированы заново.")
+    parallel_series = st.checkbox("Писать серии параллельно", value=False,
+                                  help="Быстрее, но переход между сериями строится по описанию главы, а не по ее тексту.")
 
     if st.button(" Написать Сценарий"):
         try:
-            with st.spinner("Генерация сценария..."):
-                result = create_scenario(st.session_state.jwt_token, st.session_state.active_project_folder,
-                                         st.session_state.active_project_id, selected_llm, temperature)
+            result = show_job_events(stream_job_events(
+                st.session_state.jwt_token, st.session_state.active_project_id,
+                lambda: create_scenario(st.session_state.jwt_token, st.session_state.active_project_folder,
+                                        st.session_state.active_project_id, selected_llm, temperature,
+                                        resume=resume, parallel_series=parallel_series, wait=False)
+            ), "Генерация сценария")
             st.success("✅ Сценарий сгенерирован.")
             st.json(result)
             download_scenario_docx.clear()
@@ -25,6 +35,37 @@ def show_scenario_ui():  # Переименовал в stage5, так как э
         except Exception as e:
             st.error(f"❌ Неожиданная ошибка: {e}")
 
+    with st.expander("⚡ Прогнать весь пайплайн одной задачей"):
+        st.caption("Расширение БД → поиск фактов (основной и слепые пятна параллельно) → проверка → "
+                   "структура → сценарий. Этапы, готовые по зависимостям, выполняются одновременно.")
+        try:
+            stages = get_pipeline_stages(st.session_state.jwt_token, st.session_state.active_project_id)
+            marks = {"fresh": "✅", "stale": "♻️", "never_run": "⬜"}
+            st.markdown("  \n".join(
+                f"{marks.get(s['status'], '')} {s['stage']}" + (f" — изменилось: {', '.join(s['changed'])}" if s['changed'] else "")
+                for s in stages
+            ))
+        except APIError as e:
+            st.warning(f"Не удалось получить состояние этапов: {e.message}")
+        num_series = st.number_input("Количество серий:", min_value=1, max_value=20, value=3, key="pipeline_series")
+        force = st.checkbox("Перезапустить все этапы", value=False,
+                            help="По умолчанию этапы, входы которых не менялись, пропускаются.")
+        if st.button("Запустить всё", key="run_pipeline"):
+            try:
+                result = show_job_events(stream_job_events(
+                    st.session_state.jwt_token, st.session_state.active_project_id,
+                    lambda: run_pipeline(st.session_state.jwt_token, st.session_state.active_project_folder,
+                                         st.session_state.active_project_id, selected_llm, int(num_series),
+                                         temperature, parallel_series=parallel_series, force=force, wait=False)
+                ), "Пайплайн")
+                st.success("✅ Пайплайн завершен, сценарий сгенерирован.")
+                st.json(result)
+                download_scenario_docx.clear()
+            except APIError as e:
+                st.error(f"❌ Ошибка: {e.message}")
+            except Exception as e:
+                st.error(f"❌ Неожиданная ошибка: {e}")
+
     # Раздел скачивания (в самом низу)
     st.divider()
     st.subheader("💌 Скачать Сценарий")
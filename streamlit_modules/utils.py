@@ -1,6 +1,6 @@
-from typing import Dict
+from typing import Dict, Iterator
 import streamlit as st
-from streamlit_modules.api_calls import save_file, APIError
+from streamlit_modules.api_calls import save_file, cancel_job, APIError
 import json
 import uuid
 
@@ -200,4 +200,56 @@ def show_structure_editor(stage_name: str,  project_id: int, folder_path: str, j
         if st.button("🔙 Назад", key=f"back_{stage_name}"):
             # Логика возврата (очистка или переключение)
             st.session_state.file_content_editing = None
-            st.rerun()
\ No newline at end of file
+            st.rerun()
+
+
+# --- Отображение прогресса фоновой задачи (SSE) ---
+def show_job_events(job_events: Iterator[Dict], title: str) -> Dict:
+    """
+    Отрисовывает события задачи по мере поступления: тексты линз, раундов проверки и глав
+    появляются сразу, не дожидаясь конца всего workflow. Возвращает финальное событие job_done.
+    """
+    status_box = st.status(f"{title}: задача поставлена в очередь...", expanded=True)
+    # Текст, который генерируется прямо сейчас (text_delta), до события о готовности линзы/главы
+    live_box = status_box.empty()
+    live_text = ""
+    final_event = {}
+    for event in job_events:
+        kind = event["event"]
+        if kind == "text_delta":
+            live_text += event.get("delta", "")
+            live_box.markdown(live_text)
+            continue
+        if kind in ("lens_done", "chapter_done"):
+            live_text = ""
+            live_box.empty()
+        if kind == "job_queued":
+            status_box.update(label=f"{title}: ждет свободного слота (позиция в очереди: {event['position']})")
+        elif kind == "job_started":
+            status_box.update(label=f"{title}: выполняется...")
+            # Нажатие перезапускает скрипт, но on_click успевает отправить отмену на сервер
+            status_box.button("⏹ Остановить", key=f"cancel_{event['job_id']}", on_click=cancel_job,
+                              args=(st.session_state.jwt_token, event["job_id"]))
+        elif kind == "stage_started":
+            status_box.update(label=f"{title}: этап {event['pipeline_stage']} запущен "
+                                    f"({event['done']} из {event['total']} готово)")
+        elif kind == "stage_done":
+            status_box.update(label=f"{title}: этап {event['pipeline_stage']} готов "
+                                    f"({event['done']} из {event['total']})")
+            status_box.write(f"✅ Этап {event['pipeline_stage']} завершен")
+        elif kind == "lens_done":
+            status_box.update(label=f"{title}: линза {event['lens']} из {event['total']} готова")
+            with status_box.expander(f"Линза {event['lens']}"):
+                st.markdown(event.get("text", ""))
+        elif kind == "check_round_done":
+            status_box.update(label=f"{title}: раунд проверки {event['round']} из {event['total']} готов")
+            with status_box.expander(f"Раунд проверки {event['round']}"):
+                st.markdown(event.get("text", ""))
+        elif kind == "chapter_done":
+            status_box.update(label=f"{title}: глава {event['index']} из {event['total']} готова")
+            with status_box.expander(f"Серия {event['serie']}, глава {event['chapter']}"):
+                st.markdown(event.get("text", ""))
+        elif kind == "job_done":
+            final_event = event
+            status_box.update(label=f"{title}: готово (токенов: {event.get('tokens', 0)})", state="complete")
+    return final_event